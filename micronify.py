@@ -1,11 +1,27 @@
 from markdownify import MarkdownConverter, chomp
+from bs4 import BeautifulSoup
 import posixpath
 
+
+class CheckedSoup(BeautifulSoup):
+    """
+    Parses like markdownify does, calling check() at every start tag so a long parse can be abandoned too
+    """
+    def __init__(self, markup, check):
+        self._check = check
+        super().__init__(markup, 'html.parser')
+    
+    def handle_starttag(self, *args, **kwargs):
+        self._check()
+        return super().handle_starttag(*args, **kwargs)
+
     
 class MicronConverter(MarkdownConverter):
     current_path = "/" # for relative href rewriting
     reader_path = "/page/zr.mu" # so we can create valid micron links that will actually point where we want them to
     url_suffix=""
+    path_exists = None # optional callable, False for in-archive paths known not to exist so their links render as plain text
+    check = None # optional callable, called before each tag, raises to abandon a conversion that's taking too long
     
     def convert_a(self, el, text, convert_as_inline):
         prefix, suffix, text = chomp(text)
@@ -23,10 +39,40 @@ class MicronConverter(MarkdownConverter):
         if self.options['default_title'] and not title:
             title = href
         #title_part = ' "%s"' % title.replace('"', r'\"') if title else ''
+        if href and self.is_dead_link(href):
+            return prefix + text + suffix
         micron_link = self.rewrite_link(href)
         return '`F44a%s`[%s`%s]%s`f' % (prefix, text, micron_link, suffix) if href else text
     
     
+    def link_path(self, link):
+        """
+        The archive path a link points to, None if it points outside the archive
+        """
+        if link is None or len(link)==0 or link.startswith("http"):
+            return None
+        # micron has no anchors, the page is the best we can do
+        link = link.split("#", 1)[0]
+        if len(link)==0:
+            return self.current_path
+        
+        # absolute path
+        if link.startswith("/"):
+            return link
+        
+        #relative path
+        current_dir = posixpath.dirname(self.current_path) if not self.current_path.endswith("/") else self.current_path
+        new_link = posixpath.normpath(posixpath.join(current_dir, link))
+        if link.endswith("/") and not new_link.endswith("/"):
+            new_link += "/"
+        return new_link
+    
+    def is_dead_link(self, link):
+        if self.path_exists is None:
+            return False
+        path = self.link_path(link)
+        return path is not None and self.path_exists(path) is False
+    
     def rewrite_link(self, link):
         """
         Rewrite a link so it actually goes where we want
@@ -39,18 +85,7 @@ class MicronConverter(MarkdownConverter):
         if link.startswith("http"):
             return link
         
-        
-        # absolute path
-        if link.startswith("/"):
-            return ":" + self.reader_path + "`p=" +link + self.url_suffix
-        
-        #relative path
-        current_dir = posixpath.dirname(self.current_path) if not self.current_path.endswith("/") else self.current_path
-        new_link = posixpath.normpath(posixpath.join(current_dir, link))
-        if link.endswith("/") and not new_link.endswith("/"):
-            new_link += "/"
-            
-        return ":" + self.reader_path + "`p=" + new_link + self.url_suffix
+        return ":" + self.reader_path + "`p=" + self.link_path(link) + self.url_suffix
     
     def convert_b(self, el, text, convert_as_inline):
         return "`!" + text + "`!"
@@ -78,20 +113,35 @@ class MicronConverter(MarkdownConverter):
         src = el.attrs.get('src', None) or ''
         title = el.attrs.get('title', None) or ''
 
-        new_src = self.rewrite_link(src)
         if len(title) > 0:
             label = title + (f"〚alt:{alt}〛" if len(alt) > 0 else '')
         elif len(alt) > 0:
             label = alt
         else:
             label = src
+        # nopic zims keep the tags but drop the images
+        if self.is_dead_link(src):
+            return '(🖻:%s)' % label
+        new_src = self.rewrite_link(src)
         return '`F44a`[(🖻:%s)`%s]`f' % (label , new_src) 
 
 
     convert_i = convert_em
     
+    def process_tag(self, node, *args, **kwargs):
+        if self.check is not None:
+            self.check()
+        return super().process_tag(node, *args, **kwargs)
+    
+    def convert(self, html):
+        if self.check is None:
+            return super().convert(html)
+        return self.convert_soup(CheckedSoup(html, self.check))
+    
     def convert_soup(self, soup):
         self._clean_soup(soup)
+        if self.check is not None:
+            self.check()
         return super().convert_soup(soup)
         
     def _clean_soup(self, soup):
@@ -121,8 +171,10 @@ class MicronConverter(MarkdownConverter):
             tag.decompose()
     
 # the good stuff here
-def html_to_micron(html, current_path=None, extra_get_params=None):
+def html_to_micron(html, current_path=None, extra_get_params=None, path_exists=None, check=None):
     converter = MicronConverter(wrap=False, wrap_width=180, escape_underscore=False)
+    converter.path_exists = path_exists
+    converter.check = check
     # set the current path for href rewriting
     if current_path is not None:
         converter.current_path = current_path
@@ -0,0 +1,212 @@
+# Parallel QR decoding for qr_rns.py. Images are decoded in worker processes that each load
+# the QReader model once, so a heavy image never blocks the asyncio loop and several
+# attachments or webcam frames decode on all cores at the same time.
+#
+# Every image goes through a cascade, cheapest first:
+#   classical  OpenCV's QRCodeDetector on a downscaled grayscale copy
+#   crop       a code the classical pass found but could not read is cropped out at full resolution
+#              and tried with QRCodeDetector again, then with QReader
+#   full       QReader on the whole image, only when the classical pass found nothing at all
+# The classical detector looks for a single code, which is what LXM QR codes come as. Images
+# with several codes may only have one of them read when the classical pass succeeds.
+#
+# Polled webcam frames get a stage before that:
+#   change     a small grayscale thumbnail, decoded at 1/8 scale, compared to the previous frame's,
+#              frames where no cell moved by CHANGE_THRESHOLD are not decoded any further
+
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+# longest side of the image the classical detector looks at, smaller misses dense codes
+CLASSICAL_MAX_SIDE = 1600
+# margin around a candidate code when cropping it out, relative to the code's size
+CROP_MARGIN = 0.25
+
+# thumbnail size for change detection, a QR code held up in a corner still covers a few cells
+THUMBNAIL_SIZE = (64, 48)
+# grey levels a thumbnail cell has to move for the frame to count as changed
+CHANGE_THRESHOLD = 24
+
+# hits of the change stage are frames skipped as unchanged
+STAGES = ("change", "imdecode", "classical", "crop", "full")
+
+# the models of the worker process this module is loaded in, see _init_worker()
+_qreader = None
+_detector = None
+
+
+def _init_worker():
+    global _qreader, _detector
+    # imported here so the parent process never pays for loading the model
+    from qreader import QReader
+    _qreader = QReader()
+    _detector = cv2.QRCodeDetector()
+
+
+def _qreader_texts(image):
+    return [text for text in _qreader.detect_and_decode(image=image) if text is not None]
+
+
+def _classical(gray, max_side=None):
+    """(text or None, full resolution corners of the code or None if none was found)"""
+    scale = 1.0
+    if max_side is not None and max(gray.shape[:2]) > max_side:
+        scale = max_side / max(gray.shape[:2])
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    try:
+        text, points, _ = _detector.detectAndDecode(gray)
+    except cv2.error:
+        return None, None
+    if points is None:
+        return None, None
+    return text or None, points.reshape(-1, 2) / scale
+
+
+def _crop(image, quad):
+    (x0, y0), (x1, y1) = quad.min(axis=0), quad.max(axis=0)
+    margin = CROP_MARGIN * max(x1 - x0, y1 - y0)
+    height, width = image.shape[:2]
+    return image[max(0, int(y0 - margin)):min(height, int(y1 + margin)),
+                 max(0, int(x0 - margin)):min(width, int(x1 + margin))]
+
+
+def _decode(buf):
+    """
+    Runs in a worker: (texts of the QR codes in an encoded image or None if it's not an image,
+    seconds spent per stage, the last stage that found something or None)
+    """
+    timings = {}
+    start = time.perf_counter()
+    image = cv2.imdecode(np.frombuffer(buf, dtype=np.uint8), cv2.IMREAD_COLOR)
+    timings["imdecode"] = time.perf_counter() - start
+    if image is None:
+        return None, timings, None
+
+    start = time.perf_counter()
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    text, quad = _classical(gray, CLASSICAL_MAX_SIDE)
+    timings["classical"] = time.perf_counter() - start
+    if text is not None:
+        return [text], timings, "classical"
+
+    if quad is not None:
+        start = time.perf_counter()
+        text, _ = _classical(_crop(gray, quad))
+        texts = [text] if text is not None else _qreader_texts(_crop(image, quad))
+        timings["crop"] = time.perf_counter() - start
+        if texts:
+            return texts, timings, "crop"
+
+    start = time.perf_counter()
+    texts = _qreader_texts(image)
+    timings["full"] = time.perf_counter() - start
+    return texts, timings, "full" if texts else None
+
+
+def _thumbnail(buf):
+    small = cv2.imdecode(np.frombuffer(buf, dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if small is None:
+        return None
+    return cv2.resize(small, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA)
+
+
+def _decode_frame(buf, previous):
+    """
+    Runs in a worker: _decode() for a polled frame, unless its thumbnail looks like the previous
+    one. Returns _decode()'s result plus the frame's thumbnail, texts are None if skipped.
+    """
+    start = time.perf_counter()
+    thumbnail = _thumbnail(buf)
+    changed = (thumbnail is not None and
+               (previous is None or np.abs(thumbnail.astype(np.int16) - previous).max() >= CHANGE_THRESHOLD))
+    timings = {"change": time.perf_counter() - start}
+    if not changed:
+        return None, timings, "change" if thumbnail is not None else None, thumbnail
+
+    texts, decode_timings, hit = _decode(buf)
+    timings.update(decode_timings)
+    return texts, timings, hit, thumbnail
+
+
+class DecodeStats:
+    """Per-stage run counts, time spent and hits of the decode cascade, kept in the parent process"""
+
+    def __init__(self):
+        self.images = 0
+        self.runs = dict.fromkeys(STAGES, 0)
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self.hits = dict.fromkeys(STAGES, 0)
+
+    def record(self, timings, hit):
+        self.images += 1
+        for stage, seconds in timings.items():
+            self.runs[stage] += 1
+            self.seconds[stage] += seconds
+        if hit is not None:
+            self.hits[hit] += 1
+
+    def summary(self):
+        parts = ["decode stats: %d images" % self.images]
+        for stage in STAGES:
+            runs = self.runs[stage]
+            if runs == 0:
+                continue
+            part = "%s %d runs avg %.1fms" % (stage, runs, 1000 * self.seconds[stage] / runs)
+            if stage != "imdecode":
+                part += " hits %d (%.0f%%)" % (self.hits[stage], 100 * self.hits[stage] / runs)
+            parts.append(part)
+        return ", ".join(parts)
+
+
+class DecodePool:
+    """
+    Process pool for QR decoding with an async API. At most max_pending images are in
+    the pool at once, decode() waits for a free slot and decode_frame() gives up right away.
+    """
+
+    def __init__(self, workers=None, max_pending=None):
+        self.workers = workers or max(1, min(4, os.cpu_count() or 1))
+        self.max_pending = max_pending or 2 * self.workers
+        # spawn, forking a process that already runs RNS threads is asking for trouble
+        self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                            mp_context=multiprocessing.get_context("spawn"),
+                                            initializer=_init_worker)
+        self._slots = None
+        self.stats = DecodeStats()
+
+    @property
+    def slots(self):
+        # created on first use so it belongs to the running loop
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+        return self._slots
+
+    async def decode(self, buf):
+        """QR texts found in the image, None if buf is not an image"""
+        async with self.slots:
+            texts, timings, hit = await asyncio.wrap_future(self.executor.submit(_decode, bytes(buf)))
+        self.stats.record(timings, hit)
+        return texts
+
+    async def decode_frame(self, buf, previous=None, wait=False):
+        """
+        For polled frames, stale by the time a slot frees up: (texts, thumbnail) where texts is
+        None if it is not an image or looks unchanged from the previous thumbnail, or False right
+        away if the pool is full. With wait, for frames that don't go stale, it waits for a slot.
+        """
+        if not wait and self.slots.locked():
+            return False
+        async with self.slots:
+            texts, timings, hit, thumbnail = await asyncio.wrap_future(
+                self.executor.submit(_decode_frame, bytes(buf), previous))
+        self.stats.record(timings, hit)
+        return texts, thumbnail
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,98 @@
+# Replay protection for qr_rns.py. A QR code that sits in a webcam's view is read again on every
+# poll, the index remembers the hashes of LXMF messages already queued so each goes out once.
+# Memory is bounded by an LRU limit and a TTL, and the index can be saved to a file so a restart
+# doesn't send everything still on camera again.
+
+import os
+import struct
+import time
+from collections import OrderedDict
+
+# hash (RNS.Identity.full_hash, 32 bytes) + wall clock time it was last seen
+_RECORD = struct.Struct("!32sd")
+
+
+class DedupeIndex:
+    """
+    Message hashes seen in the last ttl seconds, at most max_entries of them, least recently
+    seen ones are forgotten first. Seeing a hash again refreshes it, so a code that stays on
+    camera for longer than ttl is still only sent once.
+    """
+
+    def __init__(self, max_entries=100000, ttl=7*24*3600, path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        # hash -> time last seen, oldest first
+        self.entries = OrderedDict()
+        self.dirty = False
+        self.counts = dict.fromkeys(("new", "duplicate"), 0)
+        if path is not None:
+            self.load()
+
+    def check(self, msg_hash, now=None):
+        """True if msg_hash is new, and remembers it, False if it was seen within ttl"""
+        now = time.time() if now is None else now
+        seen = self.entries.pop(msg_hash, None)
+        self.entries[msg_hash] = now
+        self.dirty = True
+        if seen is not None and now - seen < self.ttl:
+            self.counts["duplicate"] += 1
+            return False
+        self.counts["new"] += 1
+        self.expire(now)
+        return True
+
+    def forget(self, msg_hash):
+        # for messages that turned out to be undeliverable, so they can be tried again
+        if self.entries.pop(msg_hash, None) is not None:
+            self.dirty = True
+
+    def expire(self, now=None):
+        now = time.time() if now is None else now
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        while self.entries:
+            msg_hash, seen = next(iter(self.entries.items()))
+            if now - seen < self.ttl:
+                break
+            del self.entries[msg_hash]
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            print("Could not load dedupe index "+self.path+": "+str(e))
+            return
+        # a torn last record from a crash is ignored
+        usable = len(data) - len(data) % _RECORD.size
+        records = sorted(_RECORD.iter_unpack(data[:usable]), key=lambda record: record[1])
+        for msg_hash, seen in records:
+            self.entries.pop(msg_hash, None)
+            self.entries[msg_hash] = seen
+        self.expire()
+        print("Loaded "+str(len(self.entries))+" message hashes from "+self.path)
+
+    def save(self):
+        """Writes the index if it changed since the last save, a no-op without a path"""
+        if self.path is None or not self.dirty:
+            return
+        self.expire()
+        tmp = self.path+".tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(b"".join(_RECORD.pack(msg_hash, seen) for msg_hash, seen in self.entries.items()))
+            # replace so a crash mid-write leaves the old index, not half of one
+            os.replace(tmp, self.path)
+            self.dirty = False
+        except OSError as e:
+            print("Could not save dedupe index "+self.path+": "+str(e))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return "dedupe: "+str(len(self.entries))+" hashes "+str(self.counts)
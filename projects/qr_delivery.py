@@ -0,0 +1,114 @@
+# Delivery scheduling for qr_rns.py. Outgoing items are grouped by destination, a destination
+# without a path is retried with exponential backoff instead of on every tick, and gives up
+# after max_attempts. An announce (which is how paths arrive) wakes its destination right away.
+
+import asyncio
+import heapq
+import itertools
+import random
+import time
+
+
+class _Destination:
+    __slots__ = ("items", "attempts", "due")
+
+    def __init__(self, due):
+        self.items = []
+        self.attempts = 0
+        self.due = due
+
+
+class DeliveryQueue:
+    """
+    Items waiting for a path, per destination hash. Not thread safe, use it from the event loop,
+    other threads go through loop.call_soon_threadsafe().
+    """
+
+    def __init__(self, base_delay=5, max_delay=600, max_attempts=12):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        # destination hash -> _Destination
+        self.pending = {}
+        # (due, seq, destination hash), an entry is stale if its due no longer matches the destination's
+        self.heap = []
+        self.seq = itertools.count()
+        self._event = None
+        self.counts = dict.fromkeys(("queued", "attempts", "woken", "expired"), 0)
+
+    @property
+    def event(self):
+        # created on first use so it belongs to the running loop
+        if self._event is None:
+            self._event = asyncio.Event()
+        return self._event
+
+    def _schedule(self, destination_hash, state, due):
+        state.due = due
+        heapq.heappush(self.heap, (due, next(self.seq), destination_hash))
+        self.event.set()
+
+    def put(self, destination_hash, item):
+        """Queues item for destination_hash, a new destination is due right away"""
+        self.counts["queued"] += 1
+        state = self.pending.get(destination_hash)
+        if state is None:
+            state = self.pending[destination_hash] = _Destination(None)
+            self._schedule(destination_hash, state, time.monotonic())
+        state.items.append(item)
+
+    def wake(self, destination_hash):
+        """A path to destination_hash showed up, try it now. Unknown destinations are ignored."""
+        state = self.pending.get(destination_hash)
+        if state is not None and state.due > time.monotonic():
+            self.counts["woken"] += 1
+            self._schedule(destination_hash, state, time.monotonic())
+
+    def pop_due(self):
+        """(destination hash, items, attempts so far) for every destination that is due, they leave the queue"""
+        now = time.monotonic()
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            when, _, destination_hash = heapq.heappop(self.heap)
+            state = self.pending.get(destination_hash)
+            if state is None or state.due != when:
+                continue
+            del self.pending[destination_hash]
+            due.append((destination_hash, state.items, state.attempts))
+        return due
+
+    def retry(self, destination_hash, items, attempts):
+        """
+        Puts items back after a failed attempt, attempts is what pop_due() reported. Returns the
+        items that ran out of attempts, if so.
+        """
+        self.counts["attempts"] += 1
+        attempts += 1
+        if attempts >= self.max_attempts:
+            self.counts["expired"] += len(items)
+            return items
+        state = self.pending.get(destination_hash)
+        if state is None:
+            delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+            state = self.pending[destination_hash] = _Destination(None)
+            self._schedule(destination_hash, state, time.monotonic() + delay * random.uniform(0.8, 1.2))
+        # items queued in the meantime were new and came after these
+        state.items[:0] = items
+        state.attempts = max(state.attempts, attempts)
+        return []
+
+    async def wait(self, timeout):
+        """Sleeps until something is due, a destination is woken or timeout passes"""
+        if self.heap:
+            timeout = min(timeout, max(0, self.heap[0][0] - time.monotonic()))
+        self.event.clear()
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def __len__(self):
+        return sum(len(state.items) for state in self.pending.values())
+
+    def stats(self):
+        return "delivery: "+str(len(self))+" items for "+str(len(self.pending))+" destinations "+str(self.counts)
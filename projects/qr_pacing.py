@@ -0,0 +1,131 @@
+# Outbound pacing for qr_rns.py. A burst of QR codes would otherwise go out back to back and
+# fill a slow interface like LoRa, leaving no airtime for anyone else's traffic. Each item's
+# airtime is estimated from its size and the bitrate of the interface towards its destination,
+# a token bucket holds the share of airtime we may use (the duty cycle), and replies and
+# deliveries take turns so a batch of one doesn't hold up the other.
+
+import asyncio
+import time
+from collections import deque
+
+# bytes sent besides the payload, RNS' largest header
+PACKET_OVERHEAD = 35
+KINDS = ("reply", "packet")
+
+
+def airtime(size, bitrate):
+    """Seconds a packet with size bytes of payload takes at bitrate bits/s"""
+    return (size + PACKET_OVERHEAD) * 8 / bitrate
+
+
+class AirtimeBucket:
+    """
+    duty_cycle seconds of airtime per second, up to burst seconds saved up. An item that costs
+    more than burst goes once the bucket is full and leaves it in debt.
+    """
+
+    def __init__(self, duty_cycle=0.1, burst=5):
+        self.rate = duty_cycle
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, cost, now=None):
+        """Seconds until cost seconds of airtime may be spent"""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        needed = min(cost, self.capacity)
+        if self.tokens >= needed:
+            return 0
+        return (needed - self.tokens) / self.rate
+
+    def take(self, cost):
+        self.tokens -= cost
+
+
+class OutboundPacer:
+    """
+    Items ready to send, one queue per kind, sent by run() as the airtime budget allows. Not
+    thread safe, use it from the event loop.
+    """
+
+    def __init__(self, duty_cycle=0.1, burst=5, min_interval=0.01):
+        self.bucket = AirtimeBucket(duty_cycle, burst)
+        # a small gap even on fast interfaces, so a big queue doesn't go out in one go
+        self.min_interval = min_interval
+        # kind -> deque of (time queued, airtime, entry)
+        self.queues = {kind: deque() for kind in KINDS}
+        # index into KINDS of the kind whose turn it is
+        self.turn = 0
+        self._event = None
+        self.counts = {kind: dict.fromkeys(("sent", "airtime", "wait_total", "wait_max", "throttled"), 0)
+                       for kind in KINDS}
+
+    @property
+    def event(self):
+        # created on first use so it belongs to the running loop
+        if self._event is None:
+            self._event = asyncio.Event()
+        return self._event
+
+    def put(self, kind, entry, cost):
+        """Queues entry of kind ("reply" or "packet"), which takes cost seconds of airtime"""
+        self.queues[kind].append((time.monotonic(), cost, entry))
+        self.event.set()
+
+    def _next_kind(self):
+        # the kind whose turn it is if it has something queued, else the next one that has
+        for i in range(len(KINDS)):
+            index = (self.turn + i) % len(KINDS)
+            if self.queues[KINDS[index]]:
+                return index
+        return None
+
+    async def run(self, send):
+        """Sends queued entries with await send(entry), forever"""
+        while True:
+            index = self._next_kind()
+            if index is None:
+                self.event.clear()
+                await self.event.wait()
+                continue
+            kind = KINDS[index]
+            queued_at, cost, entry = self.queues[kind][0]
+            delay = self.bucket.delay(cost)
+            if delay > 0:
+                self.counts[kind]["throttled"] += 1
+                # the other kind keeps its turn, whatever is queued meanwhile waits behind this
+                await asyncio.sleep(delay)
+                continue
+
+            self.queues[kind].popleft()
+            self.turn = (index + 1) % len(KINDS)
+            self.bucket.take(cost)
+            counts = self.counts[kind]
+            waited = time.monotonic() - queued_at
+            counts["sent"] += 1
+            counts["airtime"] += cost
+            counts["wait_total"] += waited
+            counts["wait_max"] = max(counts["wait_max"], waited)
+            try:
+                await send(entry)
+            except Exception as e:
+                print("Error sending "+kind+": "+str(e))
+            await asyncio.sleep(self.min_interval)
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def stats(self):
+        parts = []
+        for kind in KINDS:
+            counts = self.counts[kind]
+            mean_wait = counts["wait_total"] / counts["sent"] if counts["sent"] else 0
+            parts.append(f"{kind} {len(self.queues[kind])} queued, {counts['sent']} sent, "
+                         f"{counts['airtime']:.1f}s airtime, waited {mean_wait:.2f}s avg {counts['wait_max']:.2f}s max, "
+                         f"throttled {counts['throttled']} times")
+        return "pacing: "+"; ".join(parts)+f"; budget {self.bucket.tokens:.1f}s of {self.bucket.capacity}s"
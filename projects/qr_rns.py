@@ -1,33 +1,57 @@
 # RNS QR code reader. Ultimate goal: read QR codes from image streams or webcams and drop them on the network
 
-from qreader import QReader
-import cv2
 import base64
 import asyncio
+import random
 import RNS
 import time
 import os
-import numpy as np
 from LXMF import LXMessage, LXMRouter
+from qr_decode import DecodePool
+from qr_delivery import DeliveryQueue
+from qr_dedupe import DedupeIndex
+from qr_pacing import OutboundPacer, airtime
+from qr_sources import source_from_spec
 
 
+# image sources to ingest, snapshot URLs or any other spec qr_sources.source_from_spec takes
 webcam_urls = ["https://cdns.abclocal.go.com/three/wls/webcam/StateSt_cap.jpg"]
 
-qreader = QReader()
-
 class TransparentDestination(RNS.Destination):
     # we're already encrypted so skip it
     def encrypt(self, plaintext):
          return plaintext
 
+class PathWaker:
+    # paths arrive with announces, wake whatever waits for the announced destination
+    aspect_filter = "lxmf.delivery"
+
+    def __init__(self, qr_router):
+        self.qr_router = qr_router
+
+    def received_announce(self, destination_hash, announced_identity, app_data):
+        # called on an RNS thread
+        loop = self.qr_router.loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self.qr_router.deliveries.wake, destination_hash)
+
 class QrRouter:
     
     help_text = "Hello, if you send a message with an attached image file. "\
         "I will search the image for QR codes of an LXMessage, and attempt to deliver it"
                                     
     
-    def __init__(self, display_name):
+    # seconds between saves of the dedupe index
+    dedupe_save_interval = 60
+    # bits/s assumed for a destination whose next hop interface is unknown, a slow LoRa link
+    fallback_bitrate = 1200
+
+    def __init__(self, display_name, decode_workers=None, dedupe_ttl=7*24*3600, dedupe_max_entries=100000,
+                 retry_delay=5, max_retry_delay=600, max_attempts=12, duty_cycle=0.1, airtime_burst=5):
         self.r = RNS.Reticulum()
+        # QR decoding runs in worker processes, the model is loaded once per worker
+        self.decoder = DecodePool(decode_workers)
+        self.loop = None
         self.router = LXMRouter(storagepath="./tmp2")
         self.router.register_delivery_callback(self.on_rns_recv)
         
@@ -51,22 +75,40 @@ class QrRouter:
         print("Reticulum Identity <{}> has been loaded from file {}.".format(identity.hash.hex(), default_identity_file))
         
         self.ident = identity
+        # hashes of messages already queued, kept across restarts
+        self.dedupe = DedupeIndex(dedupe_max_entries, dedupe_ttl, os.path.join(base_storage_dir, "dedupe_index"))
         self.source = self.router.register_delivery_identity(self.ident, display_name=display_name)
         self.router.announce(self.source.hash)
-        self._msg_queue = []
-        self._response_queue = []
+        # messages and replies waiting for a path, retried with backoff per destination
+        self.deliveries = DeliveryQueue(retry_delay, max_retry_delay, max_attempts)
+        # deliveries queued before the event loop runs
+        self._early_deliveries = []
+        # items with a path wait here for their share of airtime, duty_cycle of it at most
+        self.pacer = OutboundPacer(duty_cycle, airtime_burst)
+        RNS.Transport.register_announce_handler(PathWaker(self))
         
-    def process_img(self, buf, reply_hash=None):
-        image = cv2.imdecode(np.frombuffer(buf, dtype=np.uint8), cv2.IMREAD_COLOR)
-        if image is None:
-            return 0
+    async def process_img(self, buf, reply_hash=None):
+        # returns the number of messages queued and the number already sent before
+        try:
+            decoded_text = await self.decoder.decode(buf)
+        except Exception as e:
+            print("Error decoding image: "+str(e))
+            return 0, 0
+        return self.enqueue_texts(decoded_text, reply_hash)
+    
+    def enqueue_texts(self, decoded_text, reply_hash=None):
+        if not decoded_text:
+            return 0, 0
         
-        decoded_text = qreader.detect_and_decode(image=image)
         num_sent = 0
+        num_dupes = 0
         for uri in decoded_text:
-            num_sent+=1
-            self.validate_and_enqueue_msg(uri, reply_hash)
-        return num_sent
+            queued = self.validate_and_enqueue_msg(uri, reply_hash)
+            if queued:
+                num_sent+=1
+            elif queued is not None:
+                num_dupes+=1
+        return num_sent, num_dupes
                     
     def on_rns_recv(self, message):        
         # DO STUFF WITH MESSAGE HERE
@@ -74,83 +116,88 @@ class QrRouter:
         has_attachment = message.fields is not None and len(message.fields) > 0
         if has_attachment:
             files = [x[1] for x in message.fields.values() if len(x) > 0 and len(x[1]) > 5]
-            num_sent = 0
-            for f in files:
-                if type(f) == str:
-                    f = f.encode()
-                    
-            num_sent = self.process_img(f, reply_hash=reply_hash)
-                    
-            if num_sent == 0:
-                print("got attachment, but none were an image")
-                if len(files) > 0:
-                    self._response_queue.append((reply_hash, "No QR codes found in attached image."))
-                else:
-                    # weird bug where sideband send 3 null bytes as a fields attachment, but meshchat doesnt
-                    self._response_queue.append((reply_hash, self.help_text))
-                    
-            else:
-                self._response_queue.append((reply_hash, f"{num_sent} message(s) queued for delivery"))
+            files = [f.encode() if type(f) == str else f for f in files]
+            if self.loop is None:
+                self.respond(reply_hash, "Still starting up, please try again in a minute.")
+                return
+            # called on the LXMF thread, decoding happens on the event loop and the pool
+            asyncio.run_coroutine_threadsafe(self.process_attachments(files, reply_hash), self.loop)
                      
         else:
             print("msg from", reply_hash.hex())
             RNS.Transport.request_path(reply_hash)
-            self._response_queue.append((reply_hash, self.help_text))
+            self.respond(reply_hash, self.help_text)
+    
+    async def process_attachments(self, files, reply_hash):
+        # every attachment decodes in parallel
+        results = await asyncio.gather(*(self.process_img(f, reply_hash=reply_hash) for f in files))
+        num_sent = sum(sent for sent, _ in results)
+        num_dupes = sum(dupes for _, dupes in results)
+        if num_dupes > 0:
+            self.respond(reply_hash, f"{num_dupes} message(s) were already delivered, not sending again")
+        if num_sent == 0:
+            if num_dupes > 0:
+                return
+            print("got attachment, but none were an image")
+            if len(files) > 0:
+                self.respond(reply_hash, "No QR codes found in attached image.")
+            else:
+                # weird bug where sideband send 3 null bytes as a fields attachment, but meshchat doesnt
+                self.respond(reply_hash, self.help_text)
+                    
+        else:
+            self.respond(reply_hash, f"{num_sent} message(s) queued for delivery")
+
+    def respond(self, reply_hash, text):
+        # queue a reply, callable from any thread
+        self.deliver(reply_hash, ("reply", text, None, None))
+
+    def deliver(self, destination_hash, item):
+        # item is (kind, payload, ack hash, transient id), kind "packet" for an ingested LXM or "reply"
+        if self.loop is None:
+            self._early_deliveries.append((destination_hash, item))
+        else:
+            self.loop.call_soon_threadsafe(self.deliveries.put, destination_hash, item)
            
             
     def validate_and_enqueue_msg(self, uri, ack_hash=None):
+        # True if queued, False if the message was queued before, None if it's not an LXM
         if uri is None:
-            return
+            return None
         
         if not uri.lower().startswith(LXMessage.URI_SCHEMA+"://"):
                 RNS.log("Cannot ingest LXM, invalid URI provided.", RNS.LOG_ERROR)
-                return
+                return None
 
         lxmf_data = base64.urlsafe_b64decode(uri.replace(LXMessage.URI_SCHEMA+"://", "").replace("/", "")+"==")
-        #transient_id = RNS.Identity.full_hash(lxmf_data)
+        transient_id = RNS.Identity.full_hash(lxmf_data)
+        if not self.dedupe.check(transient_id):
+            RNS.log("Ignoring LXM "+RNS.prettyhexrep(transient_id)+", it was already queued", RNS.LOG_DEBUG)
+            return False
         destination_hash  = lxmf_data[:LXMessage.DESTINATION_LENGTH]
         data_data = lxmf_data[LXMessage.DESTINATION_LENGTH:]
-        self._msg_queue.append((destination_hash, data_data, ack_hash))
+        self.deliver(destination_hash, ("packet", data_data, ack_hash, transient_id))
+        return True
             
     async def run_delivery_loop(self):
+        self.loop = asyncio.get_running_loop()
+        for destination_hash, item in self._early_deliveries:
+            self.deliveries.put(destination_hash, item)
+        self._early_deliveries = []
+        self.pacer_task = asyncio.create_task(self.pacer.run(lambda entry: self.send_item(*entry)))
         last_announce = 0
+        last_dedupe_save = time.time()
         while True:
-            queue = self._msg_queue
-            self._msg_queue = []
-        
-            for destination_hash, lxmf_data, ack_hash in queue:
+            for destination_hash, items, attempts in self.deliveries.pop_due():
                 dest_id = RNS.Identity.recall(destination_hash)
                 if dest_id is not None and RNS.Transport.has_path(destination_hash):
-                    dest = TransparentDestination(dest_id, RNS.Destination.OUT, RNS.Destination.SINGLE, "lxmf", "delivery")
-                    packet = RNS.Packet(dest, lxmf_data)
-                    status = packet.send()
-                    print("sent to...."+dest.hexhash)
-                    if ack_hash is not None:
-                        self._response_queue.append((ack_hash, "Message delivered!"))
-                    await asyncio.sleep(0.01) # small sleep so we don't ddos with big queue
+                    for item in items:
+                        self.pacer.put(item[0], (dest_id, item), self.item_airtime(destination_hash, item))
                 else:
-                    print("re-queing")
+                    # one path request per attempt, the announce that answers it wakes us up
                     RNS.Transport.request_path(destination_hash)
-                    # requeue until we have a path
-                    self._msg_queue.append((destination_hash, lxmf_data, ack_hash))
-                  
-            # help queue for responding with help to messages
-            r_q = self._response_queue
-            self._response_queue = []
-            for reply_hash, text in r_q:
-                dest_id = RNS.Identity.recall(reply_hash)
-                if dest_id is not None and RNS.Transport.has_path(reply_hash):
-                    destination = RNS.Destination(dest_id, RNS.Destination.OUT, RNS.Destination.SINGLE, "lxmf", "delivery")
-                    lxm = LXMessage(destination, self.source,
-                                    text,
-                                    "QR Router Message",
-                                    desired_method=LXMessage.OPPORTUNISTIC)
-            
-                    self.router.handle_outbound(lxm)
-                    print(" -> " + str(text))
-                else:
-                    RNS.Transport.request_path(reply_hash)
-                    self._response_queue.append((reply_hash, text))
+                    for item in self.deliveries.retry(destination_hash, items, attempts):
+                        self.expire_item(destination_hash, item)
                     
             # announce when it's time
             now = time.time()
@@ -158,35 +205,126 @@ class QrRouter:
                 print("announcing again!")
                 self.router.announce(self.source.hash)
                 last_announce = now
+
+            if now - last_dedupe_save > self.dedupe_save_interval:
+                # on the loop, check() runs here too; the file is 40 bytes per hash
+                self.dedupe.save()
+                last_dedupe_save = now
                 
-            await asyncio.sleep(2.5)
+            # until the next delivery is due, a path shows up, or it's time for the above
+            await self.deliveries.wait(self.dedupe_save_interval)
+
+    def item_airtime(self, destination_hash, item):
+        # seconds item takes to send over the interface towards destination_hash
+        kind, payload, _, _ = item
+        bitrate = RNS.Transport.next_hop_interface_bitrate(destination_hash) or self.fallback_bitrate
+        if kind == "packet":
+            size = len(payload)
+        else:
+            size = len(payload.encode("utf-8")) + LXMessage.LXMF_OVERHEAD
+        return airtime(size, bitrate)
+
+    async def send_item(self, dest_id, item):
+        kind, payload, ack_hash, _ = item
+        if kind == "packet":
+            dest = TransparentDestination(dest_id, RNS.Destination.OUT, RNS.Destination.SINGLE, "lxmf", "delivery")
+            packet = RNS.Packet(dest, payload)
+            status = packet.send()
+            print("sent to...."+dest.hexhash)
+            if ack_hash is not None:
+                self.respond(ack_hash, "Message delivered!")
+        else:
+            destination = RNS.Destination(dest_id, RNS.Destination.OUT, RNS.Destination.SINGLE, "lxmf", "delivery")
+            lxm = LXMessage(destination, self.source,
+                            payload,
+                            "QR Router Message",
+                            desired_method=LXMessage.OPPORTUNISTIC)
+            self.router.handle_outbound(lxm)
+            print(" -> " + str(payload))
+
+    def expire_item(self, destination_hash, item):
+        kind, payload, ack_hash, transient_id = item
+        print("giving up on "+kind+" to "+RNS.prettyhexrep(destination_hash)+", no path")
+        if kind == "packet":
+            # if the code turns up again it gets another chance
+            self.dedupe.forget(transient_id)
+            if ack_hash is not None:
+                self.respond(ack_hash, "Could not deliver message to "+RNS.prettyhexrep(destination_hash)+", no path found")
                     
 import aiohttp
 class QrIngest:
     
-    def __init__(self, qr_router: QrRouter):
+    def __init__(self, qr_router: QrRouter, sources=None, queue_size=16, stats_interval=600):
         self.qr_router = qr_router
+        self.sources = sources if sources is not None else [source_from_spec(spec) for spec in webcam_urls]
+        self.queue_size = queue_size
+        self.stats_interval = stats_interval
+        self.tasks = []
         
     async def run_ingest_loop(self):
         await asyncio.sleep(2) # warmup time
+        # every source feeds this, frames that don't fit are dropped rather than going stale in it
+        frames = asyncio.Queue(self.queue_size)
+        # one session for every source, connections are kept alive between polls
+        async with aiohttp.ClientSession() as sess:
+            self.tasks = [asyncio.create_task(self.run_source(sess, source, frames)) for source in self.sources]
+            self.tasks += [asyncio.create_task(self.run_decoder(frames))
+                           for _ in range(self.qr_router.decoder.max_pending)]
+            while True:
+                await asyncio.sleep(self.stats_interval)
+                for source in self.sources:
+                    print("ingest stats: "+source.stats())
+                print(self.qr_router.decoder.stats.summary())
+                print(self.qr_router.dedupe.stats())
+                print(self.qr_router.deliveries.stats())
+                print(self.qr_router.pacer.stats())
+    
+    async def run_source(self, sess, source, frames):
+        # start somewhere in the first interval so the sources don't all fire at once
+        await asyncio.sleep(random.uniform(0, source.interval))
         while True:
-            async with aiohttp.ClientSession() as sess:
-                for url in webcam_urls:
-                    cache_bust_url = url+"?cache_bust="+str(time.time())
-                    async with sess.get(cache_bust_url) as response:
-                        if response.ok:
-                            data = await response.read()
-                            num_sent = self.qr_router.process_img(data)
-                            if num_sent > 0:
-                                print("!!!Found QR code in: "+cache_bust_url)
-                            
-                        else:
-                            print("Bad status from "+ str(cache_bust_url))
-                            print(response.status)
-           
-                
-            # grab new images to process from webcams or other streams
-            await asyncio.sleep(60)
+            try:
+                async for data in source.frames(sess):
+                    source.counts["frames"] += 1
+                    if not source.live:
+                        # files don't come back, wait for the decoder instead of dropping
+                        await source.idle.wait()
+                        source.decoding(True)
+                        await frames.put((source, data))
+                        continue
+                    if source.in_flight:
+                        source.frame_dropped()
+                        continue
+                    try:
+                        frames.put_nowait((source, data))
+                        source.decoding(True)
+                    except asyncio.QueueFull:
+                        source.frame_dropped()
+                return
+            except Exception as e:
+                source.error(e)
+            # the source crashed, start it over
+            await asyncio.sleep(source.jittered(source.interval))
+    
+    async def run_decoder(self, frames):
+        while True:
+            source, data = await frames.get()
+            try:
+                # attachments may hold some of the pool's slots, frames don't wait for them
+                result = await self.qr_router.decoder.decode_frame(data, source.thumbnail, wait=not source.live)
+                if result is False:
+                    source.frame_dropped()
+                    continue
+                texts, thumbnail = result
+                if thumbnail is not None:
+                    source.thumbnail = thumbnail
+                source.frame_result(texts is not None)
+                if self.qr_router.enqueue_texts(texts)[0] > 0:
+                    print("!!!Found QR code in: "+source.name)
+            except Exception as e:
+                source.error(e)
+            finally:
+                source.decoding(False)
                      
 
 if __name__ == "__main__":
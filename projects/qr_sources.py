@@ -0,0 +1,316 @@
+# Image sources for QrIngest. A source is an async generator of encoded images (JPEG/PNG bytes)
+# that keeps its own schedule, timeouts and reconnects, so one slow or hanging camera only ever
+# holds up itself. Sources are made from spec strings:
+#
+#   https://host/cam.jpg          snapshot URL, polled (HttpSnapshotSource)
+#   mjpeg:https://host/stream     MJPEG stream, sampled (MjpegStreamSource)
+#   dir:/path/to/images           new or modified image files in a directory (DirectoryWatchSource)
+#   video:/path/to/file.mp4       frames of a local video, for testing (VideoFileSource)
+
+import asyncio
+import hashlib
+import os
+import random
+import time
+
+import aiohttp
+import cv2
+
+
+class ImageSource:
+    """
+    Base class. frames(sess) yields encoded images until the source gives up, the ingest loop
+    restarts it after interval. frame_result() hears back whether a frame was worth decoding,
+    frame_dropped() that a frame was never decoded.
+
+    A live source (a camera) can be behind on decoding by dropping frames, the next one it
+    delivers is as good, or it delivers the dropped one again. A source that isn't live
+    (files) holds its frame until the decoder takes it.
+    """
+
+    live = True
+
+    def __init__(self, name, interval):
+        self.name = name
+        self.interval = interval
+        # thumbnail of the last frame, for the decoder's change detection
+        self.thumbnail = None
+        # a frame of this source is queued or being decoded, the next one waits for it to finish
+        # (or is dropped) so frames are compared against the thumbnail in order
+        self.in_flight = False
+        self._idle = None
+        self.counts = dict.fromkeys(("frames", "dropped", "unchanged", "decoded", "errors"), 0)
+
+    def frames(self, sess):
+        """Async generator of encoded images, sess is the ingest loop's aiohttp session"""
+        raise NotImplementedError
+
+    def frame_result(self, changed):
+        self.counts["decoded" if changed else "unchanged"] += 1
+
+    @property
+    def idle(self):
+        # set while no frame is in flight, created on first use so it belongs to the running loop
+        if self._idle is None:
+            self._idle = asyncio.Event()
+            self._idle.set()
+        return self._idle
+
+    def decoding(self, in_flight):
+        self.in_flight = in_flight
+        if in_flight:
+            self.idle.clear()
+        else:
+            self.idle.set()
+
+    def frame_dropped(self):
+        # a live source that dropped a frame must be able to deliver it, or a newer one, again
+        self.counts["dropped"] += 1
+
+    def error(self, e):
+        self.counts["errors"] += 1
+        print("Error from "+self.name+": "+(str(e) or type(e).__name__))
+
+    @staticmethod
+    def jittered(seconds):
+        # +-20%, so sources with the same interval drift apart instead of polling in lockstep
+        return seconds * random.uniform(0.8, 1.2)
+
+    def stats(self):
+        return self.name+" every "+str(round(self.interval, 1))+"s "+str(self.counts)
+
+
+class HttpSnapshotSource(ImageSource):
+    """
+    A snapshot URL, polled with conditional requests. Polls more often while the picture
+    changes and less while it doesn't.
+    """
+
+    def __init__(self, url, interval=60, min_interval=15, max_interval=300, timeout=30):
+        super().__init__(url, interval)
+        self.url = url
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+        # validators for conditional requests
+        self.etag = None
+        self.last_modified = None
+        # digest of the last frame's bytes
+        self.digest = None
+        self.counts.update(not_modified=0, same_bytes=0)
+
+    async def frames(self, sess):
+        while True:
+            try:
+                data = await self.fetch(sess)
+                if data is not None:
+                    yield data
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.error(e)
+            await asyncio.sleep(self.jittered(self.interval))
+
+    async def fetch(self, sess):
+        # conditional GET, None if the frame is the same as last time
+        headers = {"Cache-Control": "no-cache"}
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+
+        async with sess.get(self.url, headers=headers, timeout=aiohttp.ClientTimeout(total=self.timeout)) as response:
+            if response.status == 304:
+                self.counts["not_modified"] += 1
+                self.back_off()
+                return None
+            if not response.ok:
+                print("Bad status from "+ str(self.url))
+                print(response.status)
+                return None
+            data = await response.read()
+            self.etag = response.headers.get("ETag")
+            self.last_modified = response.headers.get("Last-Modified")
+
+        # servers without validators often still serve the very same bytes
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        if digest == self.digest:
+            self.counts["same_bytes"] += 1
+            self.back_off()
+            return None
+        self.digest = digest
+        return data
+
+    def frame_result(self, changed):
+        super().frame_result(changed)
+        if changed:
+            self.interval = max(self.min_interval, self.interval / 2)
+        else:
+            self.back_off()
+
+    def frame_dropped(self):
+        super().frame_dropped()
+        # the frame was never looked at, the next poll has to fetch it again instead of hearing
+        # it's unchanged
+        self.etag = None
+        self.last_modified = None
+        self.digest = None
+
+    def back_off(self):
+        self.interval = min(self.max_interval, self.interval * 1.5)
+
+
+class MjpegStreamSource(ImageSource):
+    """
+    An MJPEG (multipart/x-mixed-replace) stream, one frame every interval seconds is passed on
+    and the rest are skipped. Reconnects with exponential backoff.
+    """
+
+    # a frame larger than this means we lost sync with the stream
+    MAX_FRAME = 8 * 1024 * 1024
+
+    def __init__(self, url, interval=2, timeout=30):
+        super().__init__("mjpeg:"+url, interval)
+        self.url = url
+        self.timeout = timeout
+
+    async def frames(self, sess):
+        backoff = 1
+        while True:
+            try:
+                timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.timeout, sock_read=self.timeout)
+                async with sess.get(self.url, timeout=timeout) as response:
+                    if not response.ok:
+                        raise aiohttp.ClientError("bad status "+str(response.status))
+                    backoff = 1
+                    async for frame in self.split_frames(response.content):
+                        yield frame
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.error(e)
+            await asyncio.sleep(self.jittered(backoff))
+            backoff = min(60, backoff * 2)
+
+    async def split_frames(self, content):
+        # the frames are the JPEGs between SOI and EOI markers, multipart headers in between are
+        # skipped without parsing them
+        buf = bytearray()
+        last = 0
+        async for chunk in content.iter_chunked(64 * 1024):
+            buf += chunk
+            while True:
+                start = buf.find(b"\xff\xd8")
+                if start < 0:
+                    # keep a trailing 0xff, it may be the first half of the next marker
+                    del buf[:-1]
+                    break
+                end = buf.find(b"\xff\xd9", start + 2)
+                if end < 0:
+                    del buf[:start]
+                    if len(buf) > self.MAX_FRAME:
+                        buf.clear()
+                    break
+                frame = bytes(buf[start:end + 2])
+                del buf[:end + 2]
+                now = time.monotonic()
+                if now - last >= self.interval:
+                    last = now
+                    yield frame
+
+
+class DirectoryWatchSource(ImageSource):
+    """Image files that appear in, or change in, a local directory"""
+
+    live = False
+    EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+    def __init__(self, path, interval=5):
+        super().__init__("dir:"+path, interval)
+        self.path = path
+        self.seen = {}
+        # the file of the frame yielded last
+        self.last_path = None
+
+    def scan(self):
+        found = {}
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.lower().endswith(self.EXTENSIONS):
+                    found[entry.path] = entry.stat().st_mtime
+        return found
+
+    @staticmethod
+    def read(path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    async def frames(self, sess):
+        while True:
+            try:
+                found = await asyncio.to_thread(self.scan)
+                for path, mtime in sorted(found.items(), key=lambda item: item[1]):
+                    if self.seen.get(path) != mtime:
+                        self.seen[path] = mtime
+                        self.last_path = path
+                        yield await asyncio.to_thread(self.read, path)
+                # forget files that went away
+                self.seen = {path: mtime for path, mtime in self.seen.items() if path in found}
+            except OSError as e:
+                self.error(e)
+            await asyncio.sleep(self.jittered(self.interval))
+
+    def frame_dropped(self):
+        super().frame_dropped()
+        # picked up again on the next scan
+        self.seen.pop(self.last_path, None)
+
+
+class VideoFileSource(ImageSource):
+    """Frames of a local video file, one per interval seconds of video, played back in real time"""
+
+    live = False
+
+    def __init__(self, path, interval=1, loop=True):
+        super().__init__("video:"+path, interval)
+        self.path = path
+        self.loop = loop
+
+    def read_frames(self, capture, count):
+        # skip count - 1 frames and encode the next one, None at the end of the file
+        for _ in range(count - 1):
+            if not capture.grab():
+                return None
+        ok, image = capture.read()
+        if not ok:
+            return None
+        ok, encoded = cv2.imencode(".jpg", image)
+        return encoded.tobytes() if ok else None
+
+    async def frames(self, sess):
+        while True:
+            capture = await asyncio.to_thread(cv2.VideoCapture, self.path)
+            try:
+                if not capture.isOpened():
+                    self.error("could not open "+self.path)
+                    return
+                fps = capture.get(cv2.CAP_PROP_FPS) or 25
+                step = max(1, round(fps * self.interval))
+                while True:
+                    frame = await asyncio.to_thread(self.read_frames, capture, step)
+                    if frame is None:
+                        break
+                    yield frame
+                    await asyncio.sleep(self.interval)
+            finally:
+                capture.release()
+            if not self.loop:
+                return
+
+
+def source_from_spec(spec):
+    """An ImageSource for a spec string, see the top of this file"""
+    kind, _, rest = spec.partition(":")
+    if kind == "mjpeg":
+        return MjpegStreamSource(rest)
+    if kind == "dir":
+        return DirectoryWatchSource(rest)
+    if kind == "video":
+        return VideoFileSource(rest)
+    return HttpSnapshotSource(spec)
@@ -0,0 +1,499 @@
+#!/usr/bin/env python3
+"""
+RNS Bridge Benchmark - Measure rns_bridge_server.py/rns_bridge_client.py without radios
+
+Starts two standalone Reticulum instances (one per bridge) joined by a TCP interface
+over loopback. The interface traffic runs through a shaping proxy that can add
+bandwidth limits and latency to look like a slow mesh hop. Echo targets run in this
+process, and the bridges run as subprocesses so their CPU use can be measured on
+its own.
+
+Workloads, for both TCP and UDP mode:
+    echo   one message in flight at a time, reports RTT percentiles
+    bulk   one large transfer through an echo target, reports throughput
+    small  many small messages back to back, reports messages per second
+
+Example: python rns_bridge_bench.py --bandwidth 50000 --latency 200 --bulk-bytes 200000
+"""
+
+import RNS
+import argparse
+import json
+import os
+import psutil
+import queue
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVICE_NAME = "bench"
+
+# RNS TCP interfaces use HDLC framing, every packet on the wire is FLAG data FLAG
+HDLC_FLAG = 0x7E
+
+RNS_CONFIG = """
+[reticulum]
+  enable_transport = No
+  share_instance = No
+  panic_on_interface_error = No
+
+[logging]
+  loglevel = 2
+
+[interfaces]
+  [[Bench Link]]
+    type = {type}
+    enabled = yes
+{settings}
+"""
+
+
+class LinkShaper:
+    """
+    TCP proxy between the two Reticulum instances. Each direction is modelled as a
+    serial link: a chunk is sent once the previous one finished transmitting at
+    bandwidth bits/s, and arrives latency seconds later. Also counts HDLC frames so
+    we know how many RNS packets the bridges produced.
+    """
+
+    def __init__(self, listen_port: int, target_port: int, bandwidth: int, latency: float):
+        self.listen_port = listen_port
+        self.target_port = target_port
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.wire_bytes = 0
+            self.flags = 0
+
+    def counters(self) -> dict:
+        with self.lock:
+            return {"wire_bytes": self.wire_bytes, "packets": self.flags // 2}
+
+    def start(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", self.listen_port))
+        self.listener.listen(4)
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                downstream, _ = self.listener.accept()
+            except OSError:
+                return
+            upstream = socket.create_connection(("127.0.0.1", self.target_port))
+            for src, dst in ((downstream, upstream), (upstream, downstream)):
+                pipe = queue.Queue()
+                threading.Thread(target=self._reader, args=(src, pipe), daemon=True).start()
+                threading.Thread(target=self._writer, args=(dst, pipe), daemon=True).start()
+
+    def _reader(self, src: socket.socket, pipe: queue.Queue):
+        tx_done = 0.0
+        while True:
+            try:
+                data = src.recv(65536)
+            except OSError:
+                data = b""
+            if not data:
+                pipe.put((0, None))
+                return
+
+            now = time.time()
+            if self.bandwidth > 0:
+                tx_done = max(now, tx_done) + len(data) * 8 / self.bandwidth
+            else:
+                tx_done = now
+            with self.lock:
+                self.wire_bytes += len(data)
+                self.flags += data.count(HDLC_FLAG)
+            pipe.put((tx_done + self.latency, data))
+
+    def _writer(self, dst: socket.socket, pipe: queue.Queue):
+        while True:
+            deliver_at, data = pipe.get()
+            if data is None:
+                try:
+                    dst.shutdown(socket.SHUT_WR)
+                except OSError:
+                    pass
+                return
+            delay = deliver_at - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                dst.sendall(data)
+            except OSError:
+                return
+
+    def stop(self):
+        self.listener.close()
+
+
+class EchoTarget:
+    """TCP or UDP echo server for the server bridge to forward to"""
+
+    def __init__(self, protocol: str):
+        self.protocol = protocol
+        kind = socket.SOCK_STREAM if protocol == "tcp" else socket.SOCK_DGRAM
+        self.sock = socket.socket(socket.AF_INET, kind)
+        self.sock.bind(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+
+    def start(self):
+        if self.protocol == "tcp":
+            self.sock.listen(16)
+            threading.Thread(target=self._accept_loop, daemon=True).start()
+        else:
+            threading.Thread(target=self._udp_loop, daemon=True).start()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._echo, args=(conn,), daemon=True).start()
+
+    def _echo(self, conn: socket.socket):
+        with conn:
+            while True:
+                try:
+                    data = conn.recv(65536)
+                    if not data:
+                        return
+                    conn.sendall(data)
+                except OSError:
+                    return
+
+    def _udp_loop(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(65536)
+                self.sock.sendto(data, addr)
+            except OSError:
+                return
+
+    def stop(self):
+        self.sock.close()
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def wait_for_log(path: str, needle: str, proc: subprocess.Popen, timeout: float = 30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{path} process exited with {proc.returncode}")
+        if os.path.exists(path) and needle in open(path, errors="ignore").read():
+            return
+        time.sleep(0.2)
+    raise RuntimeError(f"Timed out waiting for '{needle}' in {path}")
+
+
+class BridgePair:
+    """A server bridge and client bridge, each with its own Reticulum instance, in one protocol mode"""
+
+    def __init__(self, protocol: str, shaper_args: dict, workdir: str, verbose: bool):
+        self.protocol = protocol
+        self.workdir = workdir
+        self.verbose = verbose
+        self.target = EchoTarget(protocol)
+        self.listen_port = free_port()
+
+        rns_port = free_port()
+        self.shaper = LinkShaper(free_port(), rns_port, **shaper_args)
+        self.server_dir = self._write_config("server", "TCPServerInterface",
+                                             f"    listen_ip = 127.0.0.1\n    listen_port = {rns_port}")
+        self.client_dir = self._write_config("client", "TCPClientInterface",
+                                             f"    target_host = 127.0.0.1\n    target_port = {self.shaper.listen_port}")
+
+        # make the identity up front so we know the destination hash to hand the client
+        self.identity_file = os.path.join(self.server_dir, "bridge_ident")
+        identity = RNS.Identity()
+        identity.to_file(self.identity_file)
+        self.destination_hash = RNS.Destination.hash(identity, "bridge", SERVICE_NAME)
+        self.processes: List[subprocess.Popen] = []
+
+    def _write_config(self, name: str, interface_type: str, settings: str) -> str:
+        path = os.path.join(self.workdir, f"{self.protocol}_{name}")
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, "config"), "w") as f:
+            f.write(RNS_CONFIG.format(type=interface_type, settings=settings))
+        return path
+
+    def _spawn(self, args: List[str], cwd: str) -> subprocess.Popen:
+        output = None if self.verbose else subprocess.DEVNULL
+        proc = subprocess.Popen([sys.executable] + args, cwd=cwd, stdout=output, stderr=output)
+        self.processes.append(proc)
+        return proc
+
+    def start(self):
+        self.target.start()
+        self.shaper.start()
+        server = self._spawn([os.path.join(HERE, "rns_bridge_server.py"), "127.0.0.1", str(self.target.port),
+                              self.protocol, "--service", SERVICE_NAME, "--identity", self.identity_file,
+                              "--rnsconfig", self.server_dir], cwd=self.server_dir)
+        wait_for_log(os.path.join(self.server_dir, "rns_server_bridge.log"), "Announce destination", server)
+
+        client = self._spawn([os.path.join(HERE, "rns_bridge_client.py"), str(self.listen_port),
+                              self.destination_hash.hex(), self.protocol, "--service", SERVICE_NAME,
+                              "--rnsconfig", self.client_dir], cwd=self.client_dir)
+        wait_for_log(os.path.join(self.client_dir, "rns_client_bridge.log"), "Listening for", client)
+
+    def cpu_seconds(self) -> float:
+        total = 0.0
+        for proc in self.processes:
+            try:
+                times = psutil.Process(proc.pid).cpu_times()
+                total += times.user + times.system
+            except psutil.Error:
+                pass
+        return total
+
+    def stop(self):
+        for proc in self.processes:
+            proc.terminate()
+        for proc in self.processes:
+            try:
+                proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        self.shaper.stop()
+        self.target.stop()
+
+
+class Workloads:
+    def __init__(self, pair: BridgePair, args):
+        self.pair = pair
+        self.args = args
+        self.addr = ("127.0.0.1", pair.listen_port)
+
+    def _tcp_connect(self) -> socket.socket:
+        sock = socket.create_connection(self.addr, timeout=self.args.io_timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    @staticmethod
+    def _recv_exact(sock: socket.socket, size: int) -> int:
+        got = 0
+        while got < size:
+            data = sock.recv(min(65536, size - got))
+            if not data:
+                raise RuntimeError(f"Connection closed after {got}/{size} bytes")
+            got += len(data)
+        return got
+
+    def warmup(self):
+        """Wait until a message makes it through both bridges (path discovery, link setup)"""
+        deadline = time.time() + self.args.warmup
+        while time.time() < deadline:
+            try:
+                if self.pair.protocol == "tcp":
+                    with self._tcp_connect() as sock:
+                        sock.sendall(b"ping")
+                        self._recv_exact(sock, 4)
+                else:
+                    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                        sock.settimeout(2)
+                        sock.sendto(b"ping", self.addr)
+                        sock.recvfrom(65536)
+                return
+            except (OSError, RuntimeError):
+                time.sleep(1)
+        raise RuntimeError("Bridges never passed a message, is RNS working?")
+
+    def echo(self) -> dict:
+        message = b"e" * self.args.message_size
+        rtts = []
+        lost = 0
+        if self.pair.protocol == "tcp":
+            with self._tcp_connect() as sock:
+                for _ in range(self.args.echo_count):
+                    start = time.time()
+                    sock.sendall(message)
+                    self._recv_exact(sock, len(message))
+                    rtts.append(time.time() - start)
+        else:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sock.settimeout(self.args.io_timeout)
+                for _ in range(self.args.echo_count):
+                    start = time.time()
+                    sock.sendto(message, self.addr)
+                    try:
+                        sock.recvfrom(65536)
+                        rtts.append(time.time() - start)
+                    except socket.timeout:
+                        lost += 1
+        payload = 2 * len(message) * len(rtts)
+        return {"messages": len(rtts), "lost": lost, "payload_bytes": payload, "rtts": rtts}
+
+    def bulk(self) -> dict:
+        if self.pair.protocol == "tcp":
+            return self._tcp_stream(self.args.bulk_bytes, 4096)
+        return self._udp_blast(self.args.bulk_bytes // self.args.datagram_size, self.args.datagram_size)
+
+    def small(self) -> dict:
+        size = self.args.message_size
+        if self.pair.protocol == "tcp":
+            return self._tcp_stream(self.args.small_count * size, size)
+        return self._udp_blast(self.args.small_count, size)
+
+    def _tcp_stream(self, total: int, chunk_size: int) -> dict:
+        chunk = b"b" * chunk_size
+        with self._tcp_connect() as sock:
+            def send_all():
+                sent = 0
+                while sent < total:
+                    size = min(chunk_size, total - sent)
+                    sock.sendall(chunk[:size])
+                    sent += size
+            sender = threading.Thread(target=send_all, daemon=True)
+            sender.start()
+            self._recv_exact(sock, total)
+            sender.join()
+        return {"messages": -(-total // chunk_size), "lost": 0, "payload_bytes": 2 * total}
+
+    def _udp_blast(self, count: int, size: int) -> dict:
+        message = b"u" * size
+        received = 0
+        start = last_reply = time.time()
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(self.args.io_timeout)
+
+            def send_all():
+                for _ in range(count):
+                    sock.sendto(message, self.addr)
+            sender = threading.Thread(target=send_all, daemon=True)
+            sender.start()
+            try:
+                while received < count:
+                    sock.recvfrom(65536)
+                    received += 1
+                    last_reply = time.time()
+            except socket.timeout:
+                pass
+            sender.join()
+        # don't count the wait for stragglers that never came as transfer time
+        return {"messages": received, "lost": count - received, "payload_bytes": 2 * size * received,
+                "elapsed_s": max(last_reply - start, 1e-6)}
+
+    def run(self, name: str) -> dict:
+        self.pair.shaper.reset()
+        cpu_before = self.pair.cpu_seconds()
+        start = time.time()
+        result = getattr(self, name)()
+        elapsed = result.pop("elapsed_s", time.time() - start)
+        cpu = self.pair.cpu_seconds() - cpu_before
+        wire = self.pair.shaper.counters()
+
+        payload = result["payload_bytes"]
+        rtts = result.pop("rtts", [])
+        result.update({
+            "protocol": self.pair.protocol,
+            "workload": name,
+            "elapsed_s": elapsed,
+            "throughput_Bps": payload / 2 / elapsed,
+            "messages_per_s": result["messages"] / elapsed,
+            "rtt_p50_ms": None if not rtts else percentile(rtts, 50) * 1000,
+            "rtt_p90_ms": None if not rtts else percentile(rtts, 90) * 1000,
+            "rtt_p99_ms": None if not rtts else percentile(rtts, 99) * 1000,
+            "rns_packets": wire["packets"],
+            "wire_bytes": wire["wire_bytes"],
+            "packets_per_byte": wire["packets"] / payload if payload else None,
+            "wire_bytes_per_byte": wire["wire_bytes"] / payload if payload else None,
+            "cpu_s_per_MB": cpu / (payload / 1e6) if payload else None,
+        })
+        return result
+
+
+def format_value(value) -> str:
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return f"{value:.4g}"
+    return str(value)
+
+
+def print_report(results: List[Dict]):
+    columns = ["protocol", "workload", "messages", "lost", "throughput_Bps", "messages_per_s",
+               "rtt_p50_ms", "rtt_p90_ms", "rtt_p99_ms", "packets_per_byte", "wire_bytes_per_byte", "cpu_s_per_MB"]
+    rows = [[format_value(r.get(c)) for c in columns] for r in results]
+    widths = [max(len(c), *(len(row[i]) for row in rows)) for i, c in enumerate(columns)]
+    print("  ".join(c.ljust(w) for c, w in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(v.ljust(w) for v, w in zip(row, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='RNS Bridge Benchmark')
+    parser.add_argument('--protocols', default='tcp,udp', help='Bridge modes to run (default: tcp,udp)')
+    parser.add_argument('--workloads', default='echo,bulk,small', help='Workloads to run (default: echo,bulk,small)')
+    parser.add_argument('--bandwidth', type=int, default=0,
+                       help='Simulated link bandwidth in bits/s, 0 for unlimited (default: 0)')
+    parser.add_argument('--latency', type=float, default=0,
+                       help='Simulated one-way link latency in ms (default: 0)')
+    parser.add_argument('--echo-count', type=int, default=100, help='Round trips for echo (default: 100)')
+    parser.add_argument('--bulk-bytes', type=int, default=1_000_000, help='Bytes for bulk (default: 1000000)')
+    parser.add_argument('--small-count', type=int, default=1000, help='Messages for small (default: 1000)')
+    parser.add_argument('--message-size', type=int, default=32, help='Echo/small message size (default: 32)')
+    parser.add_argument('--datagram-size', type=int, default=256, help='UDP bulk datagram size (default: 256)')
+    parser.add_argument('--io-timeout', type=float, default=10, help='Socket timeout in seconds (default: 10)')
+    parser.add_argument('--warmup', type=float, default=60, help='Seconds to wait for the first message (default: 60)')
+    parser.add_argument('--json', default=None, help='Also write the results to this file as JSON')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary RNS configs and bridge logs')
+    parser.add_argument('--verbose', '-v', action='store_true', help='Show bridge output')
+    args = parser.parse_args()
+
+    shaper_args = {"bandwidth": args.bandwidth, "latency": args.latency / 1000}
+    workdir = tempfile.mkdtemp(prefix="rns_bridge_bench_")
+    results = []
+    try:
+        for protocol in args.protocols.split(","):
+            pair = BridgePair(protocol, shaper_args, workdir, args.verbose)
+            try:
+                print(f"Starting {protocol} bridges...")
+                pair.start()
+                workloads = Workloads(pair, args)
+                workloads.warmup()
+                for name in args.workloads.split(","):
+                    print(f"Running {protocol} {name}...")
+                    results.append(workloads.run(name))
+            finally:
+                pair.stop()
+    finally:
+        if args.keep:
+            print(f"Configs and logs kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print()
+    print_report(results)
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump({"bandwidth": args.bandwidth, "latency_ms": args.latency, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
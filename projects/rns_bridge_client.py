@@ -9,23 +9,82 @@ import threading
 import time
 import argparse
 import logging
+import os
 import sys
-from typing import Dict, Optional, Tuple
+from typing import Callable, Dict, Optional, Tuple
+from rns_bridge_common import (ConnectionState, ConnectionTable, FRAME_ACK, FRAME_DATA, FRAME_PAUSE, FRAME_RESUME,
+                               FRAME_SESSION, IOEngine, IdleTracker, MAX_UDP_SESSIONS, OutboundQueue, SESSION_ACCEPTED,
+                               SESSION_NEW, SESSION_RESUME, SESSION_RESUMED, STREAM_FRAME_HEADER, StreamSession,
+                               UDP_SESSION_HEADER, link_payload_size, pack_ack_frame, pack_session_frame,
+                               pack_stream_frame, pack_stream_frame_into, pack_udp_frame_into, unpack_ack_frame,
+                               unpack_session_frame, unpack_stream_frame, unpack_udp_frame)
+from rns_bridge_logging import setup_logging, tracer
+from rns_bridge_metrics import (MetricsRegistry, MetricsServer, connection_collector, describe_bridge_metrics,
+                                print_stats, record_closed)
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler('rns_client_bridge.log')
-    ]
-)
 logger = logging.getLogger(__name__)
 
+# Seconds to wait for the server to answer a session request, a new link may wait for
+# admission first
+SESSION_REPLY_TIMEOUT = 30
+
+class UdpSessionTable:
+    """
+    Maps local UDP client addresses to the session ids used on the shared RNS link.
+    Lookups are O(1) in both directions and idle sessions are expired by a timer wheel.
+    """
+    
+    def __init__(self, timeout: float):
+        self.addr_to_session: Dict[Tuple[str, int], int] = {}
+        self.session_to_addr: Dict[int, Tuple[str, int]] = {}
+        self.idle = IdleTracker(timeout)
+        self.next_session_id = 0
+        self.lock = threading.Lock()
+    
+    def session_for(self, client_addr: Tuple[str, int]) -> Optional[int]:
+        """Return the session id for a client address, allocating one if needed"""
+        session_id = self.addr_to_session.get(client_addr)
+        if session_id is None:
+            with self.lock:
+                if len(self.session_to_addr) >= MAX_UDP_SESSIONS:
+                    return None
+                # skip ids still held by live sessions after the counter wrapped around
+                while self.next_session_id in self.session_to_addr:
+                    self.next_session_id = (self.next_session_id + 1) % MAX_UDP_SESSIONS
+                session_id = self.next_session_id
+                self.next_session_id = (self.next_session_id + 1) % MAX_UDP_SESSIONS
+                self.session_to_addr[session_id] = client_addr
+                self.addr_to_session[client_addr] = session_id
+        self.idle.touch(session_id)
+        return session_id
+    
+    def addr_for(self, session_id: int) -> Optional[Tuple[str, int]]:
+        """Return the client address for a session id, or None if it expired"""
+        client_addr = self.session_to_addr.get(session_id)
+        if client_addr is not None:
+            self.idle.touch(session_id)
+        return client_addr
+    
+    def expire(self) -> list:
+        """Drop idle sessions, returns the client addresses that were expired"""
+        expired = []
+        for session_id in self.idle.expire():
+            with self.lock:
+                client_addr = self.session_to_addr.pop(session_id, None)
+                if client_addr is not None:
+                    self.addr_to_session.pop(client_addr, None)
+                    expired.append(client_addr)
+        return expired
+    
+    def __len__(self):
+        return len(self.session_to_addr)
+
 class ClientBridge:
     def __init__(self, listen_port: int, rns_destination: str, protocol: str, 
-                 timeout: int = 900, listen_host: str = "127.0.0.1"):
+                 timeout: int = 900, listen_host: str = "127.0.0.1",
+                 udp_session_timeout: int = 120, service_name: str = "bridge_service",
+                 rns_config_dir: Optional[str] = None, metrics_port: int = 0,
+                 identity_file: Optional[str] = None, resume_timeout: int = 0):
         """
         Initialize the RNS Client Bridge
         
@@ -35,23 +94,49 @@ class ClientBridge:
             protocol: 'tcp' or 'udp'
             timeout: Connection timeout in seconds (default: 15 minutes)
             listen_host: Local host to bind to
+            udp_session_timeout: Idle seconds before a UDP client's session is forgotten
+            service_name: RNS service name of the target on the server bridge
+            rns_config_dir: Reticulum config directory (default: ~/.reticulum)
+            metrics_port: Localhost port for the metrics control socket (0 to disable)
+            identity_file: Identity to identify with on the server bridge (default: a new one every run)
+            resume_timeout: TCP only, seconds to keep trying to resume a stream on a new link after its
+                            link drops (0 to disable), the server needs --session-timeout
         """
         self.listen_host = listen_host
         self.listen_port = listen_port
         self.rns_destination_hash = bytes.fromhex(rns_destination)
         self.protocol = protocol.lower()
         self.timeout = timeout
+        self.udp_session_timeout = udp_session_timeout
+        self.service_name = service_name
+        self.resume_timeout = resume_timeout if self.protocol == 'tcp' else 0
+        # Session requests waiting for the server's answer: token -> [event, kind, offset, on_reply]
+        self.session_replies: Dict[bytes, list] = {}
+        
+        # Track active connections: local_socket -> state holding the RNS.Link
+        self.connections = ConnectionTable(timeout)
         
-        # Track active connections: local_socket -> (RNS.Link, last_activity)
-        self.connections: Dict[socket.socket, Tuple[RNS.Link, float]] = {}
-        self.connection_lock = threading.Lock()
+        self.metrics = MetricsRegistry("rns_client_bridge")
+        describe_bridge_metrics(self.metrics)
+        self.metrics.describe("udp_sessions", "gauge", "Local UDP clients with a live session")
+        self.udp_sessions: Optional[UdpSessionTable] = None
+        self.metrics.add_collector(connection_collector(self.service_name, self.connections))
+        self.metrics.add_collector(
+            lambda: [("udp_sessions", {"service": self.service_name}, len(self.udp_sessions or ()))])
+        self.metrics_server = MetricsServer(self.metrics, metrics_port) if metrics_port > 0 else None
+        if self.metrics_server is not None:
+            self.metrics_server.start()
         
         # Initialize RNS
-        RNS.Reticulum()
+        RNS.Reticulum(configdir=rns_config_dir)
         
-        # Create ephemeral identity
-        self.identity = RNS.Identity()
-        logger.info(f"Created identity: {RNS.prettyhexrep(self.identity.hash)}")
+        # Writes to local clients are queued and drained here, off the RNS transport thread
+        self.engine = IOEngine()
+        self.engine.start()
+        self.metrics.add_collector(lambda: [("receive_buffers", {}, len(self.engine.buffers))])
+        
+        # Links identify with this, so the server can apply its per-identity limits
+        self.identity = self._load_or_create_identity(identity_file)
         
         # Create server socket
         if self.protocol == 'tcp':
@@ -64,7 +149,7 @@ class ClientBridge:
         self.server_socket.bind((self.listen_host, self.listen_port))
         
         # Start cleanup thread
-        self.cleanup_thread = threading.Thread(target=self._cleanup_connections, daemon=True)
+        self.cleanup_thread = threading.Thread(target=self._expire_connections, daemon=True)
         self.cleanup_thread.start()
         
         logger.info(f"Client bridge initialized")
@@ -72,6 +157,25 @@ class ClientBridge:
         logger.info(f"RNS Target: {RNS.prettyhexrep(self.rns_destination_hash)}")
         logger.info(f"Timeout: {timeout} seconds")
 
+    def _load_or_create_identity(self, identity_file: Optional[str]) -> RNS.Identity:
+        """Load the identity file, creating it if needed, or create an ephemeral identity"""
+        if identity_file and os.path.isfile(identity_file):
+            identity = RNS.Identity.from_file(identity_file)
+            if identity is not None:
+                logger.info(f"Loaded identity {RNS.prettyhexrep(identity.hash)} from {identity_file}")
+                return identity
+            logger.warning(f"Could not load identity from {identity_file}, creating a new one")
+        
+        identity = RNS.Identity()
+        if identity_file:
+            try:
+                identity.to_file(identity_file)
+                logger.info(f"Saved new identity to {identity_file}")
+            except Exception as e:
+                logger.error(f"Failed to save identity to {identity_file}: {e}")
+        logger.info(f"Created identity: {RNS.prettyhexrep(identity.hash)}")
+        return identity
+
     def _establish_rns_link(self, callback) -> Optional[RNS.Link]:
         """Establish a link to the RNS destination"""
         try:
@@ -93,7 +197,7 @@ class ClientBridge:
                 RNS.Destination.OUT,
                 RNS.Destination.SINGLE,
                 "bridge",
-                "bridge_service"
+                self.service_name
             )
             
             # Establish link
@@ -106,57 +210,87 @@ class ClientBridge:
                 time.sleep(0.1)
             
             if link.status == RNS.Link.ACTIVE:
+                # identify before sending any data, the server admits the link on it
+                link.identify(self.identity)
                 logger.info(f"Established RNS link to {RNS.prettyhexrep(self.rns_destination_hash)}")
+                self.metrics.inc("links_total", service=self.service_name)
+                self.metrics.observe("link_establishment_seconds", time.time() - start_time, service=self.service_name)
                 return link
             else:
                 logger.error("Failed to establish RNS link")
+                self.metrics.inc("links_failed", service=self.service_name)
                 return None
                 
         except Exception as e:
             logger.error(f"Error establishing RNS link: {e}")
+            self.metrics.inc("links_failed", service=self.service_name)
             return None
 
     def _handle_tcp_client(self, client_socket: socket.socket, client_addr: Tuple[str, int]):
         """Handle TCP client connection"""
         logger.info(f"New TCP client connected: {client_addr}")
         
+        # Handle client data
+        client_socket.settimeout(10.0)
+        
+        # The state exists before the link does: the server may start talking (e.g. an SSH
+        # banner) as soon as the link is up, and that data goes into the outbound queue
+        state = ConnectionState(None, client_socket)
+        state.outbound = OutboundQueue(
+            client_socket, self.engine,
+            on_pause=lambda: self._send_control(state, FRAME_PAUSE),
+            on_resume=lambda: self._send_control(state, FRAME_RESUME)
+        )
+        buf = None
+        
         try:
-            with self.connection_lock:
-                # Establish RNS link
-                rns_link = self._establish_rns_link(lambda data, packet, sock=client_socket: self._rns_data_received(data, packet, sock))
-                if not rns_link:
-                    logger.error(f"Failed to establish RNS link for client {client_addr}")
-                    client_socket.close()
-                    return
-                
-                # Store connection
+            # Establish RNS link, other clients carry on while this one waits for it
+            rns_link = self._establish_rns_link(lambda data, packet: self._rns_data_received(data, packet, state))
+            if not rns_link:
+                logger.error(f"Failed to establish RNS link for client {client_addr}")
+                state.outbound.close()
+                client_socket.close()
+                return
             
-                self.connections[client_socket] = (rns_link, time.time())
-                
-                # Set packet callback for RNS link
-                # rns_link.set_packet_callback(
-                #     lambda data, packet, sock=client_socket: self._rns_data_received(data, packet, sock)
-                # )
-                
-                # Handle client data
-                client_socket.settimeout(10.0)
+            # Store connection
+            state.link = rns_link
+            self.connections.add(client_socket, state)
+            if self.resume_timeout > 0 and not self._start_session(state):
+                return
+            buf = self.engine.buffers.acquire()
+            payload = memoryview(buf)[STREAM_FRAME_HEADER:]
+            payload_size = min(link_payload_size(rns_link), len(payload))
             
-            while rns_link.status == RNS.Link.ACTIVE:
+            while True:
                 try:
-                    data = client_socket.recv(4096)
-                    if not data:
+                    if state.link.status != RNS.Link.ACTIVE and not self._resume(state):
+                        break
+                    
+                    # the server asked us to hold off (or is a window behind on acknowledging),
+                    # leave the data in the client's socket
+                    if not state.peer_resumed.wait(1.0):
+                        continue
+                    # read once, closing the stream clears it from another thread
+                    session = state.session
+                    if session is not None and not session.window_open.wait(1.0):
+                        continue
+                    
+                    length = client_socket.recv_into(payload, payload_size)
+                    if not length:
                         break
                     
-                    # Send to RNS
-                    packet = RNS.Packet(rns_link, data)
+                    # Send to RNS, the packet keeps its data for resends so it gets a copy of the buffer
+                    frame = bytes(pack_stream_frame_into(buf, FRAME_DATA, length))
+                    if session is not None:
+                        # kept for a replay until the server acknowledges it
+                        session.sent_frame(frame)
+                    packet = RNS.Packet(state.link, frame)
                     packet.send()
                     
                     # Update last activity
-                    with self.connection_lock:
-                        if client_socket in self.connections:
-                            self.connections[client_socket] = (rns_link, time.time())
+                    state.sent(length)
                     
-                    logger.debug(f"Forwarded {len(data)} bytes from TCP client to RNS")
+                    tracer.trace("client->rns", state.link, payload[:length])
                     
                 except socket.timeout:
                     continue
@@ -167,44 +301,123 @@ class ClientBridge:
         except Exception as e:
             logger.error(f"Error in TCP client handler: {e}")
         finally:
+            if buf is not None:
+                self.engine.buffers.release(buf)
             self._cleanup_connection(client_socket)
 
+    def _session_request(self, link: RNS.Link, session: StreamSession, kind: int,
+                         on_reply: Callable[[int], None]) -> Optional[Tuple[int, int]]:
+        """
+        Send a session request on link, returns the server's (kind, offset) or None if it didn't
+        answer. on_reply(kind) runs on the RNS thread as the answer comes in, before the data
+        packets the server sends after it.
+        """
+        reply = self.session_replies[session.token] = [threading.Event(), None, 0, on_reply]
+        try:
+            RNS.Packet(link, pack_session_frame(session.token, kind, session.received)).send()
+            if not reply[0].wait(SESSION_REPLY_TIMEOUT):
+                return None
+            return reply[1], reply[2]
+        finally:
+            self.session_replies.pop(session.token, None)
+
+    def _start_session(self, state: ConnectionState) -> bool:
+        """Make the new link's stream resumable, False if the server doesn't do sessions"""
+        session = StreamSession()
+        def accepted(kind: int):
+            # the stream counts from here, the server keeps what it sends from here on
+            if kind == SESSION_ACCEPTED and self.connections.get(state.sock) is state:
+                state.session = session
+        reply = self._session_request(state.link, session, SESSION_NEW, accepted)
+        if reply is None or reply[0] != SESSION_ACCEPTED:
+            logger.error("Server bridge did not accept a session, is it running with --session-timeout?")
+            return False
+        return state.session is session
+
+    def _resume(self, state: ConnectionState) -> bool:
+        """Move the stream to a new link after its link went away, False if it can't be resumed"""
+        session = state.session
+        if session is None:
+            return False
+        logger.info(f"Link {state.link} went away, resuming its stream")
+        deadline = time.time() + self.resume_timeout
+        # the session goes away if the stream is closed (e.g. timed out) in the meantime
+        while state.session is session and time.time() < deadline:
+            link = self._establish_rns_link(lambda data, packet: self._rns_data_received(data, packet, state))
+            if link is None:
+                time.sleep(1)
+                continue
+            def resumed(kind: int, link=link):
+                # packets of the new link count from here on, and acks go out on it
+                if kind == SESSION_RESUMED and state.session is session:
+                    state.link = link
+            reply = self._session_request(link, session, SESSION_RESUME, resumed)
+            if reply is None:
+                link.teardown()
+                continue
+            kind, offset = reply
+            frames = session.replay_from(offset) if kind == SESSION_RESUMED else None
+            if frames is None:
+                logger.error("Server bridge could not resume the stream")
+                link.teardown()
+                break
+            if state.session is not session:
+                link.teardown()
+                return False
+            
+            for frame in frames:
+                RNS.Packet(link, frame).send()
+                state.sent(len(frame) - STREAM_FRAME_HEADER)
+            # a RESUME sent while the old link was dying may never have arrived
+            if not state.outbound.paused:
+                self._send_control(state, FRAME_RESUME)
+            self.metrics.inc("sessions_resumed", service=self.service_name)
+            logger.info(f"Resumed stream on {link}, replayed {len(frames)} packets")
+            return True
+        
+        if state.session is session:
+            self.metrics.inc("sessions_lost", service=self.service_name)
+        return False
+
     def _handle_udp_traffic(self):
         """Handle UDP traffic"""
         logger.info("Starting UDP traffic handler")
         
-        # For UDP, we maintain one RNS link for all traffic
+        # For UDP, we maintain one RNS link for all traffic and tell the clients apart by session id
         rns_link = None
-        client_addresses = {}  # Track client addresses
+        sessions = UdpSessionTable(self.udp_session_timeout)
+        self.udp_sessions = sessions
+        # datagrams are read behind room for the session id, this thread keeps its buffer
+        buf = self.engine.buffers.acquire()
+        datagram = memoryview(buf)[UDP_SESSION_HEADER.size:]
         
         try:
             self.server_socket.settimeout(1.0)
             
             while True:
                 try:
-                    data, client_addr = self.server_socket.recvfrom(4096)
-                    logger.debug(f"Received UDP data from {client_addr}")
+                    for client_addr in sessions.expire():
+                        logger.debug("UDP session for %s expired", client_addr)
+                    
+                    length, client_addr = self.server_socket.recvfrom_into(datagram, 4096)
                     
                     # Establish RNS link if needed
                     if not rns_link or rns_link.status != RNS.Link.ACTIVE:
-                        rns_link = self._establish_rns_link(lambda data: self._rns_udp_data_received(data, client_addresses))
+                        rns_link = self._establish_rns_link(lambda data, packet: self._rns_udp_data_received(data, sessions))
                         if not rns_link:
                             logger.error("Failed to establish RNS link for UDP traffic")
                             continue
-                        
-                        # Set packet callback
-                        # rns_link.set_packet_callback(
-                        #     lambda data: self._rns_udp_data_received(data, client_addresses)
-                        # )
                     
-                    # Track client address
-                    client_addresses[time.time()] = client_addr
+                    session_id = sessions.session_for(client_addr)
+                    if session_id is None:
+                        logger.warning(f"Too many UDP sessions, dropping datagram from {client_addr}")
+                        continue
                     
-                    # Send to RNS
-                    packet = RNS.Packet(rns_link, data)
+                    # Send to RNS, with a copy of the frame the packet can keep
+                    packet = RNS.Packet(rns_link, bytes(pack_udp_frame_into(buf, session_id, length)))
                     packet.send()
                     
-                    logger.debug(f"Forwarded {len(data)} bytes from UDP client to RNS")
+                    tracer.trace("client->rns", rns_link, datagram[:length])
                     
                 except socket.timeout:
                     continue
@@ -215,75 +428,114 @@ class ClientBridge:
         except Exception as e:
             logger.error(f"Error in UDP traffic handler: {e}")
 
-    def _rns_data_received(self, data: bytes, packet, client_socket: socket.socket):
+    def _rns_data_received(self, data: bytes, packet, state: ConnectionState):
         """Handle data received from RNS for TCP"""
         try:
-            with self.connection_lock:
-                client_socket.send(data)
-                 
-                if client_socket in self.connections:
-                    rns_link, _ = self.connections[client_socket]
-                    # Update last activity
-                    self.connections[client_socket] = (rns_link, time.time())
-                    
-                    logger.debug(f"Forwarded {len(data)} bytes from RNS to TCP client")
-                else:
-                    logger.debug(f"Forwarded {len(data)} bytes from RNS to TCP client [Warning: unknown socket {socket}]")
+            frame_type, data = unpack_stream_frame(data)
+            link = getattr(packet, "link", None)
+            if frame_type != FRAME_SESSION and state.link is not None and link is not None and link is not state.link:
+                # from a link the stream has left, or one it's resuming on that isn't
+                # RESUMED yet, whose fresh target connection the server drops
+                return
+            if frame_type == FRAME_PAUSE:
+                state.peer_resumed.clear()
+                return
+            elif frame_type == FRAME_RESUME:
+                state.peer_resumed.set()
+                return
+            elif frame_type == FRAME_ACK:
+                session = state.session
+                if session is not None:
+                    session.ack(unpack_ack_frame(data))
+                return
+            elif frame_type == FRAME_SESSION:
+                token, kind, offset = unpack_session_frame(data)
+                reply = self.session_replies.get(token)
+                if reply is not None:
+                    reply[1], reply[2] = kind, offset
+                    reply[3](kind)
+                    reply[0].set()
+                return
+            
+            # never block the RNS transport on a slow client, the IO engine writes it out
+            if not state.outbound.put(data):
+                self.metrics.inc("queue_overflows", service=self.service_name)
+                raise RuntimeError(f"outbound queue overflow ({len(state.outbound)} bytes queued)")
+            session = state.session
+            if session is not None:
+                offset = session.received_data(len(data))
+                if offset is not None:
+                    RNS.Packet(state.link, pack_ack_frame(offset)).send()
+            
+            # Update last activity
+            state.received(len(data))
+            tracer.trace("rns->client", state.link, data)
                     
         except Exception as e:
             logger.error(f"Error forwarding RNS data to TCP client: {e}")
-            self._cleanup_connection(client_socket)
+            self._cleanup_connection(state.sock)
 
-    def _rns_udp_data_received(self, data: bytes, client_addresses: dict):
+    def _send_control(self, state: ConnectionState, frame_type: int):
+        """Send a PAUSE/RESUME frame to the server"""
+        if state.link is not None and state.link.status == RNS.Link.ACTIVE:
+            RNS.Packet(state.link, pack_stream_frame(frame_type)).send()
+            if frame_type == FRAME_PAUSE:
+                self.metrics.inc("pauses_sent", service=self.service_name)
+
+    def _rns_udp_data_received(self, data: bytes, sessions: "UdpSessionTable"):
         """Handle data received from RNS for UDP"""
         try:
-            # For UDP, send to the most recent client address
-            if client_addresses:
-                latest_time = max(client_addresses.keys())
-                client_addr = client_addresses[latest_time]
-                
-                self.server_socket.sendto(data, client_addr)
-                logger.debug(f"Forwarded {len(data)} bytes from RNS to UDP client {client_addr}")
-                
-                # Clean up old addresses
-                current_time = time.time()
-                to_remove = [t for t in client_addresses.keys() if current_time - t > 300]
-                for t in to_remove:
-                    del client_addresses[t]
+            session_id, payload = unpack_udp_frame(data)
+            client_addr = sessions.addr_for(session_id)
+            if client_addr is None:
+                logger.debug("Dropping %d bytes for unknown UDP session %d", len(payload), session_id)
+                return
+            
+            self.server_socket.sendto(payload, client_addr)
+            tracer.trace("rns->client", client_addr, payload)
                     
         except Exception as e:
             logger.error(f"Error forwarding RNS data to UDP client: {e}")
 
     def _cleanup_connection(self, client_socket: socket.socket):
         """Clean up a specific connection"""
-        with self.connection_lock:
-            if client_socket in self.connections:
-                rns_link, _ = self.connections[client_socket]
-                try:
-                    client_socket.close()
-                    rns_link.teardown()
-                except:
-                    pass
-                del self.connections[client_socket]
-                logger.info("Cleaned up client connection")
+        state = self.connections.remove(client_socket)
+        if state is not None:
+            self._close_state(state)
+            logger.info("Cleaned up client connection")
 
-    def _cleanup_connections(self):
-        """Periodic cleanup of inactive connections"""
+    def _close_state(self, state: ConnectionState):
+        # closed on purpose, the handler thread must not take the link going down for a drop
+        state.session = None
+        try:
+            state.link.teardown()
+        except:
+            pass
+        # let the client have whatever the server already sent before closing
+        state.outbound.finish(lambda: self._close_socket(state.sock))
+        # fold the link's traffic into the totals
+        record_closed(self.metrics, self.service_name, state)
+        rtt = getattr(state.link, "rtt", None)
+        if rtt is not None:
+            self.metrics.observe("link_rtt_seconds", rtt, service=self.service_name)
+
+    def _close_socket(self, client_socket: socket.socket):
+        self.engine.unregister(client_socket)
+        try:
+            client_socket.close()
+        except:
+            pass
+
+    def _expire_connections(self):
+        """Drive the idle timers, once per timer wheel tick"""
         while True:
             try:
-                current_time = time.time()
-                to_cleanup = []
-                
-                with self.connection_lock:
-                    for client_socket, (rns_link, last_activity) in self.connections.items():
-                        if current_time - last_activity > self.timeout:
-                            to_cleanup.append(client_socket)
-                
-                for client_socket in to_cleanup:
+                for _, state in self.connections.expire():
                     logger.info("Connection timeout, cleaning up")
-                    self._cleanup_connection(client_socket)
+                    self.metrics.inc("links_timed_out", service=self.service_name)
+                    self._close_state(state)
                 
-                time.sleep(30)  # Check every 30 seconds
+                time.sleep(1)
                 
             except Exception as e:
                 logger.error(f"Error in cleanup thread: {e}")
@@ -331,34 +583,62 @@ class ClientBridge:
         except:
             pass
         
-        with self.connection_lock:
-            for client_socket, (rns_link, _) in self.connections.items():
-                try:
-                    client_socket.close()
-                    rns_link.teardown()
-                except:
-                    pass
-            self.connections.clear()
+        for _, state in self.connections.clear():
+            self._close_state(state)
+        
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
         
         logger.info("Client bridge shutdown complete")
 
 
 def main():
     parser = argparse.ArgumentParser(description='RNS Client Bridge')
-    parser.add_argument('listen_port', type=int, help='Local port to listen on')
-    parser.add_argument('rns_destination', help='RNS destination hash (hex)')
-    parser.add_argument('protocol', choices=['tcp', 'udp'], help='Protocol (tcp or udp)')
+    parser.add_argument('listen_port', type=int, nargs='?', help='Local port to listen on')
+    parser.add_argument('rns_destination', nargs='?', help='RNS destination hash (hex)')
+    parser.add_argument('protocol', nargs='?', choices=['tcp', 'udp'], help='Protocol (tcp or udp)')
     parser.add_argument('--host', default='127.0.0.1',
                        help='Local host to bind to (default: 127.0.0.1)')
     parser.add_argument('--timeout', type=int, default=900,
                        help='Connection timeout in seconds (default: 900)')
+    parser.add_argument('--service', default='bridge_service',
+                       help='RNS service name on the server bridge (default: bridge_service)')
+    parser.add_argument('--identity', default=None,
+                       help='Identity file to identify with, created if missing (default: a new identity every run)')
+    parser.add_argument('--udp-session-timeout', type=int, default=120,
+                       help='Idle seconds before a UDP client session expires (default: 120)')
+    parser.add_argument('--resume-timeout', type=int, default=0,
+                       help='TCP only, seconds to keep trying to resume a stream on a new link after its link '
+                            'drops, needs a server bridge run with --session-timeout (default: 0, off)')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                       help='Serve metrics (Prometheus at /metrics, JSON at /stats) on this localhost port (default: 0, off)')
+    parser.add_argument('--stats', action='store_true',
+                       help='Print the live stats of the bridge running with --metrics-port and exit')
+    parser.add_argument('--rnsconfig', default=None,
+                       help='Reticulum config directory (default: ~/.reticulum)')
     parser.add_argument('--verbose', '-v', action='store_true',
                        help='Enable verbose logging')
+    parser.add_argument('--log-file', default='rns_client_bridge.log',
+                       help='Log file, empty for stdout only (default: rns_client_bridge.log)')
+    parser.add_argument('--trace-sample', type=float, default=0,
+                       help='Fraction of forwarded packets to trace, e.g. 0.01 (default: 0, off)')
+    parser.add_argument('--log-payloads', action='store_true',
+                       help='Include packet payloads in traces')
     
     args = parser.parse_args()
     
-    if True or args.verbose:
-        logging.getLogger().setLevel(logging.DEBUG)
+    if args.stats:
+        try:
+            print_stats(args.metrics_port)
+        except OSError as e:
+            print(f"Could not reach the bridge's metrics socket on port {args.metrics_port}: {e}")
+            sys.exit(1)
+        return
+    if args.listen_port is None or args.rns_destination is None or args.protocol is None:
+        parser.error("listen_port, rns_destination and protocol are required")
+    
+    setup_logging(args.log_file, verbose=args.verbose, trace_sample=args.trace_sample,
+                  log_payloads=args.log_payloads)
     
     # Validate RNS destination hash
     try:
@@ -373,7 +653,13 @@ def main():
             rns_destination=args.rns_destination,
             protocol=args.protocol,
             timeout=args.timeout,
-            listen_host=args.host
+            listen_host=args.host,
+            udp_session_timeout=args.udp_session_timeout,
+            service_name=args.service,
+            rns_config_dir=args.rnsconfig,
+            metrics_port=args.metrics_port,
+            identity_file=args.identity,
+            resume_timeout=args.resume_timeout
         )
         bridge.start()
         
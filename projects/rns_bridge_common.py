@@ -0,0 +1,691 @@
+#!/usr/bin/env python3
+"""
+Shared helpers for the RNS bridges (rns_bridge_server.py and rns_bridge_client.py)
+"""
+
+import heapq
+import itertools
+import logging
+import os
+import selectors
+import socket
+import struct
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Hashable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# UDP mode multiplexes every local client over a single RNS link. Each packet on the
+# link carries a 2 byte session id in front of the datagram so both sides can keep
+# the clients apart without spending a link (and its handshake) per client.
+UDP_SESSION_HEADER = struct.Struct("!H")
+MAX_UDP_SESSIONS = 2**16
+
+
+def pack_udp_frame(session_id: int, data: bytes) -> bytes:
+    """Prefix a datagram with its session id"""
+    return UDP_SESSION_HEADER.pack(session_id) + data
+
+
+def pack_udp_frame_into(buf: bytearray, session_id: int, length: int) -> memoryview:
+    """Put the session id in front of length bytes read into buf at UDP_SESSION_HEADER.size, returns the frame"""
+    UDP_SESSION_HEADER.pack_into(buf, 0, session_id)
+    return memoryview(buf)[:UDP_SESSION_HEADER.size + length]
+
+
+def unpack_udp_frame(frame: bytes) -> Tuple[int, memoryview]:
+    """Split a link packet into (session_id, datagram), the datagram is a view into frame"""
+    if len(frame) < UDP_SESSION_HEADER.size:
+        raise ValueError(f"UDP frame too short ({len(frame)} bytes)")
+    session_id, = UDP_SESSION_HEADER.unpack_from(frame)
+    return session_id, memoryview(frame)[UDP_SESSION_HEADER.size:]
+
+
+# TCP mode links carry one type byte in front of every packet. Besides stream data
+# either side can ask the other to stop (and later resume) sending when the socket
+# it writes to can't keep up, so a slow consumer never blocks the RNS transport.
+STREAM_FRAME_HEADER = 1
+FRAME_DATA = 0x00
+FRAME_PAUSE = 0x01
+FRAME_RESUME = 0x02
+# resumable sessions (see StreamSession), only used when both bridges have them turned on
+FRAME_SESSION = 0x03
+FRAME_ACK = 0x04
+
+
+def pack_stream_frame(frame_type: int, data: bytes = b"") -> bytes:
+    """Prefix stream data (or an empty control frame) with its type"""
+    return bytes((frame_type,)) + data
+
+
+def pack_stream_frame_into(buf: bytearray, frame_type: int, length: int) -> memoryview:
+    """Put the type in front of length bytes read into buf at STREAM_FRAME_HEADER, returns the frame"""
+    buf[0] = frame_type
+    return memoryview(buf)[:STREAM_FRAME_HEADER + length]
+
+
+def unpack_stream_frame(frame: bytes) -> Tuple[int, memoryview]:
+    """Split a link packet into (frame_type, data), the data is a view into frame"""
+    if len(frame) < STREAM_FRAME_HEADER:
+        raise ValueError("Empty stream frame")
+    return frame[0], memoryview(frame)[STREAM_FRAME_HEADER:]
+
+
+# FRAME_SESSION payload: session token, kind, stream offset (what the sender has received)
+SESSION_TOKEN_SIZE = 16
+SESSION_HEADER = struct.Struct(f"!{SESSION_TOKEN_SIZE}sBQ")
+# client -> server
+SESSION_NEW = 0
+SESSION_RESUME = 1
+# server -> client
+SESSION_ACCEPTED = 2
+SESSION_RESUMED = 3
+SESSION_UNKNOWN = 4
+# FRAME_ACK payload: stream offset received so far
+ACK_HEADER = struct.Struct("!Q")
+
+
+def pack_session_frame(token: bytes, kind: int, offset: int) -> bytes:
+    return pack_stream_frame(FRAME_SESSION, SESSION_HEADER.pack(token, kind, offset))
+
+
+def unpack_session_frame(data: bytes) -> Tuple[bytes, int, int]:
+    """(token, kind, offset) of a FRAME_SESSION payload"""
+    if len(data) != SESSION_HEADER.size:
+        raise ValueError(f"Session frame of {len(data)} bytes")
+    return SESSION_HEADER.unpack(data)
+
+
+def pack_ack_frame(offset: int) -> bytes:
+    return pack_stream_frame(FRAME_ACK, ACK_HEADER.pack(offset))
+
+
+def unpack_ack_frame(data: bytes) -> int:
+    if len(data) != ACK_HEADER.size:
+        raise ValueError(f"Ack frame of {len(data)} bytes")
+    return ACK_HEADER.unpack(data)[0]
+
+
+def link_payload_size(link) -> int:
+    """Largest stream payload that still fits one packet on link after the frame header"""
+    # newer RNS versions track a per-link MDU (link MTU discovery), older ones only have the constant
+    return (getattr(link, "mdu", None) or link.MDU) - STREAM_FRAME_HEADER
+
+
+class BufferPool:
+    """
+    Reusable receive buffers. Sockets are read with recv_into()/recvfrom_into() behind
+    room for the frame header, the header is packed in place with pack_*_frame_into()
+    and the frame is copied once into the bytes RNS keeps for the packet, instead of
+    allocating for the read and again for header + data. Buffers are made on demand
+    and at most max_free are kept once released.
+    """
+
+    def __init__(self, buffer_size: int = 65536, max_free: int = 64):
+        self.buffer_size = buffer_size
+        self.max_free = max_free
+        self.free: List[bytearray] = []
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> bytearray:
+        with self.lock:
+            if self.free:
+                return self.free.pop()
+            self.created += 1
+        return bytearray(self.buffer_size)
+
+    def release(self, buf: bytearray):
+        with self.lock:
+            if len(self.free) < self.max_free:
+                self.free.append(buf)
+
+    def __len__(self):
+        return self.created
+
+
+class TimerWheel:
+    """
+    Hierarchical timer wheel. Level 0 has one slot per tick, every level above covers
+    num_slots times the span of the one below, and timers cascade down a level as
+    their deadline gets closer. schedule() and cancel() are O(1), advance() does O(1)
+    work per elapsed tick plus the timers it fires or cascades.
+
+    Timers fire once their tick has fully elapsed, so expiry is precise to one tick.
+    """
+
+    def __init__(self, tick: float = 1.0, num_slots: int = 64, levels: int = 4):
+        self.tick = tick
+        self.num_slots = num_slots
+        self.levels: List[List[Dict[Hashable, int]]] = [[dict() for _ in range(num_slots)] for _ in range(levels)]
+        self.spans = [num_slots ** level for level in range(levels)]
+        self.timers: Dict[Hashable, Tuple[int, int]] = {}  # key -> (level, slot)
+        self.current_tick = int(time.time() / tick)  # every tick before this one has been processed
+        self.lock = threading.Lock()
+
+    def schedule(self, key: Hashable, deadline: float):
+        """(Re)schedule key to fire at deadline"""
+        with self.lock:
+            self._cancel(key)
+            self._insert(key, int(deadline / self.tick))
+
+    def cancel(self, key: Hashable):
+        """Drop the timer for key, if any"""
+        with self.lock:
+            self._cancel(key)
+
+    def _cancel(self, key: Hashable):
+        position = self.timers.pop(key, None)
+        if position is not None:
+            level, slot = position
+            self.levels[level][slot].pop(key, None)
+
+    def _insert(self, key: Hashable, deadline_tick: int):
+        deadline_tick = max(deadline_tick, self.current_tick)
+        delta = deadline_tick - self.current_tick
+        level = 0
+        while level < len(self.levels) - 1 and delta >= self.spans[level + 1]:
+            level += 1
+        slot = (deadline_tick // self.spans[level]) % self.num_slots
+        self.levels[level][slot][key] = deadline_tick
+        self.timers[key] = (level, slot)
+
+    def advance(self, now: Optional[float] = None) -> List[Hashable]:
+        """Return (and forget) every key whose deadline tick has fully elapsed"""
+        now = time.time() if now is None else now
+        now_tick = int(now / self.tick)
+        expired = []
+        with self.lock:
+            if not self.timers:
+                self.current_tick = max(self.current_tick, now_tick)
+                return expired
+
+            while self.current_tick < now_tick:
+                tick = self.current_tick
+                # pull timers from the upper levels whose slot starts at this tick
+                for level in range(len(self.levels) - 1, 0, -1):
+                    if tick % self.spans[level] == 0:
+                        slot = self.levels[level][(tick // self.spans[level]) % self.num_slots]
+                        cascading = list(slot.items())
+                        slot.clear()
+                        for key, deadline_tick in cascading:
+                            self._insert(key, deadline_tick)
+
+                slot = self.levels[0][tick % self.num_slots]
+                for key, deadline_tick in list(slot.items()):
+                    if deadline_tick <= tick:
+                        del slot[key]
+                        del self.timers[key]
+                        expired.append(key)
+                self.current_tick += 1
+
+                if not self.timers:
+                    self.current_tick = now_tick
+        return expired
+
+    def __len__(self):
+        return len(self.timers)
+
+
+class IdleTracker:
+    """
+    Idle expiry on top of a TimerWheel. touch() is a plain dict store, the wheel is
+    only rescheduled when a timer fires on a key that has seen activity since.
+    """
+
+    def __init__(self, timeout: float, tick: float = 1.0):
+        self.timeout = timeout
+        self.last_activity: Dict[Hashable, float] = {}
+        self.wheel = TimerWheel(tick=tick)
+
+    def touch(self, key: Hashable, now: Optional[float] = None):
+        """Record activity for key, start tracking it if it is new"""
+        now = time.time() if now is None else now
+        if key not in self.last_activity:
+            self.wheel.schedule(key, now + self.timeout)
+        self.last_activity[key] = now
+
+    def forget(self, key: Hashable):
+        """Stop tracking key"""
+        self.last_activity.pop(key, None)
+        self.wheel.cancel(key)
+
+    def expire(self, now: Optional[float] = None) -> List[Hashable]:
+        """Return (and forget) every key that has been idle for longer than the timeout"""
+        now = time.time() if now is None else now
+        expired = []
+        for key in self.wheel.advance(now):
+            last_activity = self.last_activity.get(key)
+            if last_activity is None:
+                continue
+            if now - last_activity >= self.timeout:
+                self.last_activity.pop(key, None)
+                expired.append(key)
+            else:
+                self.wheel.schedule(key, last_activity + self.timeout)
+        return expired
+
+    def __contains__(self, key: Hashable):
+        return key in self.last_activity
+
+    def __len__(self):
+        return len(self.last_activity)
+
+
+class StreamSession:
+    """
+    The resumable side of a bridged TCP stream, so the stream survives its RNS link going
+    down. Each bridge numbers the bytes it sends by their offset in the stream, keeps the
+    data frames it sent until the peer acknowledges them (FRAME_ACK every ack_interval
+    received bytes) and stops reading its socket while window bytes are unacknowledged.
+    A new link re-attaches with the token: both sides tell each other how much they
+    received and replay their frames from there.
+    """
+
+    def __init__(self, token: Optional[bytes] = None, window: int = 128 * 1024):
+        self.token = token if token is not None else os.urandom(SESSION_TOKEN_SIZE)
+        self.window = window
+        self.ack_interval = window // 4
+        self.sent = 0  # stream offset after the last byte sent
+        self.received = 0  # stream offset after the last byte received
+        self.acked_received = 0  # what we last acknowledged
+        self.frames: Deque[Tuple[int, bytes]] = deque()  # (stream offset, frame) sent but not acknowledged
+        self.unacked = 0
+        self.window_open = threading.Event()  # cleared while window bytes are unacknowledged
+        self.window_open.set()
+        self.detached_at: Optional[float] = None  # when the link went away, None while attached
+        self.lock = threading.Lock()
+
+    def sent_frame(self, frame: bytes):
+        """Keep a data frame (as sent, header included) until the peer acknowledges it"""
+        with self.lock:
+            self.frames.append((self.sent, frame))
+            self.sent += len(frame) - STREAM_FRAME_HEADER
+            self.unacked += len(frame) - STREAM_FRAME_HEADER
+            if self.unacked >= self.window:
+                self.window_open.clear()
+
+    def ack(self, offset: int) -> bool:
+        """Drop the frames the peer has received up to offset, True if that reopened the window"""
+        with self.lock:
+            while self.frames:
+                start, frame = self.frames[0]
+                if start + len(frame) - STREAM_FRAME_HEADER > offset:
+                    break
+                self.frames.popleft()
+                self.unacked -= len(frame) - STREAM_FRAME_HEADER
+            if self.unacked < self.window and not self.window_open.is_set():
+                self.window_open.set()
+                return True
+            return False
+
+    def replay_from(self, offset: int) -> Optional[List[bytes]]:
+        """The frames to resend to a peer that received up to offset, None if they're gone"""
+        self.ack(offset)
+        with self.lock:
+            if self.frames:
+                return [frame for _, frame in self.frames] if self.frames[0][0] == offset else None
+            return [] if offset == self.sent else None
+
+    def received_data(self, num_bytes: int) -> Optional[int]:
+        """Count received stream bytes, returns the offset to acknowledge when an ack is due"""
+        with self.lock:
+            self.received += num_bytes
+            if self.received - self.acked_received < self.ack_interval:
+                return None
+            self.acked_received = self.received
+            return self.received
+
+
+class ConnectionState:
+    """
+    Per-connection state. Fields are plain attribute stores, so the data path can stamp
+    activity and bump counters without taking any lock.
+    """
+    __slots__ = ("link", "sock", "outbound", "peer_resumed", "identity", "bucket", "session", "created",
+                 "last_activity", "last_in", "last_out", "bytes_in", "bytes_out", "packets_in", "packets_out")
+
+    def __init__(self, link, sock):
+        self.link = link
+        self.sock = sock
+        self.outbound: Optional[OutboundQueue] = None  # TCP only, data waiting for sock
+        self.identity: Optional[bytes] = None  # remote identity hash, if the peer identified itself
+        self.bucket: Optional[TokenBucket] = None  # per-link rate limit towards RNS
+        self.session: Optional[StreamSession] = None  # TCP only, if the stream can move to a new link
+        self.peer_resumed = threading.Event()  # cleared while the peer asked us to pause
+        self.peer_resumed.set()
+        self.created = time.time()
+        self.last_activity = self.created
+        self.last_in = 0.0  # when data last came in over RNS, 0 if never
+        self.last_out = 0.0  # when data last went out over RNS, 0 if never
+        self.bytes_in = 0  # from RNS towards the local/target socket
+        self.bytes_out = 0  # from the local/target socket towards RNS
+        self.packets_in = 0
+        self.packets_out = 0
+
+    def received(self, num_bytes: int):
+        """Account for data that came in over RNS"""
+        self.last_activity = self.last_in = time.time()
+        self.bytes_in += num_bytes
+        self.packets_in += 1
+
+    def sent(self, num_bytes: int):
+        """Account for data that went out over RNS"""
+        self.last_activity = self.last_out = time.time()
+        self.bytes_out += num_bytes
+        self.packets_out += 1
+
+
+class TokenBucket:
+    """
+    Byte rate limiter. A sender may overdraw the bucket by one packet, the debt is paid
+    off before the next one goes out, so the average rate holds without having to know
+    packet sizes up front. Not locked, use it from a single thread (the IO engine).
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        """
+        Args:
+            rate: Bytes per second
+            burst: Bucket size in bytes (default: one second worth of rate)
+        """
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, num_bytes: int):
+        """Account for num_bytes sent"""
+        self._refill()
+        self.tokens -= num_bytes
+
+    def delay(self) -> float:
+        """Seconds until the bucket is out of debt, 0 if sending is allowed now"""
+        self._refill()
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class ConnectionTable:
+    """
+    Live connections and their idle timers. Lookups go straight to the dict and only
+    add/remove take the lock. Idle expiry runs off a TimerWheel: a timer fires at
+    last_activity + timeout and is pushed back if the connection was used since.
+    """
+
+    def __init__(self, timeout: float, tick: float = 1.0):
+        self.timeout = timeout
+        self.states: Dict[Hashable, ConnectionState] = {}
+        self.wheel = TimerWheel(tick=tick)
+        self.lock = threading.Lock()
+
+    def add(self, key: Hashable, state: ConnectionState):
+        with self.lock:
+            self.states[key] = state
+        self.wheel.schedule(key, state.last_activity + self.timeout)
+
+    def get(self, key: Hashable) -> Optional[ConnectionState]:
+        return self.states.get(key)
+
+    def remove(self, key: Hashable) -> Optional[ConnectionState]:
+        """Forget a connection, returns its state if it was still known"""
+        with self.lock:
+            state = self.states.pop(key, None)
+        self.wheel.cancel(key)
+        return state
+
+    def expire(self, now: Optional[float] = None) -> List[Tuple[Hashable, ConnectionState]]:
+        """Remove and return every (key, state) that has been idle for longer than the timeout"""
+        now = time.time() if now is None else now
+        expired = []
+        for key in self.wheel.advance(now):
+            state = self.states.get(key)
+            if state is None:
+                continue
+            if now - state.last_activity >= self.timeout:
+                with self.lock:
+                    self.states.pop(key, None)
+                expired.append((key, state))
+            else:
+                self.wheel.schedule(key, state.last_activity + self.timeout)
+        return expired
+
+    def items(self) -> List[Tuple[Hashable, ConnectionState]]:
+        with self.lock:
+            return list(self.states.items())
+
+    def clear(self) -> List[Tuple[Hashable, ConnectionState]]:
+        """Remove every connection, returns what was removed"""
+        with self.lock:
+            items = list(self.states.items())
+            self.states.clear()
+        for key, _ in items:
+            self.wheel.cancel(key)
+        return items
+
+    def __contains__(self, key: Hashable):
+        return key in self.states
+
+    def __len__(self):
+        return len(self.states)
+
+
+class IOEngine:
+    """
+    One selector thread that services the sockets of every bridged connection,
+    instead of a reader thread per link. Callbacks run on the engine thread and
+    should not block.
+    """
+
+    def __init__(self, poll_interval: float = 1.0):
+        self.selector = selectors.DefaultSelector()
+        self.poll_interval = poll_interval
+        self.handlers: Dict[socket.socket, List[Optional[Callable[[socket.socket], None]]]] = {}
+        self.lock = threading.Lock()
+        self.timers: List[Tuple[float, int, Callable[[], None]]] = []
+        self.timer_seq = itertools.count()
+        self.running = False
+        self.thread: Optional[threading.Thread] = None
+        # for everything reading the sockets of this engine's connections, on or off the engine thread
+        self.buffers = BufferPool()
+
+    def start(self):
+        """Start the engine thread"""
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def register(self, sock: socket.socket, callback: Optional[Callable[[socket.socket], None]]):
+        """Call callback(sock) on the engine thread whenever sock is readable, None stops reading"""
+        self._update(sock, 0, callback)
+
+    def want_write(self, sock: socket.socket, callback: Optional[Callable[[socket.socket], None]]):
+        """Call callback(sock) on the engine thread whenever sock is writable, None stops it"""
+        self._update(sock, 1, callback)
+
+    def _update(self, sock: socket.socket, index: int, callback):
+        with self.lock:
+            handlers = self.handlers.get(sock)
+            if handlers is None:
+                if callback is None:
+                    return
+                handlers = self.handlers[sock] = [None, None]
+            handlers[index] = callback
+
+            events = (selectors.EVENT_READ if handlers[0] else 0) | (selectors.EVENT_WRITE if handlers[1] else 0)
+            try:
+                if events == 0:
+                    del self.handlers[sock]
+                    self.selector.unregister(sock)
+                else:
+                    try:
+                        self.selector.modify(sock, events, handlers)
+                    except KeyError:
+                        self.selector.register(sock, events, handlers)
+            except (KeyError, ValueError):
+                pass
+
+    def call_later(self, delay: float, callback: Callable[[], None]):
+        """Call callback() on the engine thread after delay seconds"""
+        with self.lock:
+            heapq.heappush(self.timers, (time.monotonic() + delay, next(self.timer_seq), callback))
+
+    def unregister(self, sock: socket.socket):
+        """Stop watching sock, safe to call more than once"""
+        with self.lock:
+            self.handlers.pop(sock, None)
+            try:
+                self.selector.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+
+    def _run(self):
+        while self.running:
+            # timers are mostly set from engine callbacks, so waking up for the earliest
+            # one is enough, ones set from other threads wait at most poll_interval
+            timeout = self.poll_interval
+            if self.timers:
+                timeout = max(0.0, min(timeout, self.timers[0][0] - time.monotonic()))
+            try:
+                events = self.selector.select(timeout)
+            except OSError as e:
+                # a socket was closed under us, the next select won't see it
+                logger.debug("IO engine select failed: %s", e)
+                continue
+
+            for key, mask in events:
+                on_readable, on_writable = key.data
+                try:
+                    if mask & selectors.EVENT_WRITE and on_writable:
+                        on_writable(key.fileobj)
+                    if mask & selectors.EVENT_READ and on_readable:
+                        on_readable(key.fileobj)
+                except Exception as e:
+                    logger.error(f"Error in IO engine callback: {e}")
+
+            self._run_timers()
+
+    def _run_timers(self):
+        now = time.monotonic()
+        while True:
+            with self.lock:
+                if not self.timers or self.timers[0][0] > now:
+                    return
+                _, _, callback = heapq.heappop(self.timers)
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Error in IO engine timer: {e}")
+
+    def stop(self):
+        """Stop the engine thread"""
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout=self.poll_interval * 2)
+        self.selector.close()
+
+
+class OutboundQueue:
+    """
+    Bounded buffer between the RNS packet callbacks and a local socket. put() never
+    blocks the RNS transport thread; the IOEngine drains the queue whenever the socket
+    is writable. Crossing high_water calls on_pause so the sender can be told to stop,
+    draining below low_water calls on_resume.
+    """
+
+    def __init__(self, sock: socket.socket, engine: IOEngine, on_pause: Callable[[], None],
+                 on_resume: Callable[[], None], high_water: int = 256 * 1024,
+                 low_water: int = 64 * 1024, max_bytes: int = 1024 * 1024):
+        self.sock = sock
+        self.engine = engine
+        self.on_pause = on_pause
+        self.on_resume = on_resume
+        self.high_water = high_water
+        self.low_water = low_water
+        self.max_bytes = max_bytes
+        self.chunks: Deque[memoryview] = deque()
+        self.size = 0
+        self.paused = False
+        self.closed = False
+        self.on_drained: Optional[Callable[[], None]] = None
+        self.lock = threading.Lock()
+
+    def put(self, data: bytes) -> bool:
+        """Queue data for the socket, returns False if the queue overflowed"""
+        pause = False
+        with self.lock:
+            if self.closed:
+                return False
+            if self.size + len(data) > self.max_bytes:
+                return False
+            was_empty = not self.chunks
+            self.chunks.append(memoryview(data))
+            self.size += len(data)
+            if not self.paused and self.size >= self.high_water:
+                self.paused = pause = True
+
+        if was_empty:
+            self.engine.want_write(self.sock, self._writable)
+        if pause:
+            self.on_pause()
+        return True
+
+    def _writable(self, sock: socket.socket):
+        resume = False
+        drained = None
+        with self.lock:
+            while self.chunks:
+                chunk = self.chunks[0]
+                try:
+                    sent = sock.send(chunk)
+                except (BlockingIOError, socket.timeout):
+                    break
+                except OSError as e:
+                    # the reading side of the bridge notices the dead socket and tears down
+                    logger.debug("Dropping %d queued bytes: %s", self.size, e)
+                    self.closed = True
+                    self.chunks.clear()
+                    self.size = 0
+                    break
+                self.size -= sent
+                if sent < len(chunk):
+                    self.chunks[0] = chunk[sent:]
+                    break
+                self.chunks.popleft()
+
+            if not self.chunks:
+                self.engine.want_write(sock, None)
+                drained, self.on_drained = self.on_drained, None
+            if self.paused and self.size <= self.low_water and not self.closed:
+                self.paused = False
+                resume = True
+
+        if resume:
+            self.on_resume()
+        if drained is not None:
+            drained()
+
+    def finish(self, callback: Callable[[], None]):
+        """Call callback once everything queued has been written, right away if nothing is"""
+        with self.lock:
+            if self.chunks and not self.closed:
+                self.on_drained = callback
+                return
+        callback()
+
+    def close(self):
+        """Drop anything still queued and stop writing"""
+        with self.lock:
+            self.closed = True
+            self.chunks.clear()
+            self.size = 0
+        self.engine.want_write(self.sock, None)
+
+    def __len__(self):
+        return self.size
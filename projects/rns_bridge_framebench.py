@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+RNS Bridge Framing Microbenchmark - Socket reads and framing of the bridges' data path, without RNS
+
+Forwards data through a local socket pair the way the bridges read a socket and frame
+the data for an RNS packet, once with a fresh bytes per recv() plus header + data
+concatenation, and once with recv_into() a pooled buffer and a single copy for the
+packet. Receiving frames is compared the same way, slicing vs memoryview. Reports
+throughput (writing into the socket pair included, best of --repeat runs) and the
+bytes allocated per MB forwarded, measured with tracemalloc as the transient
+allocations of each packet (the final frame included, RNS keeps it).
+
+Example: python rns_bridge_framebench.py --megabytes 20 --payload-size 431
+"""
+
+import argparse
+import socket
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+from rns_bridge_common import (BufferPool, FRAME_DATA, STREAM_FRAME_HEADER, UDP_SESSION_HEADER, pack_stream_frame,
+                               pack_stream_frame_into, pack_udp_frame, pack_udp_frame_into, unpack_stream_frame,
+                               unpack_udp_frame)
+
+
+def stream_copying(sock: socket.socket, size: int) -> Callable[[], bytes]:
+    def read():
+        return pack_stream_frame(FRAME_DATA, sock.recv(size))
+    return read
+
+
+def stream_pooled(sock: socket.socket, size: int) -> Callable[[], bytes]:
+    buf = BufferPool().acquire()
+    payload = memoryview(buf)[STREAM_FRAME_HEADER:]
+    def read():
+        return bytes(pack_stream_frame_into(buf, FRAME_DATA, sock.recv_into(payload, size)))
+    return read
+
+
+def udp_copying(sock: socket.socket, size: int) -> Callable[[], bytes]:
+    def read():
+        data, _ = sock.recvfrom(4096)
+        return pack_udp_frame(1, data)
+    return read
+
+
+def udp_pooled(sock: socket.socket, size: int) -> Callable[[], bytes]:
+    buf = BufferPool().acquire()
+    datagram = memoryview(buf)[UDP_SESSION_HEADER.size:]
+    def read():
+        length, _ = sock.recvfrom_into(datagram, 4096)
+        return bytes(pack_udp_frame_into(buf, 1, length))
+    return read
+
+
+READERS = {
+    ("tcp", "copying"): stream_copying,
+    ("tcp", "pooled"): stream_pooled,
+    ("udp", "copying"): udp_copying,
+    ("udp", "pooled"): udp_pooled,
+}
+
+# what the bridges did with a received frame before unpacking returned views
+UNPACKERS = {
+    ("tcp", "copying"): lambda frame: (frame[0], frame[STREAM_FRAME_HEADER:]),
+    ("tcp", "pooled"): unpack_stream_frame,
+    ("udp", "copying"): lambda frame: (UDP_SESSION_HEADER.unpack_from(frame)[0], frame[UDP_SESSION_HEADER.size:]),
+    ("udp", "pooled"): unpack_udp_frame,
+}
+
+
+def measure(op: Callable[[], object], count: int, before: Callable[[], None], repeat: int) -> Dict[str, float]:
+    """Best seconds for count runs of before() and op(), and the bytes op() allocated"""
+    elapsed = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(count):
+            before()
+            op()
+        run = time.perf_counter() - start
+        elapsed = run if elapsed is None else min(elapsed, run)
+
+    # a second pass under tracemalloc, it slows everything down too much to time
+    allocated = 0
+    tracemalloc.start()
+    try:
+        for _ in range(count):
+            before()
+            tracemalloc.reset_peak()
+            current, _ = tracemalloc.get_traced_memory()
+            op()
+            allocated += tracemalloc.get_traced_memory()[1] - current
+    finally:
+        tracemalloc.stop()
+    return {"elapsed_s": elapsed, "allocated": allocated}
+
+
+def bench_read(protocol: str, variant: str, count: int, size: int, repeat: int) -> Dict[str, float]:
+    family = socket.AF_UNIX
+    kind = socket.SOCK_STREAM if protocol == "tcp" else socket.SOCK_DGRAM
+    writer, reader = socket.socketpair(family, kind)
+    try:
+        chunk = b"x" * size
+        return measure(READERS[(protocol, variant)](reader, size), count, lambda: writer.send(chunk), repeat)
+    finally:
+        writer.close()
+        reader.close()
+
+
+def bench_unpack(protocol: str, variant: str, count: int, size: int, repeat: int) -> Dict[str, float]:
+    header = STREAM_FRAME_HEADER if protocol == "tcp" else UDP_SESSION_HEADER.size
+    frame = bytes(header) + b"x" * size
+    unpack = UNPACKERS[(protocol, variant)]
+    return measure(lambda: unpack(frame), count, lambda: None, repeat)
+
+
+def format_value(value) -> str:
+    if isinstance(value, float):
+        return f"{value:.4g}"
+    return str(value)
+
+
+def print_report(results: List[Dict]):
+    columns = ["protocol", "step", "variant", "MB_per_s", "allocated_bytes_per_MB"]
+    rows = [[format_value(r.get(c)) for c in columns] for r in results]
+    widths = [max(len(c), *(len(row[i]) for row in rows)) for i, c in enumerate(columns)]
+    print("  ".join(c.ljust(w) for c, w in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(v.ljust(w) for v, w in zip(row, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='RNS Bridge Framing Microbenchmark')
+    parser.add_argument('--protocols', default='tcp,udp', help='Bridge modes to run (default: tcp,udp)')
+    parser.add_argument('--megabytes', type=float, default=10, help='Data to forward per run (default: 10)')
+    parser.add_argument('--payload-size', type=int, default=431,
+                       help='Bytes per packet, an RNS link MDU by default (default: 431)')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed runs, the best one counts (default: 5)')
+    args = parser.parse_args()
+
+    count = max(1, int(args.megabytes * 1e6 / args.payload_size))
+    megabytes = count * args.payload_size / 1e6
+    results = []
+    for protocol in args.protocols.split(","):
+        for step, bench in (("read", bench_read), ("unpack", bench_unpack)):
+            for variant in ("copying", "pooled"):
+                measured = bench(protocol, variant, count, args.payload_size, args.repeat)
+                results.append({
+                    "protocol": protocol,
+                    "step": step,
+                    "variant": variant,
+                    "MB_per_s": megabytes / max(measured["elapsed_s"], 1e-9),
+                    "allocated_bytes_per_MB": measured["allocated"] / megabytes,
+                })
+    print_report(results)
+
+
+if __name__ == "__main__":
+    main()
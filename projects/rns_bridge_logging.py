@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Logging for the RNS bridges. Log records are handed to a queue and written to
+stdout/file by a background listener thread, so the data path never waits on I/O.
+Per-packet tracing is sampled and off by default, payloads are only logged when
+explicitly asked for.
+"""
+
+import atexit
+import itertools
+import logging
+import logging.handlers
+import queue
+import sys
+from typing import Optional
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+
+class PacketTracer:
+    """
+    Sampled per-packet tracing for the bridge data path. When tracing is off (the
+    default) trace() is a single attribute check, messages are only formatted for
+    the packets that are actually logged.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("rns_bridge.trace")
+        self.configure(0)
+
+    def configure(self, sample_rate: float, log_payloads: bool = False, payload_bytes: int = 64):
+        """
+        Args:
+            sample_rate: Fraction of packets to trace, 0 disables tracing, 1 traces every packet
+            log_payloads: Include (the start of) each traced packet's payload
+            payload_bytes: How much of the payload to include
+        """
+        self.every = max(1, round(1 / sample_rate)) if sample_rate > 0 else 0
+        self.enabled = self.every > 0
+        self.log_payloads = log_payloads
+        self.payload_bytes = payload_bytes
+        self.counter = itertools.count()
+        self.logger.setLevel(logging.DEBUG if self.enabled else logging.WARNING)
+
+    def trace(self, direction: str, link, data):
+        """Maybe log one forwarded packet, direction is something like 'rns->target'"""
+        if not self.enabled or next(self.counter) % self.every:
+            return
+        if self.log_payloads:
+            self.logger.debug("%s %d bytes on %s: %r", direction, len(data), link, bytes(data[:self.payload_bytes]))
+        else:
+            self.logger.debug("%s %d bytes on %s", direction, len(data), link)
+
+
+tracer = PacketTracer()
+
+
+def setup_logging(log_file: Optional[str], verbose: bool = False, trace_sample: float = 0,
+                  log_payloads: bool = False) -> logging.handlers.QueueListener:
+    """
+    Route all logging through a queue to stdout and (optionally) a file
+
+    Args:
+        log_file: Log file path, None or empty for stdout only
+        verbose: Log at DEBUG instead of INFO
+        trace_sample: Fraction of forwarded packets to trace (0 to disable)
+        log_payloads: Include packet payloads in traces
+    """
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if log_file:
+        handlers.append(logging.FileHandler(log_file))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(logging.DEBUG if verbose else logging.INFO)
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    listener.start()
+    # flush whatever is still queued on the way out
+    atexit.register(listener.stop)
+
+    tracer.configure(trace_sample, log_payloads)
+    return listener
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""
+Metrics for the RNS bridges: counters and histograms kept in a MetricsRegistry,
+per-link values read straight off the live ConnectionState objects at scrape time,
+and a small localhost control socket that serves them as JSON or Prometheus text.
+"""
+
+import json
+import logging
+import socket
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# seconds, good enough for link setup over LoRa as well as TCP on a LAN
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 3600)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, object]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Histogram:
+    """Cumulative-bucket histogram, the way Prometheus wants them"""
+    __slots__ = ("buckets", "counts", "sum", "count", "lock")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self.lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {"buckets": dict(zip(self.buckets, self.counts)), "sum": self.sum, "count": self.count}
+
+
+class MetricsRegistry:
+    """
+    Named metric families with labels. Counters and histograms are updated in place,
+    collectors are called at scrape time to add live values (gauges, or the traffic
+    of connections that are still open on top of the counted totals of closed ones).
+    """
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.families: Dict[str, dict] = {}
+        self.values: Dict[str, Dict[LabelKey, object]] = {}
+        self.collectors: List[Callable[[], Iterable[Tuple[str, Dict[str, object], float]]]] = []
+        self.lock = threading.Lock()
+
+    def describe(self, name: str, kind: str, help_text: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        """Declare a metric family, kind is 'counter', 'gauge' or 'histogram'"""
+        self.families[name] = {"type": kind, "help": help_text, "buckets": buckets}
+        self.values[name] = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            series = self.values[name]
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = _label_key(labels)
+        series = self.values[name]
+        histogram = series.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = series.setdefault(key, Histogram(self.families[name]["buckets"]))
+        histogram.observe(value)
+
+    def add_collector(self, collector: Callable[[], Iterable[Tuple[str, Dict[str, object], float]]]):
+        """collector() yields (name, labels, value), values are added to the stored ones"""
+        self.collectors.append(collector)
+
+    def collect(self) -> Dict[str, Dict[LabelKey, object]]:
+        """Every series of every family, stored values plus collected live values"""
+        with self.lock:
+            merged = {name: dict(series) for name, series in self.values.items()}
+        for collector in self.collectors:
+            try:
+                for name, labels, value in collector():
+                    key = _label_key(labels)
+                    merged[name][key] = merged[name].get(key, 0) + value
+            except Exception as e:
+                logger.error("Metrics collector failed: %s", e)
+        return merged
+
+    def snapshot(self) -> dict:
+        """JSON friendly view of collect()"""
+        result = {}
+        for name, series in self.collect().items():
+            result[name] = {
+                "type": self.families[name]["type"],
+                "values": [
+                    {"labels": dict(key), "value": value.snapshot() if isinstance(value, Histogram) else value}
+                    for key, value in series.items()
+                ],
+            }
+        return result
+
+    def render_prometheus(self) -> str:
+        """Prometheus text exposition format"""
+        lines = []
+        for name, series in self.collect().items():
+            family = self.families[name]
+            full_name = f"{self.prefix}_{name}"
+            lines.append(f"# HELP {full_name} {family['help']}")
+            lines.append(f"# TYPE {full_name} {family['type']}")
+            for key, value in series.items():
+                if isinstance(value, Histogram):
+                    snap = value.snapshot()
+                    for bound, count in snap["buckets"].items():
+                        lines.append(f"{full_name}_bucket{_format_labels(key + (('le', str(bound)),))} {count}")
+                    lines.append(f"{full_name}_bucket{_format_labels(key + (('le', '+Inf'),))} {snap['count']}")
+                    lines.append(f"{full_name}_sum{_format_labels(key)} {snap['sum']}")
+                    lines.append(f"{full_name}_count{_format_labels(key)} {snap['count']}")
+                else:
+                    lines.append(f"{full_name}{_format_labels(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(key: LabelKey) -> str:
+    if not key:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in key)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(key, escaped)) + "}"
+
+
+def describe_bridge_metrics(registry: MetricsRegistry):
+    """The metric families both bridges share"""
+    registry.describe("links_total", "counter", "Links established")
+    registry.describe("links_failed", "counter", "Links that could not be established or bridged")
+    registry.describe("links_refused", "counter", "Links refused by admission control")
+    registry.describe("links_timed_out", "counter", "Links torn down after being idle")
+    registry.describe("links_active", "gauge", "Links currently bridged")
+    registry.describe("bytes_in", "counter", "Bytes received over RNS and forwarded to a socket")
+    registry.describe("bytes_out", "counter", "Bytes read from a socket and sent over RNS")
+    registry.describe("packets_in", "counter", "RNS packets received")
+    registry.describe("packets_out", "counter", "RNS packets sent")
+    registry.describe("queue_overflows", "counter", "Links torn down because their outbound queue overflowed")
+    registry.describe("pauses_sent", "counter", "PAUSE frames sent to the peer")
+    registry.describe("link_establishment_seconds", "histogram", "Time to bring up an RNS link")
+    registry.describe("link_rtt_seconds", "histogram", "RNS link round trip time estimate, one sample per link")
+    registry.describe("connection_duration_seconds", "histogram", "Lifetime of bridged connections")
+    registry.describe("link_bytes_in", "gauge", "Bytes in over RNS on a live link")
+    registry.describe("link_bytes_out", "gauge", "Bytes out over RNS on a live link")
+    registry.describe("link_packets_in", "gauge", "Packets in over RNS on a live link")
+    registry.describe("link_packets_out", "gauge", "Packets out over RNS on a live link")
+    registry.describe("link_queue_bytes", "gauge", "Bytes waiting in a live link's outbound queue")
+    registry.describe("link_rtt", "gauge", "Current RTT estimate of a live link in seconds")
+    registry.describe("link_idle_seconds", "gauge", "Seconds since a live link last carried data")
+    registry.describe("link_age_seconds", "gauge", "Seconds since a live link was bridged")
+    registry.describe("receive_buffers", "gauge", "Socket receive buffers the buffer pool has allocated")
+    registry.describe("sessions_resumed", "counter", "Streams moved to a new link after theirs went away")
+    registry.describe("sessions_lost", "counter", "Resumable streams that could not be resumed")
+
+
+def connection_collector(service: str, connections) -> Callable:
+    """
+    Collector for a ConnectionTable: aggregate traffic of the live connections plus
+    one series per live link. Counted totals of closed connections are added with
+    record_closed().
+    """
+    def collect():
+        now = time.time()
+        items = connections.items()
+        yield "links_active", {"service": service}, len(items)
+        for _, state in items:
+            for name, value in (("bytes_in", state.bytes_in), ("bytes_out", state.bytes_out),
+                                ("packets_in", state.packets_in), ("packets_out", state.packets_out)):
+                yield name, {"service": service}, value
+
+            link = {"service": service, "link": link_id(state.link)}
+            yield "link_bytes_in", link, state.bytes_in
+            yield "link_bytes_out", link, state.bytes_out
+            yield "link_packets_in", link, state.packets_in
+            yield "link_packets_out", link, state.packets_out
+            yield "link_queue_bytes", link, len(state.outbound) if state.outbound is not None else 0
+            rtt = getattr(state.link, "rtt", None)
+            if rtt is not None:
+                yield "link_rtt", link, rtt
+            yield "link_idle_seconds", link, now - state.last_activity
+            yield "link_age_seconds", link, now - state.created
+    return collect
+
+
+def record_closed(registry: MetricsRegistry, service: str, state):
+    """Fold a closed connection's traffic into the service counters"""
+    registry.inc("bytes_in", state.bytes_in, service=service)
+    registry.inc("bytes_out", state.bytes_out, service=service)
+    registry.inc("packets_in", state.packets_in, service=service)
+    registry.inc("packets_out", state.packets_out, service=service)
+    registry.observe("connection_duration_seconds", time.time() - state.created, service=service)
+
+
+def link_id(link) -> str:
+    link_hash = getattr(link, "hash", None)
+    return link_hash.hex() if link_hash is not None else "pending"
+
+
+class MetricsServer:
+    """
+    Control socket on localhost. Speaks just enough HTTP for a Prometheus scrape
+    (GET /metrics) or a browser/curl (GET /stats for JSON), and also takes a bare
+    'json' or 'prometheus' line for the --stats CLI view.
+    """
+
+    def __init__(self, registry: MetricsRegistry, port: int, host: str = "127.0.0.1"):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.sock: Optional[socket.socket] = None
+
+    def start(self):
+        try:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind((self.host, self.port))
+            self.sock.listen(8)
+        except OSError as e:
+            logger.warning("Metrics disabled, could not listen on %s:%d: %s", self.host, self.port, e)
+            self.sock = None
+            return
+        threading.Thread(target=self._serve, daemon=True).start()
+        logger.info(f"Metrics on {self.host}:{self.port} (GET /metrics for Prometheus, /stats for JSON)")
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            try:
+                with conn:
+                    conn.settimeout(5)
+                    self._handle(conn)
+            except Exception as e:
+                logger.debug("Metrics request failed: %s", e)
+
+    def _handle(self, conn: socket.socket):
+        request = conn.recv(1024).decode(errors="ignore")
+        first_line = request.split("\n", 1)[0].strip()
+        if first_line.startswith("GET "):
+            path = first_line.split()[1]
+            if path.startswith("/metrics"):
+                body, content_type = self.registry.render_prometheus(), "text/plain; version=0.0.4"
+            else:
+                body, content_type = json.dumps(self.registry.snapshot()), "application/json"
+            body = body.encode()
+            conn.sendall(f"HTTP/1.0 200 OK\r\nContent-Type: {content_type}\r\n"
+                         f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+        elif first_line == "prometheus":
+            conn.sendall(self.registry.render_prometheus().encode())
+        else:
+            conn.sendall(json.dumps(self.registry.snapshot()).encode())
+
+    def stop(self):
+        if self.sock is not None:
+            self.sock.close()
+
+
+def fetch_stats(port: int, host: str = "127.0.0.1") -> dict:
+    """Ask a running bridge's control socket for its metrics"""
+    with socket.create_connection((host, port), timeout=5) as conn:
+        conn.sendall(b"json\n")
+        chunks = []
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            chunks.append(data)
+    return json.loads(b"".join(chunks))
+
+
+def print_stats(port: int, host: str = "127.0.0.1", top: int = 10):
+    """The --stats view: totals per service, then the busiest live links"""
+    stats = fetch_stats(port, host)
+
+    def series(name):
+        return stats.get(name, {}).get("values", [])
+
+    per_service: Dict[str, Dict[str, object]] = {}
+    for name in ("links_active", "links_total", "links_failed", "links_refused", "links_timed_out",
+                 "bytes_in", "bytes_out", "packets_in", "packets_out", "queue_overflows", "pauses_sent"):
+        for sample in series(name):
+            per_service.setdefault(sample["labels"].get("service", "-"), {})[name] = sample["value"]
+
+    print("Services")
+    for service, values in sorted(per_service.items()):
+        print(f"  {service}: " + ", ".join(f"{k}={v}" for k, v in values.items()))
+
+    for name in ("link_establishment_seconds", "link_rtt_seconds", "connection_duration_seconds"):
+        for sample in series(name):
+            histogram = sample["value"]
+            if histogram["count"]:
+                print(f"  {name}[{sample['labels'].get('service', '-')}]: count={histogram['count']} "
+                      f"mean={histogram['sum'] / histogram['count']:.3f}s")
+
+    links: Dict[str, Dict[str, object]] = {}
+    for name in ("link_bytes_in", "link_bytes_out", "link_packets_in", "link_packets_out",
+                 "link_queue_bytes", "link_rtt", "link_idle_seconds", "link_age_seconds"):
+        for sample in series(name):
+            link = links.setdefault(sample["labels"]["link"], {"service": sample["labels"].get("service", "-")})
+            link[name[len("link_"):]] = sample["value"]
+
+    hottest = sorted(links.items(), key=lambda kv: kv[1].get("bytes_in", 0) + kv[1].get("bytes_out", 0), reverse=True)
+    print(f"Links ({len(links)} live, busiest {min(top, len(links))})")
+    for link, values in hottest[:top]:
+        rtt = values.get("rtt")
+        print(f"  {link[:16]} {values['service']}: in={values.get('bytes_in', 0)}B/{values.get('packets_in', 0)}p "
+              f"out={values.get('bytes_out', 0)}B/{values.get('packets_out', 0)}p queue={values.get('queue_bytes', 0)}B "
+              f"rtt={'-' if rtt is None else f'{rtt * 1000:.0f}ms'} idle={values.get('idle_seconds', 0):.0f}s "
+              f"age={values.get('age_seconds', 0):.0f}s")
@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 """
-RNS Server Bridge - Accept incoming Reticulum connections and forward to local TCP/UDP server
+RNS Server Bridge - Accept incoming Reticulum connections and forward to local TCP/UDP server(s)
+
+Either bridge a single target given on the command line, or many targets from a config
+file (--config) sharing one identity, one Reticulum instance and one IO engine.
 """
 
 import RNS
@@ -8,238 +11,1079 @@ import socket
 import threading
 import time
 import argparse
+import configparser
 import logging
 import sys
-from typing import Dict, Optional, Tuple
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler('rns_server_bridge.log')
-    ]
-)
+from collections import OrderedDict, deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+from rns_bridge_common import (ConnectionState, ConnectionTable, FRAME_ACK, FRAME_DATA, FRAME_PAUSE, FRAME_RESUME,
+                               FRAME_SESSION, IOEngine, IdleTracker, OutboundQueue, SESSION_ACCEPTED, SESSION_NEW,
+                               SESSION_RESUME, SESSION_RESUMED, SESSION_UNKNOWN, STREAM_FRAME_HEADER, StreamSession,
+                               TokenBucket, UDP_SESSION_HEADER, link_payload_size, pack_ack_frame, pack_session_frame,
+                               pack_stream_frame, pack_stream_frame_into, pack_udp_frame_into, unpack_ack_frame,
+                               unpack_session_frame, unpack_stream_frame, unpack_udp_frame)
+from rns_bridge_logging import setup_logging, tracer
+from rns_bridge_metrics import (MetricsRegistry, MetricsServer, connection_collector, describe_bridge_metrics,
+                                print_stats, record_closed)
+
 logger = logging.getLogger(__name__)
 
-class ServerBridge:
-    def __init__(self, target_host: str, target_port: int, protocol: str, 
-                 timeout: int = 900, service_name: str = "bridge_service", 
-                 identity_file: str = "./bridge_ident"):
+# Seconds a new link gets to identify itself when per-identity limits are on, links that
+# send data first or stay quiet are admitted as anonymous
+IDENTIFY_TIMEOUT = 2
+# Data a link may send while it waits for admission, buffered and replayed once bridged
+PENDING_BUFFER = 64 * 1024
+
+ADMIT, QUEUE, REFUSE = "admit", "queue", "refuse"
+
+class AdmissionControl:
+    """
+    Decides which new links get bridged, across every service of the daemon: a cap on
+    concurrent links overall, per service and per remote identity, plus a bounded FIFO
+    for links that wait for a slot instead of being refused. Links that did not identify
+    themselves share the allowance of one (anonymous) identity.
+    """
+    
+    def __init__(self, max_links: int = 0, max_links_per_identity: int = 0, queue_size: int = 0,
+                 queue_timeout: int = 30):
         """
-        Initialize the RNS Server Bridge
+        Args:
+            max_links: Maximum concurrent links across every service (0 for no limit)
+            max_links_per_identity: Maximum concurrent links per remote identity (0 for no limit)
+            queue_size: Links that may wait for a free slot, beyond that they are refused
+            queue_timeout: Seconds a link may wait before it is refused
+        """
+        self.max_links = max_links
+        self.max_links_per_identity = max_links_per_identity
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.per_service: Dict[str, int] = {}
+        self.per_identity: Dict[Optional[bytes], int] = {}
+        self.waiting: "OrderedDict[bytes, Tuple[BridgeService, Optional[bytes]]]" = OrderedDict()
+        self.closed = False
+        self.lock = threading.Lock()
+    
+    def _fits(self, service: "BridgeService", identity: Optional[bytes]) -> bool:
+        if self.max_links > 0 and self.active >= self.max_links:
+            return False
+        if service.max_links > 0 and self.per_service.get(service.service_name, 0) >= service.max_links:
+            return False
+        if self.max_links_per_identity > 0 and self.per_identity.get(identity, 0) >= self.max_links_per_identity:
+            return False
+        return True
+    
+    def _take(self, service: "BridgeService", identity: Optional[bytes]):
+        self.active += 1
+        self.per_service[service.service_name] = self.per_service.get(service.service_name, 0) + 1
+        self.per_identity[identity] = self.per_identity.get(identity, 0) + 1
+    
+    def request(self, service: "BridgeService", link_hash: bytes, identity: Optional[bytes]) -> str:
+        """ADMIT (a slot is taken), QUEUE (wait for release() to hand one over) or REFUSE"""
+        with self.lock:
+            # every release hands slots to fitting waiters first, so a newcomer that fits
+            # is not jumping ahead of anyone
+            if self._fits(service, identity):
+                self._take(service, identity)
+                return ADMIT
+            if len(self.waiting) < self.queue_size:
+                self.waiting[link_hash] = (service, identity)
+                return QUEUE
+            return REFUSE
+    
+    def release(self, service: "BridgeService", identity: Optional[bytes]) -> List[Tuple["BridgeService", bytes]]:
+        """Give a slot back, returns the waiting links that were admitted in its place"""
+        admitted = []
+        with self.lock:
+            self.active -= 1
+            self.per_service[service.service_name] -= 1
+            self.per_identity[identity] -= 1
+            if not self.per_identity[identity]:
+                del self.per_identity[identity]
+            if self.closed:
+                return admitted
+            for link_hash, (waiting_service, waiting_identity) in list(self.waiting.items()):
+                if self._fits(waiting_service, waiting_identity):
+                    del self.waiting[link_hash]
+                    self._take(waiting_service, waiting_identity)
+                    admitted.append((waiting_service, link_hash))
+        return admitted
+    
+    def cancel(self, link_hash: bytes) -> bool:
+        """Stop waiting, returns False if the link was not (or no longer) waiting"""
+        with self.lock:
+            return self.waiting.pop(link_hash, None) is not None
+    
+    def close(self):
+        """Admit nothing anymore, for shutdown"""
+        with self.lock:
+            self.closed = True
+            self.queue_size = 0
+            self.waiting.clear()
+
+class PendingLink:
+    """A link that is established but not bridged yet, waiting to identify or for a slot"""
+    __slots__ = ("link", "identity", "session", "stage", "deadline", "frames", "buffered", "paused", "lock")
+    
+    IDENTIFY, QUEUED, BRIDGED, CLOSED = range(4)
+    
+    def __init__(self, link: RNS.Link):
+        self.link = link
+        self.identity: Optional[bytes] = None
+        self.session: Optional[bytes] = None  # token of the new session the link asked for
+        self.stage = PendingLink.IDENTIFY
+        self.deadline = 0.0
+        self.frames: List[bytes] = []
+        self.buffered = 0
+        self.paused = False
+        # held while the link changes stage, so packets arriving meanwhile keep their order
+        self.lock = threading.RLock()
+
+class UpstreamPool:
+    """
+    Warm TCP connections to one target, for request/response services such as HTTP with
+    keep-alive. A connection goes back to the pool when its link closes after the target
+    answered the last request and stayed quiet for quiet_grace seconds, with nothing left
+    unread on it, and is checked again before it is handed to the next link.
+    """
+    
+    def __init__(self, target: Tuple[str, int], size: int, idle_timeout: float = 60, quiet_grace: float = 0.5):
+        """
+        Args:
+            target: (host, port) of the target server
+            size: Maximum idle connections kept
+            idle_timeout: Seconds an idle connection is kept, keep this below the target's keep-alive timeout
+            quiet_grace: Seconds the target must have been quiet after its last response
+        """
+        self.target = target
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.quiet_grace = quiet_grace
+        # most recently used on the right, handed out first, the oldest expire from the left
+        self.idle: Deque[Tuple[socket.socket, float]] = deque()
+        self.lock = threading.Lock()
+    
+    def connect(self) -> socket.socket:
+        """Open a new connection to the target"""
+        target_socket = socket.create_connection(self.target)
+        target_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        return target_socket
+    
+    def acquire(self) -> Optional[socket.socket]:
+        """A healthy idle connection, or None if there is none"""
+        while True:
+            with self.lock:
+                if not self.idle:
+                    return None
+                target_socket, _ = self.idle.pop()
+            if self._healthy(target_socket):
+                return target_socket
+            self._close(target_socket)
+    
+    def release_delay(self, last_request: float, last_response: float) -> Optional[float]:
+        """
+        Seconds to wait before release() of a connection whose link last sent a request at
+        last_request and got a response at last_response, None if it must be closed instead
+        """
+        if last_response <= last_request:
+            # the response to the last request may still be on its way, the next link would get it
+            return None
+        return max(0.0, last_response + self.quiet_grace - time.time())
+    
+    def release(self, target_socket: socket.socket) -> bool:
+        """Keep a connection for reuse, returns False if the caller should close it instead"""
+        if not self._healthy(target_socket):
+            return False
+        with self.lock:
+            if len(self.idle) >= self.size:
+                return False
+            self.idle.append((target_socket, time.time()))
+        return True
+    
+    def expire(self):
+        """Close connections that have been idle for longer than idle_timeout"""
+        cutoff = time.time() - self.idle_timeout
+        while True:
+            with self.lock:
+                if not self.idle or self.idle[0][1] > cutoff:
+                    return
+                target_socket, _ = self.idle.popleft()
+            self._close(target_socket)
+    
+    def close(self):
+        """Close every idle connection"""
+        with self.lock:
+            idle, self.idle = self.idle, deque()
+        for target_socket, _ in idle:
+            self._close(target_socket)
+    
+    @staticmethod
+    def _healthy(target_socket: socket.socket) -> bool:
+        """Open and with nothing unread, anything else is not safe to hand to another link"""
+        try:
+            target_socket.recv(1, socket.MSG_PEEK)
+        except BlockingIOError:
+            # the socket is non-blocking, would-block means connected and quiet
+            return True
+        except OSError:
+            return False
+        # either EOF (the target hung up) or leftovers of the previous link's response
+        return False
+    
+    @staticmethod
+    def _close(target_socket: socket.socket):
+        try:
+            target_socket.close()
+        except OSError:
+            pass
+    
+    def __len__(self):
+        return len(self.idle)
+
+class UdpTargetSessions:
+    """
+    Server side of UDP session multiplexing. Every session id on a link gets its own
+    UDP socket towards the target, so the target's replies can be routed back to the
+    client that sent the request.
+    """
+    
+    def __init__(self, target_host: str, target_port: int, timeout: float, engine: IOEngine,
+                 on_reply: Callable[[int, memoryview], None]):
+        self.target = (target_host, target_port)
+        self.sockets: Dict[int, socket.socket] = {}
+        self.idle = IdleTracker(timeout)
+        self.engine = engine
+        self.on_reply = on_reply
+        self.lock = threading.Lock()
+    
+    def send(self, session_id: int, data: bytes):
+        """Send a datagram to the target on behalf of a session"""
+        target_socket = self.sockets.get(session_id)
+        if target_socket is None:
+            with self.lock:
+                target_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                target_socket.setblocking(False)
+                # connected UDP socket, so we only ever hear back from the target
+                target_socket.connect(self.target)
+                self.sockets[session_id] = target_socket
+                self.engine.register(target_socket, lambda sock, session_id=session_id: self._readable(session_id, sock))
+        self.idle.touch(session_id)
+        target_socket.send(data)
+    
+    def _readable(self, session_id: int, target_socket: socket.socket):
+        buf = self.engine.buffers.acquire()
+        try:
+            length = target_socket.recv_into(memoryview(buf)[UDP_SESSION_HEADER.size:], 4096)
+        except (BlockingIOError, ConnectionRefusedError):
+            self.engine.buffers.release(buf)
+            return
+        self.idle.touch(session_id)
+        try:
+            self.on_reply(session_id, pack_udp_frame_into(buf, session_id, length))
+        finally:
+            self.engine.buffers.release(buf)
+    
+    def expire(self) -> List[int]:
+        """Close the sockets of idle sessions, returns the expired session ids"""
+        expired = self.idle.expire()
+        for session_id in expired:
+            self._close_session(session_id)
+        return expired
+    
+    def _close_session(self, session_id: int):
+        with self.lock:
+            target_socket = self.sockets.pop(session_id, None)
+            if target_socket is not None:
+                self.engine.unregister(target_socket)
+                try:
+                    target_socket.close()
+                except:
+                    pass
+    
+    def close(self):
+        """Close every session socket"""
+        for session_id in list(self.sockets.keys()):
+            self._close_session(session_id)
+
+class BridgeService:
+    def __init__(self, service_name: str, target_host: str, target_port: int, protocol: str,
+                 timeout: int = 900, udp_session_timeout: int = 120, max_links: int = 0,
+                 rate_limit: int = 0, link_rate_limit: int = 0, pool_size: int = 0,
+                 pool_idle_timeout: int = 60, session_timeout: int = 0):
+        """
+        One forwarded target: an RNS destination under the shared identity and the
+        TCP/UDP server its links are bridged to
         
         Args:
+            service_name: RNS service name (the destination aspect)
             target_host: Local TCP/UDP server IP to forward to
             target_port: Local TCP/UDP server port to forward to
             protocol: 'tcp' or 'udp'
             timeout: Connection timeout in seconds (default: 15 minutes)
-            service_name: RNS service name
-            identity_file: Path to identity file (default: ./bridge_ident)
+            udp_session_timeout: Idle seconds before a UDP session's socket is closed
+            max_links: Maximum concurrent links for this service (0 for no limit)
+            rate_limit: Bytes per second this service may send over RNS, all links together (0 for no limit)
+            link_rate_limit: Bytes per second each link may send over RNS (0 for no limit)
+            pool_size: TCP only, idle target connections kept for reuse by later links (0 to disable),
+                       for request/response targets with keep-alive, e.g. HTTP
+            pool_idle_timeout: Seconds an idle pooled connection is kept
+            session_timeout: TCP only, seconds the target connection of a dropped link is kept for the
+                             client to resume the stream on a new link (0 to disable), for clients
+                             run with --resume-timeout
         """
+        self.service_name = service_name
         self.target_host = target_host
         self.target_port = target_port
         self.protocol = protocol.lower()
         self.timeout = timeout
-        self.service_name = service_name
-        self.identity_file = identity_file
-        
-        # Track active connections: RNS link -> (socket, last_activity)
-        self.connections: Dict[RNS.Link, Tuple[socket.socket, float]] = {}
-        self.connection_lock = threading.Lock()
-        
-        # Initialize RNS
-        RNS.Reticulum()
+        self.udp_session_timeout = udp_session_timeout
+        self.max_links = max_links
+        self.link_rate_limit = link_rate_limit
+        self.bucket = TokenBucket(rate_limit) if rate_limit > 0 else None
+        self.pool: Optional[UpstreamPool] = None
+        if pool_size > 0 and self.protocol == 'tcp':
+            self.pool = UpstreamPool((target_host, target_port), pool_size, pool_idle_timeout)
+        self.session_timeout = session_timeout
+        self.resumable = session_timeout > 0 and self.protocol == 'tcp'
         
-        # Load or create persistent identity
-        self.identity = self._load_or_create_identity()
-        logger.info(f"Using identity: {RNS.prettyhexrep(self.identity.hash)}")
+        # Track active connections: RNS link hash -> state holding the socket or UDP sessions
+        self.connections = ConnectionTable(timeout)
+        # Links waiting to identify or for admission: RNS link hash -> PendingLink
+        self.pending: Dict[bytes, PendingLink] = {}
+        # Resumable streams, bridged or waiting for a new link: session token -> state
+        self.sessions: Dict[bytes, ConnectionState] = {}
         
-        # Create destination
+        self.destination: Optional[RNS.Destination] = None
+        self.engine: Optional[IOEngine] = None
+        self.metrics: Optional[MetricsRegistry] = None
+        self.admission: Optional[AdmissionControl] = None
+    
+    def attach(self, identity: RNS.Identity, engine: IOEngine, metrics: MetricsRegistry,
+               admission: AdmissionControl):
+        """Register this service's destination under the shared identity"""
+        self.engine = engine
+        self.metrics = metrics
+        self.admission = admission
+        # live links are read at scrape time, closed ones are folded in by record_closed()
+        self.metrics.add_collector(connection_collector(self.service_name, self.connections))
+        self.metrics.add_collector(lambda: [("links_waiting", {"service": self.service_name}, len(self.pending))])
+        if self.pool is not None:
+            self.metrics.add_collector(lambda: [("pool_idle", {"service": self.service_name}, len(self.pool))])
+        if self.resumable:
+            self.metrics.add_collector(lambda: [("sessions_detached", {"service": self.service_name},
+                                                 sum(1 for state in list(self.sessions.values())
+                                                     if state.session.detached_at is not None))])
         self.destination = RNS.Destination(
-            self.identity,
+            identity,
             RNS.Destination.IN,
             RNS.Destination.SINGLE,
             "bridge",
-            service_name
+            self.service_name
         )
         
         # Set link established callback
         self.destination.set_link_established_callback(self.client_connected)
         
-        # Start cleanup thread
-        self.cleanup_thread = threading.Thread(target=self._cleanup_connections, daemon=True)
-        self.cleanup_thread.start()
+        logger.info(f"Service {self.service_name}: {self.protocol.upper()} {self.target_host}:{self.target_port} "
+                    f"at {RNS.prettyhexrep(self.destination.hash)}")
+    
+    def client_connected(self, link: RNS.Link):
+        """Handle new RNS client connections"""
+        logger.info(f"New RNS client connected to {self.service_name}: {link}")
         
-        logger.info(f"Server bridge initialized")
-        logger.info(f"Target: {protocol.upper()} {target_host}:{target_port}")
-        logger.info(f"RNS Destination: {RNS.prettyhexrep(self.destination.hash)}")
-        logger.info(f"Identity file: {identity_file}")
-        logger.info(f"Timeout: {timeout} seconds")
+        # nothing is opened towards the target until the link has been admitted
+        pending = PendingLink(link)
+        self.pending[link.hash] = pending
+        link.set_packet_callback(lambda data, packet, link=link: self.rns_data_received(data, packet, link))
+        link.set_link_closed_callback(self._cleanup_connection)
+        
+        with pending.lock:
+            if self.admission.max_links_per_identity > 0:
+                # identifying clients do so right after the link comes up, before any data
+                pending.deadline = time.time() + IDENTIFY_TIMEOUT
+                link.set_remote_identified_callback(self._identified)
+            else:
+                # a session request, if one comes, finds the link bridged already
+                self._request_admission(pending, None)
 
+    def _identified(self, link: RNS.Link, identity: RNS.Identity):
+        pending = self.pending.get(link.hash)
+        if pending is not None:
+            with pending.lock:
+                if pending.stage == PendingLink.IDENTIFY:
+                    pending.identity = identity.hash
+                    self._request_admission(pending, pending.identity)
 
-    def _load_or_create_identity(self) -> RNS.Identity:
-        """Load existing identity or create a new one"""
+    def _session_requested(self, pending: PendingLink, data: bytes):
+        """A FRAME_SESSION from a link that is not bridged yet, called with pending.lock held"""
         try:
-            # Try to load existing identity
-            identity = RNS.Identity.from_file(self.identity_file)
-            if identity is None:
-                raise RuntimeError("IDent is none :( )")
-            logger.info(f"Loaded existing identity from {self.identity_file}")
-            return identity
-        except Exception as e:
-            logger.warning(f"Could not load identity from {self.identity_file}: {e}")
+            token, kind, offset = unpack_session_frame(data[STREAM_FRAME_HEADER:])
+        except ValueError as e:
+            self._refuse(pending, str(e))
+            return
+        if kind == SESSION_NEW:
+            # attached once the link is bridged
+            pending.session = token
+        elif kind == SESSION_RESUME:
+            self._resume(pending, token, offset)
+        else:
+            self._refuse(pending, f"unexpected session request {kind}")
+
+    def _resume(self, pending: PendingLink, token: bytes, offset: int):
+        """Move a session's stream onto a new link, called with pending.lock held"""
+        link = pending.link
+        state = self.sessions.get(token)
+        remote = link.get_remote_identity()
+        # the token is the secret, but a session that identified stays with its identity
+        if state is None or (state.identity is not None and (remote is None or remote.hash != state.identity)):
+            RNS.Packet(link, pack_session_frame(token, SESSION_UNKNOWN, 0)).send()
+            self.metrics.inc("sessions_lost", service=self.service_name)
+            self._refuse(pending, "asked to resume an unknown session")
+            return
         
-        # Create new identity if loading failed or file doesn't exist
-        logger.info(f"Creating new identity and saving to {self.identity_file}")
-        identity = RNS.Identity()
+        if state.session.detached_at is None:
+            # the client noticed the old link is gone before we did
+            old_link = state.link
+            self.connections.remove(old_link.hash)
+            self._detach(state)
+            old_link.teardown()
         
-        try:
-            identity.to_file(self.identity_file)
-            logger.info(f"Saved new identity to {self.identity_file}")
-        except Exception as e:
-            logger.error(f"Failed to save identity to {self.identity_file}: {e}")
-            logger.warning("Identity will not persist across restarts")
+        frames = state.session.replay_from(offset)
+        if frames is None:
+            self.sessions.pop(token, None)
+            self._close_state(state)
+            RNS.Packet(link, pack_session_frame(token, SESSION_UNKNOWN, 0)).send()
+            self.metrics.inc("sessions_lost", service=self.service_name)
+            self._refuse(pending, f"can't resume from stream offset {offset}")
+            return
         
-        return identity
-    
-    def client_connected(self, link: RNS.Link):
-        """Handle new RNS client connections"""
-        logger.info(f"New RNS client connected: {link}")
+        pending.stage = PendingLink.BRIDGED
+        self.pending.pop(link.hash, None)
+        state.link = link
+        state.session.detached_at = None
+        RNS.Packet(link, pack_session_frame(token, SESSION_RESUMED, state.session.received)).send()
+        for frame in frames:
+            RNS.Packet(link, frame).send()
+            state.sent(len(frame))
+        self.connections.add(link.hash, state)
+        for frame in pending.frames:
+            self._forward(state, link, frame)
+        pending.frames = []
         
+        # a RESUME sent while the old link was dying may never have arrived
+        if not state.outbound.paused:
+            self._send_control(link, FRAME_RESUME)
+        self._resume_target(link)
+        self.metrics.inc("sessions_resumed", service=self.service_name)
+        logger.info(f"Resumed session on {link}, replayed {len(frames)} packets")
+
+    def _request_admission(self, pending: PendingLink, identity: Optional[bytes]):
+        """Bridge, queue or refuse a pending link, called with pending.lock held"""
+        link = pending.link
+        pending.identity = identity
+        decision = self.admission.request(self, link.hash, identity)
+        if decision == ADMIT:
+            self._bridge(pending)
+        elif decision == QUEUE:
+            pending.stage = PendingLink.QUEUED
+            pending.deadline = time.time() + self.admission.queue_timeout
+            if self.protocol == 'tcp':
+                # hold the client off instead of letting it fill the pending buffer
+                pending.paused = True
+                self._send_control(link, FRAME_PAUSE)
+            logger.info(f"No free slot for {link} on {self.service_name}, queued")
+        else:
+            self._refuse(pending, "no free slot and the queue is full")
+
+    def _refuse(self, pending: PendingLink, reason: str):
+        pending.stage = PendingLink.CLOSED
+        self.pending.pop(pending.link.hash, None)
+        self.metrics.inc("links_refused", service=self.service_name)
+        logger.warning(f"Refusing {pending.link} on {self.service_name}: {reason}")
+        pending.link.teardown()
+
+    def _admitted(self, link_hash: bytes):
+        """A queued link got a slot handed over by AdmissionControl.release()"""
+        pending = self.pending.get(link_hash)
+        if pending is not None:
+            with pending.lock:
+                if pending.stage == PendingLink.QUEUED:
+                    self._bridge(pending)
+                    return
+        # the link went away while the slot was handed over, pass it on
+        identity = pending.identity if pending is not None else None
+        self._release(identity)
+
+    def _release(self, identity: Optional[bytes]):
+        for service, link_hash in self.admission.release(self, identity):
+            service._admitted(link_hash)
+
+    def _bridge(self, pending: PendingLink):
+        """Connect an admitted link to the target, called with pending.lock held"""
+        link = pending.link
         try:
             # Create socket to target server
             if self.protocol == 'tcp':
-                target_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                target_socket.connect((self.target_host, self.target_port))
+                target_socket = self._connect_target()
+                # from here on the IO engine reads and writes it, never block it
+                target_socket.setblocking(False)
             else:  # UDP
-                target_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                # For UDP, we don't connect but store the target address
+                # one socket per client session, created as the sessions show up
+                target_socket = UdpTargetSessions(
+                    self.target_host, self.target_port, self.udp_session_timeout, self.engine,
+                    lambda session_id, frame, link=link: self._udp_reply(link, session_id, frame)
+                )
+            
+            state = ConnectionState(link, target_socket)
+            state.identity = pending.identity
+            if self.link_rate_limit > 0:
+                state.bucket = TokenBucket(self.link_rate_limit)
+            if self.protocol == 'tcp':
+                # the state's link, a resumed stream moves to a new one
+                state.outbound = OutboundQueue(
+                    target_socket, self.engine,
+                    on_pause=lambda: self._send_control(state.link, FRAME_PAUSE),
+                    on_resume=lambda: self._send_control(state.link, FRAME_RESUME)
+                )
+            
+            # whatever the client sent while it waited goes first, newer packets block on
+            # pending.lock until the connection is in the table
+            for frame in pending.frames:
+                self._forward(state, link, frame)
+            pending.frames = []
             
             # Store connection
-            with self.connection_lock:
-                self.connections[link.hash] = (target_socket, time.time())
+            self.connections.add(link.hash, state)
+            pending.stage = PendingLink.BRIDGED
+            self.pending.pop(link.hash, None)
+            self.metrics.inc("links_total", service=self.service_name)
             
-            # Set packet callback for this link
-            link.set_packet_callback(lambda data, packet, link=link: self.rns_data_received(data, packet, link))
+            if pending.session is not None:
+                # nothing is read from the target yet, every data frame comes after ACCEPTED
+                self._attach_session(state, pending.session)
             
-            # Start thread to handle data from target socket
-            socket_thread = threading.Thread(
-                target=self._handle_target_socket,
-                args=(link, target_socket),
-                daemon=True
-            )
-            socket_thread.start()
+            # Let the shared IO engine handle data from the target socket
+            if self.protocol == 'tcp':
+                if state.peer_resumed.is_set():
+                    self._read_target(link, target_socket)
+                if pending.paused:
+                    self._send_control(link, FRAME_RESUME)
             
             logger.info(f"Established bridge for client {link}")
             
         except Exception as e:
             logger.error(f"Failed to establish bridge for client: {e}")
+            self.metrics.inc("links_failed", service=self.service_name)
+            pending.stage = PendingLink.CLOSED
+            self.pending.pop(link.hash, None)
+            self._release(pending.identity)
             link.teardown()
 
     def rns_data_received(self, data: bytes, packet, link: RNS.Link):
         """Handle data received from RNS client"""
+        state = self.connections.get(link.hash)
+        if state is None:
+            pending = self.pending.get(link.hash)
+            if pending is None:
+                logger.error(f"Recv Data from unknown link! {link}")
+                return
+            with pending.lock:
+                if (pending.stage in (PendingLink.IDENTIFY, PendingLink.QUEUED) and self.resumable
+                        and data[:1] == bytes((FRAME_SESSION,))):
+                    self._session_requested(pending, data)
+                    return
+                if pending.stage != PendingLink.BRIDGED:
+                    self._buffer_pending(pending, data)
+                    return
+            state = self.connections.get(link.hash)
+            if state is None:
+                return
+        
         try:
-            print("Data recv:", data, "     ", link)
-            with self.connection_lock:
-                if link.hash in  self.connections:
-                    target_socket, _ = self.connections[link.hash]
-                    # Update last activity
-                    self.connections[link.hash] = (target_socket, time.time())
-                    
-                    if self.protocol == 'tcp':
-                        target_socket.send(data)
-                    else:  # UDP
-                        target_socket.sendto(data, (self.target_host, self.target_port))
-                    
-                    logger.debug(f"Forwarded {len(data)} bytes from RNS to target")
-                else:
-                    logger.error(f"Recv Data from unknown link! {link}")
-                    
+            self._forward(state, link, data)
         except Exception as e:
             logger.error(f"Error forwarding RNS data to target: {e}")
-            self._cleanup_connection(link)
+            self._close_link(link)
+
+    def _buffer_pending(self, pending: PendingLink, data: bytes):
+        """Keep data from a link that is not bridged yet, called with pending.lock held"""
+        if pending.stage == PendingLink.CLOSED:
+            return
+        if pending.buffered + len(data) > PENDING_BUFFER:
+            if self.protocol == 'tcp':
+                self._refuse(pending, "sent too much data while waiting for admission")
+            # UDP datagrams beyond the buffer are simply lost
+            return
+        pending.frames.append(data)
+        pending.buffered += len(data)
+        if pending.stage == PendingLink.IDENTIFY:
+            # data before an identity (or a session request) means the client is not going to send one
+            self._request_admission(pending, pending.identity)
+
+    def _forward(self, state: ConnectionState, link: RNS.Link, data: bytes):
+        """Hand one packet from the RNS client to the target"""
+        if self.protocol == 'tcp':
+            frame_type, data = unpack_stream_frame(data)
+            if frame_type == FRAME_PAUSE:
+                # client can't keep up, stop reading so the target feels TCP backpressure
+                state.peer_resumed.clear()
+                self.engine.register(state.sock, None)
+                return
+            elif frame_type == FRAME_RESUME:
+                state.peer_resumed.set()
+                self._resume_target(link)
+                return
+            elif frame_type == FRAME_ACK:
+                if state.session is not None and state.session.ack(unpack_ack_frame(data)):
+                    self._resume_target(link)
+                return
+            elif frame_type == FRAME_SESSION:
+                self._bridged_session_request(state, link, data)
+                return
+            
+            # queued, the IO engine writes it once the target socket has room
+            if not state.outbound.put(data):
+                self.metrics.inc("queue_overflows", service=self.service_name)
+                raise RuntimeError(f"outbound queue overflow ({len(state.outbound)} bytes queued)")
+            if state.session is not None:
+                offset = state.session.received_data(len(data))
+                if offset is not None:
+                    RNS.Packet(link, pack_ack_frame(offset)).send()
+        else:  # UDP
+            session_id, datagram = unpack_udp_frame(data)
+            state.sock.send(session_id, datagram)
+        
+        # Update last activity
+        state.received(len(data))
+        tracer.trace("rns->target", link, data)
+
+    def _read_target(self, link: RNS.Link, target_socket: socket.socket):
+        """(Re)start reading the target socket on the IO engine"""
+        self.engine.register(target_socket, lambda sock, link=link: self._target_readable(link, sock))
+
+    def _send_control(self, link: RNS.Link, frame_type: int):
+        """Send a PAUSE/RESUME frame to the client"""
+        if link.status == RNS.Link.ACTIVE:
+            RNS.Packet(link, pack_stream_frame(frame_type)).send()
+            if frame_type == FRAME_PAUSE:
+                self.metrics.inc("pauses_sent", service=self.service_name)
 
-    def _handle_target_socket(self, link: RNS.Link, target_socket: socket.socket):
+    def _read_size(self, link: RNS.Link, state: Optional[ConnectionState]) -> int:
+        """One packet's worth, but never more than a rate limit's bucket holds"""
+        size = link_payload_size(link)
+        if state is not None and state.bucket is not None:
+            size = min(size, int(state.bucket.burst))
+        if self.bucket is not None:
+            size = min(size, int(self.bucket.burst))
+        return size
+
+    def _rate_limit_delay(self, state: ConnectionState) -> float:
+        """Seconds until the link and the service may send over RNS again"""
+        delay = state.bucket.delay() if state.bucket is not None else 0.0
+        if self.bucket is not None:
+            delay = max(delay, self.bucket.delay())
+        return delay
+
+    def _bridged_session_request(self, state: ConnectionState, link: RNS.Link, data: bytes):
+        """
+        A FRAME_SESSION on a bridged link. Links are bridged as soon as they come up, a client
+        asks for its session right after that, before sending any data.
+        """
+        try:
+            token, kind, offset = unpack_session_frame(data)
+        except ValueError as e:
+            logger.warning(f"Bad session request on {link}: {e}")
+            return
+        if not self.resumable or state.session is not None or state.bytes_in > 0:
+            logger.warning(f"Ignoring a session request on bridged link {link}")
+            return
+        if kind == SESSION_NEW:
+            # on the engine thread, which sends the target's data, so every data frame after
+            # ACCEPTED is kept for a replay
+            self.engine.call_later(0, lambda: self._attach_session(state, token))
+        elif kind == SESSION_RESUME:
+            # the link got a fresh target connection before it asked, the client drops whatever
+            # came from it
+            self._discard_fresh(state)
+            pending = PendingLink(link)
+            pending.identity = state.identity
+            with pending.lock:
+                self._resume(pending, token, offset)
+        else:
+            logger.warning(f"Ignoring session request {kind} on {link}")
+
+    def _attach_session(self, state: ConnectionState, token: bytes):
+        """Make a bridged stream resumable, the client counts the stream from ACCEPTED on"""
+        if self.connections.get(state.link.hash) is not state:
+            return
+        state.session = StreamSession(token)
+        self.sessions[token] = state
+        RNS.Packet(state.link, pack_session_frame(token, SESSION_ACCEPTED, 0)).send()
+
+    def _discard_fresh(self, state: ConnectionState):
+        """Drop the target connection of a link that turns out to resume another stream"""
+        self.connections.remove(state.link.hash)
+        if state.outbound is not None:
+            state.outbound.close()
+        # not pooled, the target may have started talking to it
+        self._close_socket(state.sock)
+        self._release(state.identity)
+
+    def _target_readable(self, link: RNS.Link, target_socket: socket.socket):
         """Handle data from target socket back to RNS"""
+        state = self.connections.get(link.hash)
+        if state is None:
+            # closed, or detached from its link, already
+            self.engine.register(target_socket, None)
+            return
+        if state.session is not None and link.status != RNS.Link.ACTIVE:
+            # the target's data waits for the link the stream is resumed on
+            self._cleanup_connection(link)
+            return
+        delay = self._rate_limit_delay(state)
+        if delay > 0:
+            # over the rate, leave the data with the target until the buckets refill
+            self.metrics.inc("rate_limited", service=self.service_name)
+            self.engine.register(target_socket, None)
+            self.engine.call_later(delay, lambda: self._resume_target(link))
+            return
+        if state.session is not None and not state.session.window_open.is_set():
+            # the client is a window behind on acknowledging, its ACK restarts reading
+            self.engine.register(target_socket, None)
+            if state.session.window_open.is_set():
+                self._read_target(link, target_socket)
+            return
+        
+        buf = self.engine.buffers.acquire()
         try:
-            target_socket.settimeout(10.0)  # Non-blocking with timeout
+            payload = memoryview(buf)[STREAM_FRAME_HEADER:]
+            try:
+                length = target_socket.recv_into(payload, min(self._read_size(link, state), len(payload)))
+            except BlockingIOError:
+                return
+            except Exception as e:
+                logger.error(f"Error receiving from target socket: {e}")
+                length = 0
             
-            while link.status == RNS.Link.ACTIVE:
-                try:
-                    if self.protocol == 'tcp':
-                        data = target_socket.recv(4096)
-                        if not data:
-                            continue
-                    else:  # UDP
-                        data, _ = target_socket.recvfrom(4096)
-                    
-                    # Send data back over RNS
-                    print("Data send:", data, "     ", link)
-                    packet = RNS.Packet(link, data)
-                    packet.send()
-                    
-                    # Update last activity
-                    with self.connection_lock:
-                        if link.hash in  self.connections:
-                            self.connections[link.hash] = (target_socket, time.time())
-                    
-                    logger.debug(f"Forwarded {len(data)} bytes from target to RNS")
-                    
-                except socket.timeout:
-                    continue
-                except Exception as e:
-                    logger.error(f"Error receiving from target socket: {e}")
-                    break
-                    
-        except Exception as e:
-            logger.error(f"Error in target socket handler: {e}")
+            if not length or link.status != RNS.Link.ACTIVE:
+                # target hung up (or the link is gone), tear the bridge down
+                self._close_link(link)
+                return
+            
+            # Send data back over RNS
+            self._send_to_link(link, pack_stream_frame_into(buf, FRAME_DATA, length))
+            tracer.trace("target->rns", link, payload[:length])
         finally:
+            self.engine.buffers.release(buf)
+
+    def _resume_target(self, link: RNS.Link):
+        state = self.connections.get(link.hash)
+        # a PAUSE from the client (or a full replay window) wins, its RESUME (or ACK) restarts reading
+        if state is None or not state.peer_resumed.is_set():
+            return
+        if state.session is None or state.session.window_open.is_set():
+            self._read_target(link, state.sock)
+
+    def _udp_reply(self, link: RNS.Link, session_id: int, frame: memoryview):
+        """Handle a reply from the target for one UDP session on a link, frame is already packed"""
+        if link.status != RNS.Link.ACTIVE:
             self._cleanup_connection(link)
+            return
+        state = self.connections.get(link.hash)
+        if state is not None and self._rate_limit_delay(state) > 0:
+            self.metrics.inc("rate_limited", service=self.service_name)
+            return
+        self._send_to_link(link, frame)
+        tracer.trace("target->rns", link, frame[UDP_SESSION_HEADER.size:])
+
+    def _send_to_link(self, link: RNS.Link, data: memoryview):
+        # data is usually a pooled buffer, the packet keeps its data for resends so it gets a copy
+        data = bytes(data)
+        state = self.connections.get(link.hash)
+        if state is not None and state.session is not None:
+            # kept for a replay until the client acknowledges it
+            state.session.sent_frame(data)
+        packet = RNS.Packet(link, data)
+        packet.send()
+        
+        # Update last activity
+        if state is not None:
+            state.sent(len(data))
+            if state.bucket is not None:
+                state.bucket.take(len(data))
+        if self.bucket is not None:
+            self.bucket.take(len(data))
 
     def _cleanup_connection(self, link: RNS.Link):
         """Clean up a specific connection"""
-        with self.connection_lock:
-            if link.hash in  self.connections:
-                target_socket, _ = self.connections[link.hash]
-                try:
-                    target_socket.close()
-                except:
-                    pass
-                del self.connections[link.hash]
-                logger.info(f"Cleaned up connection for {link}")
+        pending = self.pending.pop(link.hash, None)
+        if pending is not None:
+            with pending.lock:
+                stage, pending.stage = pending.stage, PendingLink.CLOSED
+            # a queued link that was just handed a slot is released by _admitted()
+            if stage == PendingLink.QUEUED:
+                self.admission.cancel(link.hash)
+        
+        state = self.connections.remove(link.hash)
+        if state is not None:
+            if state.session is not None and self.sessions.get(state.session.token) is state:
+                if getattr(link, "teardown_reason", None) != RNS.Link.INITIATOR_CLOSED:
+                    self._detach(state)
+                    return
+                # the client closed the stream itself
+                self._end_session(state)
+            self._close_state(state)
+            logger.info(f"Cleaned up connection for {link}")
+
+    def _close_link(self, link: RNS.Link):
+        """Tear a bridged link down for good, its stream can't be resumed"""
+        state = self.connections.get(link.hash)
+        if state is not None:
+            self._end_session(state)
+        link.teardown()
+        self._cleanup_connection(link)
 
-    def _cleanup_connections(self):
-        """Periodic cleanup of inactive connections"""
+    def _end_session(self, state: ConnectionState):
+        if state.session is not None:
+            self.sessions.pop(state.session.token, None)
+
+    def _detach(self, state: ConnectionState):
+        """The link of a resumable stream went away, keep the target connection for the next link"""
+        # the target feels backpressure until then, what's queued for it still goes out
+        self.engine.register(state.sock, None)
+        state.session.detached_at = time.time()
+        logger.info(f"Link {state.link} went away, keeping its session for {self.session_timeout}s")
+
+    def _close_state(self, state: ConnectionState):
+        if state.outbound is not None:
+            # stop reading but let the target have whatever the client already sent
+            self.engine.register(state.sock, None)
+            state.outbound.finish(lambda: self._release_socket(state))
+        else:
+            self._close_socket(state.sock)
+        # fold the link's traffic into the service totals
+        record_closed(self.metrics, self.service_name, state)
+        rtt = getattr(state.link, "rtt", None)
+        if rtt is not None:
+            self.metrics.observe("link_rtt_seconds", rtt, service=self.service_name)
+        self._release(state.identity)
+
+    def _connect_target(self) -> socket.socket:
+        """A warm pooled connection to the target if there is one, a new one otherwise"""
+        if self.pool is None:
+            return socket.create_connection((self.target_host, self.target_port))
+        target_socket = self.pool.acquire()
+        if target_socket is not None:
+            self.metrics.inc("pool_hits", service=self.service_name)
+            return target_socket
+        self.metrics.inc("pool_misses", service=self.service_name)
+        return self.pool.connect()
+
+    def _release_socket(self, state: ConnectionState):
+        """Return a TCP target connection to the pool, or close it"""
+        target_socket = state.sock
+        if self.pool is not None:
+            # the client's requests came in over RNS, the target's responses went out
+            delay = self.pool.release_delay(state.last_in, state.last_out)
+            if delay is not None and delay > 0:
+                # a late response shows up as unread data when it's checked again
+                self.engine.call_later(delay, lambda: self._release_socket(state))
+                return
+            self.engine.unregister(target_socket)
+            if delay is not None and self.pool.release(target_socket):
+                return
+        self._close_socket(target_socket)
+
+    def _close_socket(self, target_socket):
+        if isinstance(target_socket, socket.socket):
+            self.engine.unregister(target_socket)
+        try:
+            target_socket.close()
+        except:
+            pass
+
+    def expire_idle(self):
+        """Tear down idle connections, expire idle UDP sessions and time out pending links"""
+        for _, state in self.connections.expire():
+            logger.info(f"Connection timeout for {state.link}")
+            self.metrics.inc("links_timed_out", service=self.service_name)
+            self._end_session(state)
+            state.link.teardown()
+            self._close_state(state)
+        
+        now = time.time()
+        for token, state in list(self.sessions.items()):
+            detached_at = state.session.detached_at
+            if detached_at is not None and now - detached_at > self.session_timeout:
+                logger.info(f"Session of {state.link} was not resumed within {self.session_timeout}s")
+                self.metrics.inc("sessions_lost", service=self.service_name)
+                self.sessions.pop(token, None)
+                self._close_state(state)
+        
+        if self.protocol == 'udp':
+            for _, state in self.connections.items():
+                for session_id in state.sock.expire():
+                    logger.debug("UDP session %d on %s expired", session_id, self.service_name)
+        
+        for pending in list(self.pending.values()):
+            if pending.deadline > now:
+                continue
+            with pending.lock:
+                if pending.stage == PendingLink.IDENTIFY:
+                    # quiet clients that did not identify, e.g. waiting for an SSH banner
+                    self._request_admission(pending, None)
+                elif pending.stage == PendingLink.QUEUED and self.admission.cancel(pending.link.hash):
+                    self._refuse(pending, f"waited {self.admission.queue_timeout}s for a free slot")
+        
+        if self.pool is not None:
+            self.pool.expire()
+
+    def shutdown(self):
+        """Close every connection of this service"""
+        # links torn down from here on close their streams instead of keeping them for a resume
+        detached = [state for state in self.sessions.values() if state.session.detached_at is not None]
+        self.sessions.clear()
+        for state in detached:
+            self._close_state(state)
+        for pending in list(self.pending.values()):
+            pending.link.teardown()
+        for _, state in self.connections.clear():
+            try:
+                self._close_state(state)
+                state.link.teardown()
+            except:
+                pass
+        if self.pool is not None:
+            self.pool.close()
+
+class ServerBridge:
+    def __init__(self, services: List[BridgeService], identity_file: str = "./bridge_ident",
+                 stats_interval: int = 300, rns_config_dir: Optional[str] = None, metrics_port: int = 0,
+                 admission: Optional[AdmissionControl] = None):
+        """
+        Initialize the RNS Server Bridge
+        
+        Args:
+            services: Services to expose, each one gets its own destination
+            identity_file: Path to identity file (default: ./bridge_ident)
+            stats_interval: Seconds between combined stats log lines (0 to disable)
+            rns_config_dir: Reticulum config directory (default: ~/.reticulum)
+            metrics_port: Localhost port for the metrics control socket (0 to disable)
+            admission: Link limits shared by every service (default: no limits)
+        """
+        self.identity_file = identity_file
+        self.stats_interval = stats_interval
+        self.services = services
+        self.admission = admission if admission is not None else AdmissionControl()
+        
+        # Initialize RNS, shared by every service
+        RNS.Reticulum(configdir=rns_config_dir)
+        
+        # Load or create persistent identity
+        self.identity = self._load_or_create_identity()
+        logger.info(f"Using identity: {RNS.prettyhexrep(self.identity.hash)}")
+        
+        # One IO engine for the target sockets of every service
+        self.engine = IOEngine()
+        self.engine.start()
+        
+        # One registry for every service, series are labelled with the service name
+        self.metrics = MetricsRegistry("rns_server_bridge")
+        describe_bridge_metrics(self.metrics)
+        self.metrics.describe("links_waiting", "gauge", "Links waiting to identify or for a free slot")
+        self.metrics.describe("rate_limited", "counter", "Times a link was held back by its rate limit")
+        self.metrics.describe("pool_hits", "counter", "Links bridged over a warm pooled target connection")
+        self.metrics.describe("pool_misses", "counter", "Links that needed a new target connection with pooling on")
+        self.metrics.describe("pool_idle", "gauge", "Idle target connections in the pool")
+        self.metrics.describe("sessions_detached", "gauge", "Resumable streams waiting for their client to come back")
+        self.metrics.add_collector(lambda: [("receive_buffers", {}, len(self.engine.buffers))])
+        self.metrics_server = MetricsServer(self.metrics, metrics_port) if metrics_port > 0 else None
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+        
+        for service in self.services:
+            service.attach(self.identity, self.engine, self.metrics, self.admission)
+        
+        # Start cleanup thread
+        self.cleanup_thread = threading.Thread(target=self._expire_connections, daemon=True)
+        self.cleanup_thread.start()
+        
+        logger.info(f"Server bridge initialized with {len(self.services)} service(s)")
+        logger.info(f"Identity file: {identity_file}")
+
+
+    def _load_or_create_identity(self) -> RNS.Identity:
+        """Load existing identity or create a new one"""
+        try:
+            # Try to load existing identity
+            identity = RNS.Identity.from_file(self.identity_file)
+            if identity is None:
+                raise RuntimeError("IDent is none :( )")
+            logger.info(f"Loaded existing identity from {self.identity_file}")
+            return identity
+        except Exception as e:
+            logger.warning(f"Could not load identity from {self.identity_file}: {e}")
+        
+        # Create new identity if loading failed or file doesn't exist
+        logger.info(f"Creating new identity and saving to {self.identity_file}")
+        identity = RNS.Identity()
+        
+        try:
+            identity.to_file(self.identity_file)
+            logger.info(f"Saved new identity to {self.identity_file}")
+        except Exception as e:
+            logger.error(f"Failed to save identity to {self.identity_file}: {e}")
+            logger.warning("Identity will not persist across restarts")
+        
+        return identity
+
+    def _expire_connections(self):
+        """Drive the idle timers of every service, once per timer wheel tick"""
+        last_stats = time.time()
         while True:
             try:
-                current_time = time.time()
-                to_cleanup = []
+                for service in self.services:
+                    service.expire_idle()
                 
-                with self.connection_lock:
-                    for link, (target_socket, last_activity) in self.connections.items():
-                        if current_time - last_activity > self.timeout:
-                            to_cleanup.append(link)
+                if self.stats_interval > 0 and time.time() - last_stats > self.stats_interval:
+                    self.log_stats()
+                    last_stats = time.time()
                 
-                for link in to_cleanup:
-                    logger.info(f"Connection timeout for {link}")
-                    link.teardown()
-                    self._cleanup_connection(link)
-                
-                time.sleep(60)  # Check every 60 seconds
+                time.sleep(1)
                 
             except Exception as e:
                 logger.error(f"Error in cleanup thread: {e}")
                 time.sleep(30)
 
+    def get_stats(self) -> dict:
+        """Per-service counters plus totals across every service"""
+        services = {service.service_name: {} for service in self.services}
+        total = {}
+        for name, series in self.metrics.collect().items():
+            if self.metrics.families[name]["type"] == "histogram" or name.startswith("link_"):
+                continue
+            for key, value in series.items():
+                service = dict(key).get("service")
+                if service in services:
+                    services[service][name] = value
+                    total[name] = total.get(name, 0) + value
+        return {"services": services, "total": total}
+
+    def log_stats(self):
+        """Log the combined stats view"""
+        stats = self.get_stats()
+        for name, service_stats in stats["services"].items():
+            logger.info(f"[stats] {name}: " + ", ".join(f"{k}={v}" for k, v in service_stats.items()))
+        logger.info(f"[stats] total: " + ", ".join(f"{k}={v}" for k, v in stats["total"].items()))
+
     def start(self):
         """Start the server bridge"""
         logger.info("RNS Server Bridge started")
-        logger.info(f"Announce destination: {RNS.prettyhexrep(self.destination.hash)}")
         
-        # Announce the destination
-        self.destination.announce()
+        # Announce every destination
+        for service in self.services:
+            logger.info(f"Announce destination: {RNS.prettyhexrep(service.destination.hash)} ({service.service_name})")
+            service.destination.announce()
         
         try:
             while True:
@@ -252,18 +1096,79 @@ class ServerBridge:
         """Shutdown the server bridge"""
         logger.info("Shutting down all connections...")
         
-        with self.connection_lock:
-            for link, (target_socket, _) in self.connections.items():
-                try:
-                    target_socket.close()
-                    link.teardown()
-                except:
-                    pass
-            self.connections.clear()
+        # closing one service's links must not hand their slots to another's waiting links
+        self.admission.close()
+        for service in self.services:
+            service.shutdown()
+        self.engine.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        self.log_stats()
         
         logger.info("Server bridge shutdown complete")
 
 
+def load_services(config_path: str) -> Tuple[List[BridgeService], dict]:
+    """
+    Read services from an INI style config file. The optional [bridge] section holds
+    daemon settings, every other section is a service named after the section:
+    
+        [bridge]
+        identity = ./bridge_ident
+        max_links = 32
+        max_links_per_identity = 4
+        link_queue = 8
+        queue_timeout = 30
+        
+        [ssh]
+        target_host = 127.0.0.1
+        target_port = 22
+        protocol = tcp
+        max_links = 4
+        rate_limit = 4000
+        link_rate_limit = 1000
+        session_timeout = 120
+        
+        [web]
+        target_port = 8080
+        pool_size = 4
+        pool_idle_timeout = 30
+        
+        [dns]
+        target_port = 53
+        protocol = udp
+        udp_session_timeout = 30
+    """
+    config = configparser.ConfigParser()
+    if not config.read(config_path):
+        raise RuntimeError(f"Could not read config file {config_path}")
+    
+    settings = dict(config["bridge"]) if config.has_section("bridge") else {}
+    services = []
+    for name in config.sections():
+        if name == "bridge":
+            continue
+        section = config[name]
+        services.append(BridgeService(
+            service_name=name,
+            target_host=section.get("target_host", "127.0.0.1"),
+            target_port=section.getint("target_port"),
+            protocol=section.get("protocol", "tcp"),
+            timeout=section.getint("timeout", 900),
+            udp_session_timeout=section.getint("udp_session_timeout", 120),
+            max_links=section.getint("max_links", 0),
+            rate_limit=section.getint("rate_limit", 0),
+            link_rate_limit=section.getint("link_rate_limit", 0),
+            pool_size=section.getint("pool_size", 0),
+            pool_idle_timeout=section.getint("pool_idle_timeout", 60),
+            session_timeout=section.getint("session_timeout", 0)
+        ))
+    
+    if not services:
+        raise RuntimeError(f"No services defined in {config_path}")
+    return services, settings
+
+
 def main():
     parser = argparse.ArgumentParser(description='RNS Server Bridge')
     parser.add_argument('target_host', nargs='?', help='Target server IP address', default="127.0.0.1")
@@ -275,22 +1180,93 @@ def main():
                        help='RNS service name (default: bridge_service)')
     parser.add_argument('--identity', default='./bridge_ident',
                        help='Identity file path (default: ./bridge_ident)')
+    parser.add_argument('--udp-session-timeout', type=int, default=120,
+                       help='Idle seconds before a UDP client session expires (default: 120)')
+    parser.add_argument('--max-links', type=int, default=0,
+                       help='Maximum concurrent links (default: 0, no limit)')
+    parser.add_argument('--max-links-per-identity', type=int, default=0,
+                       help='Maximum concurrent links per remote identity, clients that do not identify '
+                            'share one allowance (default: 0, no limit)')
+    parser.add_argument('--link-queue', type=int, default=0,
+                       help='Links that may wait for a free slot instead of being refused (default: 0)')
+    parser.add_argument('--queue-timeout', type=int, default=30,
+                       help='Seconds a waiting link is kept before it is refused (default: 30)')
+    parser.add_argument('--rate-limit', type=int, default=0,
+                       help='Bytes per second the service may send over RNS, all links together (default: 0, no limit)')
+    parser.add_argument('--link-rate-limit', type=int, default=0,
+                       help='Bytes per second each link may send over RNS (default: 0, no limit)')
+    parser.add_argument('--pool-size', type=int, default=0,
+                       help='TCP only, idle target connections kept for reuse by later links, for request/response '
+                            'targets with keep-alive such as HTTP (default: 0, off)')
+    parser.add_argument('--pool-idle-timeout', type=int, default=60,
+                       help='Seconds an idle pooled target connection is kept (default: 60)')
+    parser.add_argument('--session-timeout', type=int, default=0,
+                       help='TCP only, seconds a stream whose link dropped is kept for the client bridge to resume '
+                            'it on a new link, needs a client run with --resume-timeout (default: 0, off)')
+    parser.add_argument('--config', default=None,
+                       help='Config file with one section per service, overrides the target arguments')
+    parser.add_argument('--stats-interval', type=int, default=300,
+                       help='Seconds between combined stats log lines, 0 to disable (default: 300)')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                       help='Serve metrics (Prometheus at /metrics, JSON at /stats) on this localhost port (default: 0, off)')
+    parser.add_argument('--stats', action='store_true',
+                       help='Print the live stats of the bridge running with --metrics-port and exit')
+    parser.add_argument('--rnsconfig', default=None,
+                       help='Reticulum config directory (default: ~/.reticulum)')
     parser.add_argument('--verbose', '-v', action='store_true',
                        help='Enable verbose logging')
+    parser.add_argument('--log-file', default='rns_server_bridge.log',
+                       help='Log file, empty for stdout only (default: rns_server_bridge.log)')
+    parser.add_argument('--trace-sample', type=float, default=0,
+                       help='Fraction of forwarded packets to trace, e.g. 0.01 (default: 0, off)')
+    parser.add_argument('--log-payloads', action='store_true',
+                       help='Include packet payloads in traces')
     
     args = parser.parse_args()
     
-    if True or args.verbose:
-        logging.getLogger().setLevel(logging.DEBUG)
+    if args.stats:
+        try:
+            print_stats(args.metrics_port)
+        except OSError as e:
+            print(f"Could not reach the bridge's metrics socket on port {args.metrics_port}: {e}")
+            sys.exit(1)
+        return
+    
+    setup_logging(args.log_file, verbose=args.verbose, trace_sample=args.trace_sample,
+                  log_payloads=args.log_payloads)
     
     try:
-        bridge = ServerBridge(
-            target_host=args.target_host,
-            target_port=args.target_port,
-            protocol=args.protocol,
-            timeout=args.timeout,
-            service_name=args.service
-        )
+        identity_file = args.identity
+        admission = AdmissionControl(max_links_per_identity=args.max_links_per_identity,
+                                     queue_size=args.link_queue, queue_timeout=args.queue_timeout)
+        if args.config is not None:
+            services, settings = load_services(args.config)
+            identity_file = settings.get("identity", identity_file)
+            admission = AdmissionControl(
+                max_links=int(settings.get("max_links", 0)),
+                max_links_per_identity=int(settings.get("max_links_per_identity", args.max_links_per_identity)),
+                queue_size=int(settings.get("link_queue", args.link_queue)),
+                queue_timeout=int(settings.get("queue_timeout", args.queue_timeout))
+            )
+        else:
+            services = [BridgeService(
+                service_name=args.service,
+                target_host=args.target_host,
+                target_port=args.target_port,
+                protocol=args.protocol,
+                timeout=args.timeout,
+                udp_session_timeout=args.udp_session_timeout,
+                max_links=args.max_links,
+                rate_limit=args.rate_limit,
+                link_rate_limit=args.link_rate_limit,
+                pool_size=args.pool_size,
+                pool_idle_timeout=args.pool_idle_timeout,
+                session_timeout=args.session_timeout
+            )]
+        
+        bridge = ServerBridge(services, identity_file=identity_file, stats_interval=args.stats_interval,
+                              rns_config_dir=args.rnsconfig, metrics_port=args.metrics_port,
+                              admission=admission)
         bridge.start()
         
     except Exception as e:
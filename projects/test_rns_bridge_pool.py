@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Tests for UpstreamPool, the server bridge's warm target connections. Run with
+python -m unittest test_rns_bridge_pool (or pytest) from this directory, needs no RNS network.
+"""
+
+import socket
+import threading
+import time
+import unittest
+
+from rns_bridge_common import ConnectionState
+from rns_bridge_server import UpstreamPool
+
+
+class SlowEchoServer:
+    """A target that answers every request after delay seconds"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.address = self.listener.getsockname()
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._answer, args=(conn,), daemon=True).start()
+
+    def _answer(self, conn: socket.socket):
+        with conn:
+            try:
+                while True:
+                    request = conn.recv(4096)
+                    if not request:
+                        return
+                    time.sleep(self.delay)
+                    conn.sendall(b"response to " + request)
+            except OSError:
+                # the test closed its end before the response went out
+                pass
+
+    def close(self):
+        self.listener.close()
+
+
+class UpstreamPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SlowEchoServer(delay=0.3)
+        self.pool = UpstreamPool(self.server.address, size=4, quiet_grace=0.1)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.close()
+
+    def _connect(self) -> socket.socket:
+        target_socket = self.pool.connect()
+        target_socket.setblocking(False)
+        return target_socket
+
+    def test_pools_a_connection_that_answered(self):
+        target_socket = self._connect()
+        state = ConnectionState(None, target_socket)
+        target_socket.send(b"one")
+        state.received(3)
+        time.sleep(0.4)
+        self.assertEqual(target_socket.recv(4096), b"response to one")
+        state.sent(15)
+
+        delay = self.pool.release_delay(state.last_in, state.last_out)
+        self.assertIsNotNone(delay)
+        time.sleep(delay)
+        self.assertTrue(self.pool.release(target_socket))
+        self.assertIs(self.pool.acquire(), target_socket)
+
+    def test_link_drops_while_reply_pending(self):
+        target_socket = self._connect()
+        state = ConnectionState(None, target_socket)
+        target_socket.send(b"one")
+        state.received(3)
+        time.sleep(0.4)
+        self.assertEqual(target_socket.recv(4096), b"response to one")
+        state.sent(15)
+        # a second request, the link goes away before the target answers it
+        target_socket.send(b"two")
+        state.received(3)
+
+        # quiet right now, the old health check alone would have pooled it
+        self.assertTrue(UpstreamPool._healthy(target_socket))
+        self.assertIsNone(self.pool.release_delay(state.last_in, state.last_out))
+        target_socket.close()
+        self.assertIsNone(self.pool.acquire())
+
+    def test_late_response_during_grace_is_not_pooled(self):
+        target_socket = self._connect()
+        state = ConnectionState(None, target_socket)
+        state.received(3)
+        state.sent(15)
+        # a request the state never saw, its response arrives during the grace period
+        target_socket.send(b"late")
+        delay = self.pool.release_delay(state.last_in, state.last_out)
+        self.assertGreater(delay, 0)
+        time.sleep(delay + 0.3)
+        self.assertFalse(self.pool.release(target_socket))
+        target_socket.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Benchmark page views of the zim reader, cold and warm.
+
+Starts zim_host.py on a directory of zim files and times the views NomadNet would do. Each view
+spawns pages/zr.mu like NomadNet does. The first view of each page after the daemon starts is
+cold (nothing cached yet), the rest are warm. For comparison it also times:
+    socket  the render socket alone, no process spawn, what the daemon itself costs
+    legacy  a process with the imports and multiprocessing client of the old zr.mu, asking
+            the listener on port 6000 for the same page
+
+Example: python zim_bench.py ~/zims/ --repeat 20 --search baseball
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# what every view of the old zr.mu paid before doing anything, plus its round trip
+LEGACY_CLIENT = """
+import os
+import traceback
+from multiprocessing.connection import Client
+conn = Client(('localhost', 6000), authkey=os.environ["ZIM_AUTHKEY"].encode())
+msg = {k[4:]: v for k, v in os.environ.items() if k.startswith("var_")}
+if "a" not in msg:
+    msg = {"command": "list_archives"}
+elif "do_search" in msg:
+    msg = {"command": "search", "archive": msg["a"], "search": os.environ["field_search"], "page": 0}
+else:
+    msg = {"command": "request_path", "archive": msg["a"], "path": msg.get("p")}
+conn.send(msg)
+print(conn.recv())
+conn.close()
+"""
+
+
+def page_env(params):
+    return {k: str(v) for k, v in params.items()}
+
+
+def time_process(args, env):
+    start = time.perf_counter()
+    out = subprocess.run(args, env=env, stdout=subprocess.PIPE, check=True, timeout=60).stdout
+    return time.perf_counter() - start, out
+
+
+def time_socket(sock_path, params):
+    start = time.perf_counter()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(sock_path)
+    sock.sendall("\0".join(f"{k}={v}" for k, v in params.items()).encode())
+    sock.shutdown(socket.SHUT_WR)
+    out = b""
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        out += chunk
+    sock.close()
+    return time.perf_counter() - start, out
+
+
+def wait_for_socket(path, proc, timeout=60):
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path):
+        if proc.poll() is not None:
+            raise RuntimeError("zim_host.py exited during startup")
+        if time.monotonic() > deadline:
+            raise RuntimeError("zim_host.py did not start its render server")
+        time.sleep(0.05)
+
+
+def ms(seconds):
+    return f"{seconds*1000:8.1f}ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Zim reader page view benchmark')
+    parser.add_argument('zim_path', help='Directory with .zim files')
+    parser.add_argument('--repeat', type=int, default=10, help='Warm views per page')
+    parser.add_argument('--search', default='the', help='Search string for the search page')
+    parser.add_argument('--path', action='append', default=[], help='Extra path in archive 0 to view, repeatable')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="zim_bench_")
+    sock_path = os.path.join(workdir, "render.sock")
+    env = dict(os.environ, ZIM_PATH=os.path.join(os.path.abspath(args.zim_path), ""),
+               ZIM_AUTHKEY="bench", ZIM_RENDER_SOCKET=sock_path)
+    pages = [("archive list", {}),
+             ("main page", {"var_a": 0}),
+             ("search", {"var_a": 0, "var_do_search": 1, "field_search": args.search})]
+    pages += [(path, {"var_a": 0, "var_p": path}) for path in args.path]
+
+    host = subprocess.Popen([sys.executable, os.path.join(HERE, "zim_host.py")], env=env,
+                            stdout=subprocess.DEVNULL, cwd=workdir)
+    try:
+        wait_for_socket(sock_path, host)
+        shim = [os.path.join(HERE, "pages", "zr.mu")]
+        legacy = [sys.executable, "-c", LEGACY_CLIENT]
+        print(f"{'page':20} {'cold':>10} {'warm':>10} {'socket':>10} {'legacy':>10} {'bytes':>8}")
+        for name, params in pages:
+            view_env = dict(env, **page_env(params))
+            cold, out = time_process(shim, view_env)
+            warm = statistics.median(time_process(shim, view_env)[0] for _ in range(args.repeat))
+            direct = statistics.median(time_socket(sock_path, page_env(params))[0] for _ in range(args.repeat))
+            old = statistics.median(time_process(legacy, view_env)[0] for _ in range(args.repeat))
+            print(f"{name[:20]:20} {ms(cold):>10} {ms(warm):>10} {ms(direct):>10} {ms(old):>10} {len(out):8}")
+    finally:
+        host.terminate()
+        host.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+Copy zim items out without holding them in memory. Items in uncompressed clusters (where zims
+put videos, pdfs and images) are copied straight from the zim file with copy_file_range or
+sendfile, located by reading the zim's dirent and cluster headers ourselves since libzim's python
+bindings don't tell us where an item is. Everything else is copied from libzim's buffer in
+CHUNK_SIZE pieces, which at least never makes a second whole copy.
+
+See https://wiki.openzim.org/wiki/ZIM_file_format for the layout.
+"""
+import os
+import struct
+import threading
+
+CHUNK_SIZE = 256*1024
+
+_HEADER = struct.Struct("<IHH16sIIQQQQIIQ")
+_DIRENT = struct.Struct("<HBcIII") # mimetype, parameter length, namespace, revision, cluster, blob
+ZIM_MAGIC = 0x44D495A
+REDIRECT_MIMETYPE = 0xFFFF
+UNCOMPRESSED = (0, 1) # compression field of a cluster's info byte
+EXTENDED_CLUSTER = 0x10 # info byte flag, blob offsets are 8 bytes instead of 4
+
+
+class DirectAccess:
+    """
+    Where the items of one zim file are in the file, if they're stored uncompressed. Multi part
+    zims aren't supported, locate() answers None for everything and callers fall back to libzim.
+    """
+
+    def __init__(self, archive):
+        self.fd = None
+        # locations don't change, items that get exported are usually exported again
+        self.locations = {}
+        self.lock = threading.Lock()
+        if archive.is_multipart:
+            return
+        try:
+            fd = os.open(str(archive.filename), os.O_RDONLY)
+            header = os.pread(fd, _HEADER.size, 0)
+            magic, _, _, _, _, self.cluster_count, self.path_ptr_pos, _, self.cluster_ptr_pos, _, _, _, _ = _HEADER.unpack(header)
+            if magic != ZIM_MAGIC:
+                os.close(fd)
+                return
+            self.fd = fd
+        except (OSError, struct.error) as e:
+            print(f"No direct access to {archive.filename}: {e}")
+
+    def locate(self, entry_index):
+        """(offset in the zim file, size) of an item stored uncompressed, or None"""
+        if self.fd is None:
+            return None
+        with self.lock:
+            if entry_index in self.locations:
+                return self.locations[entry_index]
+        try:
+            location = self._locate(entry_index)
+        except (OSError, struct.error):
+            location = None
+        with self.lock:
+            self.locations[entry_index] = location
+        return location
+
+    def _read_u64(self, pos):
+        return struct.unpack("<Q", os.pread(self.fd, 8, pos))[0]
+
+    def _locate(self, entry_index):
+        dirent_pos = self._read_u64(self.path_ptr_pos + 8*entry_index)
+        mimetype, _, _, _, cluster, blob = _DIRENT.unpack(os.pread(self.fd, _DIRENT.size, dirent_pos))
+        if mimetype == REDIRECT_MIMETYPE or cluster >= self.cluster_count:
+            return None
+        cluster_pos = self._read_u64(self.cluster_ptr_pos + 8*cluster)
+        info = os.pread(self.fd, 1, cluster_pos)[0]
+        if info & 0x0F not in UNCOMPRESSED:
+            return None
+        offset_format = "<2Q" if info & EXTENDED_CLUSTER else "<2I"
+        offset_size = struct.calcsize(offset_format) // 2
+        start, end = struct.unpack(offset_format, os.pread(self.fd, 2*offset_size, cluster_pos + 1 + offset_size*blob))
+        return cluster_pos + 1 + start, end - start
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def _copy_range(src_fd, dst_fd, offset, size):
+    copied = 0
+    # in kernel copies where we can, a read/write loop where we can't
+    for copy in (getattr(os, "copy_file_range", None), getattr(os, "sendfile", None)):
+        if copy is None:
+            continue
+        try:
+            while copied < size:
+                if copy is os.sendfile:
+                    n = os.sendfile(dst_fd, src_fd, offset + copied, min(CHUNK_SIZE*16, size - copied))
+                else:
+                    n = copy(src_fd, dst_fd, min(CHUNK_SIZE*16, size - copied), offset + copied)
+                if n == 0:
+                    break
+                copied += n
+            if copied == size:
+                return
+        except OSError:
+            # not supported between these two files, carry on from where it stopped
+            pass
+    while copied < size:
+        chunk = os.pread(src_fd, min(CHUNK_SIZE, size - copied), offset + copied)
+        if not chunk:
+            raise OSError(f"zim file ended {size - copied} bytes early")
+        os.write(dst_fd, chunk)
+        copied += len(chunk)
+
+
+def _direct_location(item, direct):
+    if direct is None:
+        return None
+    location = direct.locate(item._index)
+    # our reading of the zim has to agree with libzim's, or we don't trust it
+    if location is None or location[1] != item.size:
+        return None
+    return location
+
+
+def export_item(item, dest_path, direct=None):
+    """
+    Write item's content to dest_path, memory use doesn't depend on the item's size. An
+    existing file of the same size is taken to be the item already exported. Returns the
+    number of bytes written.
+    """
+    if os.path.exists(dest_path) and os.path.getsize(dest_path) == item.size:
+        return 0
+    tmp_path = dest_path + ".part"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        location = _direct_location(item, direct)
+        if location is not None:
+            _copy_range(direct.fd, fd, location[0], location[1])
+        else:
+            content = item.content
+            for start in range(0, item.size, CHUNK_SIZE):
+                os.write(fd, content[start:start + CHUNK_SIZE])
+    finally:
+        os.close(fd)
+    # rename so a download never sees half a file
+    os.replace(tmp_path, dest_path)
+    return item.size
+
+
+def read_item(item, limit=-1, direct=None):
+    """The first limit bytes of item's content (all of it if limit < 0), for previews"""
+    size = item.size if limit < 0 else min(limit, item.size)
+    location = _direct_location(item, direct)
+    if location is not None:
+        return os.pread(direct.fd, size, location[0])
+    # slicing the memoryview copies only what we keep
+    return item.content[:size].tobytes()
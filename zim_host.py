@@ -6,7 +6,19 @@ from libzim.suggestion import SuggestionSearcher
 import traceback
 from urllib.parse import unquote
 from micronify import html_to_micron
+from zim_render import RenderServer, Deadline, Cancelled, request_stats
+from zim_paths import PathIndex
+from zim_export import DirectAccess, export_item, read_item
+from zim_titles import TitleIndex
+from zim_warm import WarmCache
+import atexit
+import select
+import signal
 import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 
 # Env vars for privacy
 zimpath = os.environ["ZIM_PATH"] 
@@ -25,6 +37,29 @@ DEFAULT_PAGE_SIZE_BYTES =  2**64 # Actually have pagination once we add styling
 archive_lookup = dict() # map from name to index id (we use numbers to save space/bandwidth in href rewrites)
 archives = []
 archive_names = []
+path_indexes = [] # which paths exist in each archive, built on first use
+direct_access = [] # for copying uncompressed items straight out of each zim file
+title_indexes = [] # prebuilt with zim_titles.py, searched when an archive has no full text index
+TITLE_SEARCH_LIMIT = 500 # matches a title search looks for, there's no estimate to page through
+# the render server's threads and the listener share the archives
+archive_lock = threading.Lock()
+
+ALL_ARCHIVES = "all" # archive id of the search across every archive
+SEARCH_DEADLINE = 5 # seconds an archive gets to answer an all-archives search, slow ones are left out
+SEARCH_DEPTH = 50 # results taken from each archive for the merged list
+RRF_K = 60 # reciprocal rank fusion constant, libzim gives us ranks but no scores to compare across archives
+search_pool = None # a thread per archive, made by load()
+search_cache = OrderedDict() # search string -> merged results of an all-archives search, least recently used first
+SEARCH_CACHE_SIZE = 32
+page_cache = OrderedDict() # (archive idx, path) -> converted html page, least recently used first
+PAGE_CACHE_BYTES = 32*2**20 # characters really, close enough
+page_cache_size = 0
+# the caches are filled by requests and by rewarm(), a page cached by one is looked up by the other
+cache_lock = threading.Lock()
+warm_cache = WarmCache() # what's popular, saved across restarts
+WARM_IDLE_WAIT = 0.05 # seconds rewarm() waits while a request is running or waiting
+requests_waiting = 0 # requests waiting for the archive lock, rewarm() gives it up for them
+waiting_lock = threading.Lock()
 
 def load(zimfile_path):
     """
@@ -37,11 +72,16 @@ def load(zimfile_path):
             name = file[:-4] # name without extension. Let's keep dates and lang for now, its useful
             archives.append(Archive(zimfile_path+file))
             archive_names.append(name)
+            path_indexes.append(PathIndex(archives[-1], name))
+            direct_access.append(DirectAccess(archives[-1]))
+            title_indexes.append(TitleIndex.open(name, archives[-1]))
             print(f"Loading {name}...")
             archive_lookup[name] = i
             i+=1
+    global search_pool
+    search_pool = ThreadPoolExecutor(max_workers=max(1, len(archives)), thread_name_prefix="search")
 
-def request_path(archive_idx, path, last_path):
+def request_path(archive_idx, path, last_path, deadline):
     if archive_idx >= len(archives) or archive_idx <0:
         return {"status": "error", "message":f"could not find archive {archive_idx}"}
     
@@ -53,48 +93,94 @@ def request_path(archive_idx, path, last_path):
     entry = archive.main_entry
     if path is not None and len(path) > 0:
         path = unquote(path) # unquote the path for dealing with uincode and stuff
-        if not archive.has_entry_by_path(path):
+        index = path_indexes[archive_idx]
+        if index.ready:
+            # also covers the trailing slash issue
+            resolved = index.resolve(path)
+        elif archive.has_entry_by_path(path):
+            resolved = path
+        else:
             # is it just a trailing slash issue?
-            if archive.has_entry_by_path(path+"/"):
-                path = path+"/"
-            else: 
-                return {"status": "error", "message":f"could not find path {path} in {archive_idx}"}
-        entry = archive.get_entry_by_path(path)
+            resolved = path+"/" if archive.has_entry_by_path(path+"/") else None
+            index.build_in_background()
+        try:
+            if resolved is None:
+                raise KeyError(path)
+            # the index can be fooled by a hash collision, the archive has the last word
+            entry = archive.get_entry_by_path(resolved)
+        except KeyError:
+            return {"status": "error", "message":f"could not find path {path} in {archive_idx}"}
+        path = resolved
         
     item = entry.get_item()
     if path is None:
         path = item.path # fill in path for main entry
         print("PATH="+path)
 
-    content = decode_content_by_mimetype(item, path, archive_idx, last_path=last_path)
+    deadline.check()
+    if item.mimetype == "text/html":
+        warm_cache.hit(("page", archive_names[archive_idx], path))
+    content = page_content(item, path, archive_idx, deadline, last_path)
     return {"status":"ok", "title":item.title, "content":content, "size": item.size, "mimetype": item.mimetype, "archive": {"name": archive_names[archive_idx], "id": archive_idx}  }
     
-def decode_content_by_mimetype(item, current_path, archive_idx, pre_truncate=-1, last_path=None):
+def page_content(item, path, archive_idx, deadline, last_path=None):
+    """
+    decode_content_by_mimetype, with converted html pages kept in page_cache. They don't depend on
+    last_path, only downloads link back to it.
+    """
+    if item.mimetype != "text/html":
+        return decode_content_by_mimetype(item, path, archive_idx, deadline, last_path=last_path)
+    key = (archive_idx, path)
+    with cache_lock:
+        if key in page_cache:
+            page_cache.move_to_end(key)
+            return page_cache[key]
+    # converted before the path index was ready it links to missing pages, convert it again later
+    cacheable = path_indexes[archive_idx].ready
+    content = decode_content_by_mimetype(item, path, archive_idx, deadline, last_path=last_path)
+    if cacheable:
+        cache_page(key, content)
+    return content
+
+def cache_page(key, content):
+    global page_cache_size
+    with cache_lock:
+        if key in page_cache:
+            return
+        page_cache[key] = content
+        page_cache_size += len(content)
+        while page_cache_size > PAGE_CACHE_BYTES and page_cache:
+            _, evicted = page_cache.popitem(last=False)
+            page_cache_size -= len(evicted)
+
+def decode_content_by_mimetype(item, current_path, archive_idx, deadline, pre_truncate=-1, last_path=None):
     """
     try to decode the content based on the mimetype
     """
     mimetype = item.mimetype
-    content = bytes(item.content)
     
-    if pre_truncate > 0:
-        content = content[:pre_truncate]
-        
-    if mimetype == "text/html":
-        #TODO html to micron
-        html = content.decode("UTF-8")
-        return html_to_micron(html, current_path, extra_get_params={"a":archive_idx})
-    # just straight text decode anything else thats text/
     if mimetype.startswith("text"):
+        # only the part we need, not the whole item and then a slice of it
+        content = read_item(item, pre_truncate if pre_truncate > 0 else -1, direct_access[archive_idx])
+        
+        if mimetype == "text/html":
+            #TODO html to micron
+            html = content.decode("UTF-8")
+            index = path_indexes[archive_idx]
+            deadline.check()
+            # checked again tag by tag, a huge article stops converting once nobody waits for it
+            return html_to_micron(html, current_path, extra_get_params={"a":archive_idx},
+                                  path_exists=lambda link: index.exists(unquote(link)), check=deadline.check)
+        # just straight text decode anything else thats text/
         return content.decode("UTF-8", errors='ignore')
     
     # Can't turn it into a micron page, let the user download it
     # first move to a temp file
     filename = archive_names[archive_idx] + "_" + current_path.replace("/","__")
-    # if we overwrite it... o well it was tempfs anyway
+    # if it's there from an earlier request it's kept, else it's copied out in chunks, so a big video doesn't end up in memory
     # TODO: Could we eagerly cache links when parsing the HTML (to things like images and pdf files, and then if it's here, we don't need to write it?)
     # that could get us around the 60 second minimum polling
-    with open(file_storage_path + filename, "wb+") as tmpfile:
-        tmpfile.write(content)
+    export_item(item, file_storage_path + filename, direct_access[archive_idx])
         
     # calculate size string
     size_str = ""
@@ -116,32 +202,236 @@ def decode_content_by_mimetype(item, current_path, archive_idx, pre_truncate=-1,
 def list_archives():
     return {"status": "ok", "archives": [{'name':name, "id":idx} for name,idx in archive_lookup.items() ]}
 
-def search(archive_idx, needle, page_idx, page_size):
+def search_paths(archive_idx, needle, start, max_results):
+    """
+    (estimated number of matches, paths of up to max_results matches from start on) in one archive
+    """
+    archive = archives[archive_idx]
+    titles = title_indexes[archive_idx]
+    if archive.has_fulltext_index or titles is None:
+        query = Query().set_query(needle)
+        searcher = Searcher(archive)
+        search = searcher.search(query)
+        count = search.getEstimatedMatches()
+        num_to_grab = min(count,max_results)
+        return count, list(search.getResults(start, num_to_grab))
+    
+    # no full text index, fall back to matching titles
+    entry_ids = titles.search(needle, TITLE_SEARCH_LIMIT)
+    return len(entry_ids), [archive._get_entry_by_id(i).path for i in entry_ids[start:start+max_results]]
+
+def search_result(archive_idx, path, deadline):
+    deadline.check()
+    item = archives[archive_idx].get_entry_by_path(path).get_item()
+    # grab the page and pre-trnacte it to save cpu cycles on conversion
+    content = decode_content_by_mimetype(item, path, archive_idx, deadline, pre_truncate=5000).strip()
+    # truncate the result itself so we don't have HUGE results
+    content = content[:1000]
+    return {"title":item.title, "content":content, "size": item.size, "mimetype": item.mimetype, "path": path}
+
+def search(archive_idx, needle, page_idx, page_size, deadline):
     if archive_idx >= len(archives) or archive_idx <0:
         return {"status": "error", "message":f"could not find archive {archive_idx}"}
     
-    archive = archives[archive_idx]
-    
-    query = Query().set_query(needle)
-    searcher = Searcher(archive)
-    search = searcher.search(query)
-    count = search.getEstimatedMatches()
-    num_to_grab = min(count,page_size)
-    result_pages = list(search.getResults(page_idx*page_size, num_to_grab))
-    results = []
+    if not archives[archive_idx].has_fulltext_index and title_indexes[archive_idx] is None:
+        return {"status": "error", "message":f"{archive_names[archive_idx]} has no search index, build a title index with zim_titles.py"}
     
-    for path in result_pages:
-        item = archive.get_entry_by_path(path).get_item()
-        # grab the page and pre-trnacte it to save cpu cycles on conversion
-        content = decode_content_by_mimetype(item, path, archive_idx, pre_truncate=5000).strip()
-        # truncate the result itself so we don't have HUGE results
-        content = content[:1000]
-        
-        results.append({"title":item.title, "content":content, "size": item.size, "mimetype": item.mimetype, "path": path})
+    count, result_pages = search_paths(archive_idx, needle, page_idx*page_size, page_size)
+    results = [search_result(archive_idx, path, deadline) for path in result_pages]
     
     return {"status": "ok", "archive": {"name": archive_names[archive_idx], "id": archive_idx} , "count": count, 'search_string': needle, "results":  results, "page":page_idx, "page_size": page_size}
+
+def merged_search(needle, deadline):
+    """
+    Search every archive with a full text or title index at once and merge the results by reciprocal rank.
+    Returns (list of (archive_idx, path) best first, per archive info), cached if every archive answered.
+    """
+    with cache_lock:
+        if needle in search_cache:
+            search_cache.move_to_end(needle)
+            return search_cache[needle]
+    
+    searchable = [idx for idx, archive in enumerate(archives) if archive.has_fulltext_index or title_indexes[idx] is not None]
+    futures = {idx: search_pool.submit(search_paths, idx, needle, 0, SEARCH_DEPTH) for idx in searchable}
+    # the deadline is per search, the archives are searched side by side, and the request's own
+    # budget may be shorter still
+    wait(futures.values(), timeout=min(SEARCH_DEADLINE, deadline.remaining()))
+    deadline.check()
+    
+    scored = []
+    archive_info = []
+    complete = True
+    for idx, future in futures.items():
+        info = {"name": archive_names[idx], "id": idx, "count": 0, "timed_out": False}
+        if not future.done():
+            info["timed_out"] = True
+            complete = False
+        elif future.exception() is not None:
+            print(f"search in {archive_names[idx]} failed: {future.exception()}")
+            complete = False
+        else:
+            info["count"], paths = future.result()
+            scored += [(1 / (RRF_K + rank), idx, path) for rank, path in enumerate(paths)]
+        archive_info.append(info)
+    # equal ranks come out in archive order
+    scored.sort(key=lambda s: (-s[0], s[1]))
+    merged = ([(idx, path) for _, idx, path in scored], archive_info)
+    
+    if complete:
+        with cache_lock:
+            search_cache[needle] = merged
+            if len(search_cache) > SEARCH_CACHE_SIZE:
+                search_cache.popitem(last=False)
+    return merged
+
+def search_all(needle, page_idx, page_size, deadline):
+    warm_cache.hit(("search", needle))
+    merged, archive_info = merged_search(needle, deadline)
+    results = []
+    for idx, path in merged[page_idx*page_size:(page_idx+1)*page_size]:
+        result = search_result(idx, path, deadline)
+        result["archive"] = {"name": archive_names[idx], "id": idx}
+        results.append(result)
+    
+    return {"status": "ok", "archive": {"name": "All archives", "id": ALL_ARCHIVES}, "count": len(merged), 'search_string': needle,
+            "results": results, "page": page_idx, "page_size": page_size, "archives": archive_info}
    
 
+def handle_command(msg, deadline=None):
+    """
+    Run a command message from either the listener or the render server, returns the response.
+    Work stops with an error response once the deadline passes or its client hangs up, by default
+    the deadline is the budget in msg, if any.
+    """
+    command = msg.get("command")
+    resp = {"status":"error", "message": f"no handler for command={command}"}
+    if command == "stats":
+        return {"status": "ok", "stats": dict(request_stats)}
+    if deadline is None:
+        deadline = Deadline(msg.get("budget"))
+    request_stats["requests"] += 1
+    
+    # waiting for another request counts against the budget too
+    global requests_waiting
+    with waiting_lock:
+        requests_waiting += 1
+    try:
+        acquired = archive_lock.acquire(timeout=deadline.remaining())
+    finally:
+        with waiting_lock:
+            requests_waiting -= 1
+    if not acquired:
+        request_stats["timeouts"] += 1
+        return {"status": "error", "message": "request cancelled: timeout"}
+    try:
+        if command == "list_archives":
+            resp = list_archives()
+        elif command == "request_path":
+            archive_id = int(msg.get("archive", -1))
+            path = msg.get("path", None) # path requested
+            last_path = msg.get("last_path",None)
+            resp = request_path(archive_id, path, last_path, deadline)
+            #print(resp.get("content","?"))
+        elif command == "search":
+            search_str = msg.get("search", "no search?")
+            page = int(msg.get("page",0))
+            if msg.get("archive") == ALL_ARCHIVES:
+                resp = search_all(search_str, page, 5, deadline)
+            else:
+                archive_id = int(msg.get("archive", -1))
+                resp = search(archive_id, search_str, page, 5, deadline)
+    except Cancelled as e:
+        request_stats["timeouts" if str(e) == "timeout" else "disconnects"] += 1
+        print(f"{command} request cancelled: {e}")
+        return {"status": "error", "message": f"request cancelled: {e}"}
+    except Exception:
+        request_stats["errors"] += 1
+        raise
+    finally:
+        archive_lock.release()
+    request_stats["ok" if resp.get("status") == "ok" else "errors"] += 1
+    return resp
+
+def archive_uuids():
+    return {name: archives[idx].uuid.hex for name, idx in archive_lookup.items()}
+
+def page_body(name, path):
+    with cache_lock:
+        return page_cache.get((archive_lookup.get(name), path))
+
+class WarmDeadline(Deadline):
+    """The deadline of warming one entry, which also gives up as soon as a request waits for the archive lock"""
+
+    def check(self):
+        if requests_waiting:
+            raise Cancelled("request waiting")
+        super().check()
+
+def warm(key, body):
+    """Restore or redo one snapshot entry, called with the archive lock held"""
+    if key[0] == "search":
+        merged_search(key[1], WarmDeadline())
+        return
+    archive_idx = archive_lookup[key[1]]
+    if body is not None:
+        cache_page((archive_idx, key[2]), body)
+        return
+    item = archives[archive_idx].get_entry_by_path(key[2]).get_item()
+    page_content(item, key[2], archive_idx, WarmDeadline())
+
+def rewarm():
+    """
+    Restore or redo the pages and searches of the last snapshot, most popular first, in the
+    background. Entries are warmed one at a time under the archive lock like a request, taken
+    only while no request holds or waits for it, and a request that comes along meanwhile
+    cancels the entry (which is tried again later), so it waits a moment at most.
+    """
+    warmed = 0
+    for key, body in warm_cache.load(archive_uuids()):
+        if key[0] == "page" and body is None:
+            # pages converted without the path index aren't cached, build it without the lock
+            index = path_indexes[archive_lookup[key[1]]]
+            index.build_in_background()
+            index.done.wait()
+        while True:
+            if requests_waiting or not archive_lock.acquire(blocking=False):
+                time.sleep(WARM_IDLE_WAIT)
+                continue
+            try:
+                warm(key, body)
+                warmed += 1
+                break
+            except Cancelled as e:
+                if str(e) != "request waiting":
+                    print(f"Could not warm {key}: {e}")
+                    break
+            except Exception as e:
+                print(f"Could not warm {key}: {e}")
+                break
+            finally:
+                archive_lock.release()
+    print(f"Warmed {warmed} pages and searches from the last snapshot")
+
+def start_warm_cache():
+    """
+    Warm the caches in the background, and snapshot what's popular periodically and on shutdown
+    """
+    threading.Thread(target=rewarm, daemon=True, name="rewarm").start()
+    uuids = archive_uuids()
+    warm_cache.start_saving(uuids, page_body)
+    atexit.register(warm_cache.save, uuids, page_body)
+    # so a plain kill saves the snapshot too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+def start_render_server():
+    """
+    Serve pages/zr.mu from this process so a page view doesn't pay for a python start and imports
+    """
+    server = RenderServer(handle_command)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Rendering zr.mu pages on {server.server_address}")
+    return server
+
 def main_loop():
     listener = Listener(('localhost', 6000), authkey=authkey)
     running = True
@@ -152,23 +442,9 @@ def main_loop():
             
             msg = conn.recv()
             print(msg)
-            command = msg.get("command")
-            resp = {"status":"error", "message": f"no handler for command={command}"}
-            
-            if command == "list_archives":
-                resp = list_archives()
-            elif command == "request_path":
-                archive_id = int(msg.get("archive", -1))
-                path = msg.get("path", None) # path requested
-                last_path = msg.get("last_path",None)
-                resp = request_path(archive_id, path, last_path)
-                #print(resp.get("content","?"))
-            elif command == "search":
-                archive_id = int(msg.get("archive", -1))
-                search_str = msg.get("search", "no search?")
-                page = int(msg.get("page",0))
-                resp = search(archive_id, search_str, page, 5)
-                
+            # legacy clients never half close, any hangup means they're gone
+            deadline = Deadline(msg.get("budget"), conn.fileno(), getattr(select, "POLLRDHUP", select.POLLHUP))
+            resp = handle_command(msg, deadline)
             conn.send(resp)
             #print(resp)
             conn.close()
@@ -181,6 +457,8 @@ def main_loop():
 
 
 load(zimpath)    
+start_render_server()
+start_warm_cache()
 main_loop()
     
 #result = request("wikipedia_en_all_mini_2024-04", "/A/Baseball")
@@ -0,0 +1,133 @@
+"""
+Path membership index for zim archives, so pages can be converted with dead links (articles a
+mini/nopic zim left out) shown as plain text instead of links that cost a round trip to find out.
+
+Each archive gets a sorted array of 32 bit hashes of its entry paths, 4 bytes an entry. A hash
+collision can only make a dead link look alive, which is how every link was rendered before.
+Indexes are built in a background thread the first time they're needed and saved to the cache
+directory, tagged with the archive's uuid so a replaced zim file gets a new one.
+"""
+import os
+import threading
+import zlib
+from array import array
+from bisect import bisect_left
+
+# where built indexes are kept between runs
+cache_path = os.environ.get("ZIM_CACHE_PATH", os.path.expanduser("~/.nomadnetwork/storage/zim_cache/"))
+
+
+def path_hash(path):
+    return zlib.crc32(path.encode("UTF-8", errors="surrogatepass"))
+
+
+class PathIndex:
+    """
+    Which paths exist in one archive. Until the index is ready every lookup answers None
+    (unknown), callers fall back to asking the archive.
+    """
+
+    def __init__(self, archive, name):
+        self.archive = archive
+        self.name = name
+        self.file_path = os.path.join(cache_path, name + ".paths")
+        self.hashes = None
+        self.lock = threading.Lock()
+        self.building = False
+        # set once a build (or loading the saved index) has finished, whether it worked or not
+        self.done = threading.Event()
+
+    @property
+    def ready(self):
+        return self.hashes is not None
+
+    def contains(self, path):
+        """True or False, or None if the index isn't built yet (which starts building it)"""
+        hashes = self.hashes
+        if hashes is None:
+            self.build_in_background()
+            return None
+        h = path_hash(path)
+        i = bisect_left(hashes, h)
+        return i < len(hashes) and hashes[i] == h
+
+    def resolve(self, path):
+        """
+        The path request_path should open for path: path itself, path with a trailing slash, or
+        None if neither exists. Returns path unchanged if the index isn't built yet.
+        """
+        found = self.contains(path)
+        if found is None or found:
+            return path
+        if self.contains(path + "/"):
+            return path + "/"
+        return None
+
+    def exists(self, path):
+        """Whether request_path would find path, None if the index isn't built yet"""
+        if not self.ready:
+            self.build_in_background()
+            return None
+        return self.resolve(path) is not None
+
+    def build_in_background(self):
+        with self.lock:
+            if self.building or self.hashes is not None:
+                return
+            self.building = True
+            self.done.clear()
+        threading.Thread(target=self.load_or_build, daemon=True).start()
+
+    def load_or_build(self):
+        try:
+            hashes = self.load()
+            if hashes is None:
+                print(f"Building path index for {self.name}...")
+                hashes = self.build()
+                self.save(hashes)
+                print(f"Path index for {self.name} has {len(hashes)} entries")
+            self.hashes = hashes
+        except Exception as e:
+            print(f"Could not build path index for {self.name}: {e}")
+        finally:
+            self.building = False
+            self.done.set()
+
+    def build(self):
+        # libzim's reader is safe to use from several threads, no need for the archive lock
+        archive = self.archive
+        # bucketed by the top byte so only one bucket at a time is a list of python ints while
+        # sorting, a whole wikipedia's worth would take a few hundred MB
+        buckets = [array("I") for _ in range(256)]
+        for i in range(archive.entry_count):
+            h = path_hash(archive._get_entry_by_id(i).path)
+            buckets[h >> 24].append(h)
+        hashes = array("I")
+        for bucket in buckets:
+            hashes.extend(sorted(bucket))
+            del bucket[:]
+        return hashes
+
+    def load(self):
+        try:
+            with open(self.file_path, "rb") as f:
+                uuid = f.read(16)
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        if uuid != self.archive.uuid.bytes:
+            return None
+        hashes = array("I")
+        hashes.frombytes(data[:len(data) - len(data) % hashes.itemsize])
+        return hashes
+
+    def save(self, hashes):
+        try:
+            os.makedirs(cache_path, exist_ok=True)
+            tmp = self.file_path + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(self.archive.uuid.bytes)
+                hashes.tofile(f)
+            os.replace(tmp, self.file_path)
+        except OSError as e:
+            print(f"Could not save path index for {self.name}: {e}")
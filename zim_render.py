@@ -0,0 +1,219 @@
+"""
+Micron rendering for pages/zr.mu, done resident in zim_host.py. NomadNet starts a fresh process
+for every page view, so zr.mu is only a small shim: it passes its var_*/field_* environment over
+a unix socket and copies the rendered page to stdout. Everything that costs time to import or
+compute lives here, and the page header and archive list are rendered once and cached.
+
+Request: var_*/field_* pairs as "key=value" joined by NUL bytes, plus the seconds the shim will
+wait as "budget", the shim then shuts down its write side. Response: the rendered micron,
+streamed until the connection closes.
+"""
+import functools
+import os
+import select
+import socketserver
+import time
+import traceback
+from collections import Counter
+
+ALL_ARCHIVES = "all" # same as zim_host.ALL_ARCHIVES
+# the shim (pages/zr.mu) reads the same variable with the same default
+SOCKET_PATH = os.environ.get("ZIM_RENDER_SOCKET", os.path.expanduser("~/.nomadnetwork/zim_render.sock"))
+MAX_REQUEST = 64*1024
+MAX_BUDGET = 60 # seconds, no request gets longer than this whatever its client asks for
+HANGUP_POLL_INTERVAL = 0.05 # seconds between checks whether the client is still there
+
+# requests, ok, errors, timeouts and disconnects of both the render server and the listener
+request_stats = Counter()
+
+
+class CommandError(Exception):
+    pass
+
+
+class Cancelled(Exception):
+    """The request ran out of time ("timeout") or its client left ("disconnected")"""
+    pass
+
+
+class Deadline:
+    """
+    Time budget of one request and, if fileno is given, whether its client is still connected.
+    check() raises Cancelled when either is gone, call it between steps of long work.
+    gone_events are the poll events that mean the client left: POLLHUP on the shim's unix socket,
+    which it half closes after sending, POLLRDHUP on a connection that's never half closed.
+    """
+
+    def __init__(self, budget=None, fileno=None, gone_events=select.POLLHUP):
+        try:
+            budget = min(max(0, float(budget)), MAX_BUDGET)
+        except (TypeError, ValueError):
+            budget = MAX_BUDGET
+        self.expires = time.monotonic() + budget
+        self.poll = None
+        if fileno is not None:
+            self.poll = select.poll()
+            self.poll.register(fileno, gone_events)
+        self.last_poll = 0
+
+    def remaining(self):
+        return max(0, self.expires - time.monotonic())
+
+    def check(self):
+        now = time.monotonic()
+        if now > self.expires:
+            raise Cancelled("timeout")
+        if self.poll is not None and now - self.last_poll > HANGUP_POLL_INTERVAL:
+            self.last_poll = now
+            if self.poll.poll(0):
+                raise Cancelled("disconnected")
+
+
+def send_cmd(dispatch, deadline, command, **kwargs):
+    kwargs["command"] = command
+    resp = dispatch(kwargs, deadline)
+    if resp.get("status","nostatus") != "ok":
+        raise CommandError(resp.get("message", "no error message"))
+    return resp
+
+
+@functools.lru_cache(maxsize=1)
+def render_archive_list(archives):
+    """archives is a tuple of (name, id), the archives are loaded once so this is rendered once"""
+    lines = ["Below are Zim files in alphabetical order. Click on on to browse it. ",
+             f"Or search all of them: `B444`<16|search`>`b `[Search all`:/page/zr.mu`search|do_search=1|a={ALL_ARCHIVES}]",
+             # TODO pagination for smaller bandwidth like Lora
+             ">Archives"]
+    for name, archive_id in archives:
+        lines.append(f"`F55a`[{name}`:/page/zr.mu`a={archive_id}]`f")
+    return "\n".join(lines)+"\n"
+
+
+@functools.lru_cache(maxsize=1024)
+def render_page_header(archive_name, archive_id, search_str, last_path):
+    return (f"`[Home`:/page/index.mu]                  `[{archive_name}`:/page/zr.mu`a={archive_id}]                  "+
+            f"`B444`<16|search`{search_str}>`b `[Search`:/page/zr.mu`search|do_search=1|a={archive_id}]               " +
+            (f"`F44a`[<--Back`:/page/zr.mu`a={archive_id}|p={last_path}]`f" if last_path is not None else " ") +
+            "\n-\n\n")
+
+
+@functools.lru_cache(maxsize=1024)
+def render_search_header(archive_name, archive_id, search):
+    return (f"`[Home`:/page/index.mu]                  `[{archive_name}`:/page/zr.mu`a={archive_id}]                  `B444`<16|search`{search}>`b `[Search`:/page/zr.mu`search|do_search=1|a={archive_id}]\n" +
+            "-\n\n")
+
+
+def render_search(resp, search, page):
+    page_size = int(resp.get("page_size", 1))
+    count = int(resp.get("count",-1))
+    num_pages = count/page_size
+    archive_name = resp.get("archive",{}).get("name","archive name")
+    archive_id = resp.get("archive",{}).get("id",0)
+    yield render_search_header(archive_name, archive_id, search)
+    next_page = f"`[Next Page`:/page/zr.mu`search|do_search=1|a={archive_id}|page={page+1}]" if page < num_pages else "          "
+    prev_page = f"`[Prev Page`:/page/zr.mu`search|do_search=1|a={archive_id}|page={page-1}]" if page > 0 else "      "
+    yield f">{count} results for {search}. Showing page {page+1} of {num_pages}\n    {prev_page }   {next_page }  \n-=\n"
+    results = resp.get("results",[])
+    # an all-archives search says how each archive did, and the page's results are grouped by
+    # archive in the order of each archive's best result
+    archives = resp.get("archives")
+    if archives is not None:
+        yield render_archive_counts(archives)
+        groups = {}
+        for r in results:
+            groups.setdefault(r.get("archive",{}).get("id",0), []).append(r)
+        results = [r for group in groups.values() for r in group]
+    group = None
+    for i, r in enumerate(results):
+        title, c, path = r.get("title","?"), r.get("content","???"), r.get("path","/")
+        result_archive = r.get("archive")
+        if result_archive is not None:
+            if result_archive.get("id") != group:
+                group = result_archive.get("id")
+                yield f">>{result_archive.get('name','archive name')}\n"
+            archive_id = group
+        yield f"> Result {i}\n`F44a`[{title}`:/page/zr.mu`a={archive_id}|p={path}]\n"
+        if c is not None:
+            yield c+"\n"
+        yield "-=\n\n"
+
+
+def render_archive_counts(archives):
+    parts = []
+    for a in archives:
+        found = "timed out" if a.get("timed_out") else f"{a.get('count',0)} matches"
+        parts.append(f"`F55a`[{a.get('name','?')}`:/page/zr.mu`a={a.get('id',0)}]`f {found}")
+    return "  ".join(parts)+"\n-=\n"
+
+
+def render(params, dispatch, deadline):
+    """
+    Generator of the micron page for the shim's var_*/field_* params. dispatch(msg, deadline) runs
+    a zim_host command and returns its response.
+    """
+    yield "#!c=0\n" # don't cache, this is all dynamic
+    try:
+        archive = params.get("var_a", None)
+        path = params.get("var_p", None)
+        last_path = params.get("var_L", None)
+        page = int(params.get("var_page", 0))
+        search = params.get("field_search", None)
+        do_search = int(params.get("var_do_search", "0")) > 0
+
+        # default, just list archives
+        if archive is None:
+            resp = send_cmd(dispatch, deadline, "list_archives")
+            yield render_archive_list(tuple((a["name"], a["id"]) for a in resp.get("archives",[])))
+
+        elif do_search and search is not None:
+            resp = send_cmd(dispatch, deadline, "search", archive=archive, search=search, page=page)
+            yield from render_search(resp, search, page)
+
+        # nothing to show for all archives but the search field
+        elif archive == ALL_ARCHIVES:
+            yield render_search_header("All archives", ALL_ARCHIVES, search if search is not None else "")
+
+        # if we have an archive, then grab the path and display it
+        else:
+            resp = send_cmd(dispatch, deadline, "request_path", archive=archive, path=path, last_path=last_path)
+            archive_name = resp.get("archive",{}).get("name","archive name")
+            archive_id = resp.get("archive",{}).get("id",0)
+            yield render_page_header(archive_name, archive_id, search if search is not None else "", last_path)
+            yield resp.get("content","nocontent")+"\n"
+    except CommandError as e:
+        yield "ERROR!! \n"+str(e)+"\nEnd\n"
+    except Exception as e:
+        yield traceback.format_exc()
+
+
+class RenderHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        data = self.rfile.read(MAX_REQUEST+1)
+        if len(data) > MAX_REQUEST:
+            self.wfile.write(b"#!c=0\nERROR!! \nrequest too large\n")
+            return
+        params = dict(pair.split("=", 1) for pair in data.decode("UTF-8", errors="replace").split("\0") if "=" in pair)
+        deadline = Deadline(params.get("budget"), self.connection.fileno())
+        try:
+            # wfile is unbuffered, every chunk goes out as soon as it's rendered
+            for chunk in render(params, self.server.dispatch, deadline):
+                self.wfile.write(chunk.encode("UTF-8"))
+        except OSError:
+            # the shim went away while we were writing
+            request_stats["disconnects"] += 1
+
+
+class RenderServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves the zr.mu shim on a unix socket only the owner can connect to"""
+    daemon_threads = True
+
+    def __init__(self, dispatch, path=SOCKET_PATH):
+        self.dispatch = dispatch
+        # a socket left over from a previous run
+        if os.path.exists(path):
+            os.unlink(path)
+        old_umask = os.umask(0o177)
+        try:
+            super().__init__(path, RenderHandler)
+        finally:
+            os.umask(old_umask)
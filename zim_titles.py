@@ -0,0 +1,228 @@
+"""
+Title search for zim archives that come without a full text index. Built offline, once per zim:
+
+    python zim_titles.py ~/zims/            # every .zim in the directory
+    python zim_titles.py ~/zims/foo.zim
+
+and memory mapped by zim_host.py, which uses it when an archive has no Xapian index. The index
+holds every article's normalized title, sorted, for prefix queries by binary search, and a
+trigram posting list for substring queries and, when those come up short, fuzzy ones ranked by
+shared trigrams. Nothing is loaded into memory, the OS pages in the parts a query touches.
+
+File layout, all little endian u32 arrays after the header:
+    header          magic, version, archive uuid, title count, trigram count
+    title_offsets   title count + 1 offsets into the titles blob
+    entry_ids       title count ids for archive._get_entry_by_id()
+    trigram_keys    trigram count sorted crc32s of the trigrams
+    posting_offsets trigram count + 1 offsets into postings
+    postings        title numbers, sorted within each trigram
+    titles          the normalized titles, UTF-8, in sorted order
+"""
+import mmap
+import os
+import struct
+import sys
+import unicodedata
+import zlib
+from array import array
+from bisect import bisect_left
+from collections import Counter
+
+from zim_paths import cache_path
+
+MAGIC = b"ZTI1"
+_HEADER = struct.Struct("<4sI16sII")
+# trigrams in more titles than this are too common to narrow anything down in a fuzzy search
+FUZZY_MAX_POSTINGS = 100000
+# share of the query's trigrams a title needs for a fuzzy match
+FUZZY_MIN_SHARE = 0.5
+
+
+def normalize(title):
+    """casefolded, accents stripped, whitespace collapsed"""
+    decomposed = unicodedata.normalize("NFKD", title.casefold())
+    return " ".join("".join(c for c in decomposed if not unicodedata.combining(c)).split())
+
+
+def trigrams(normalized, padded=True):
+    # padded so short words and word starts have trigrams too, a substring of a title only has
+    # the title's inner trigrams
+    if padded:
+        normalized = f" {normalized} "
+    return {zlib.crc32(normalized[i:i+3].encode("UTF-8")) for i in range(len(normalized) - 2)}
+
+
+def index_path(name):
+    return os.path.join(cache_path, name + ".titles")
+
+
+def build(archive, out_path):
+    """
+    Write the title index of archive to out_path. Holds every title in memory while building,
+    meant to run offline and not on the node serving pages.
+    """
+    titles = []
+    for entry_id in range(archive.entry_count):
+        entry = archive._get_entry_by_id(entry_id)
+        # articles and redirects to them, not images, scripts and the like
+        if not entry.is_redirect and not entry.get_item().mimetype.startswith("text/html"):
+            continue
+        normalized = normalize(entry.title)
+        if normalized:
+            titles.append((normalized, entry_id))
+    titles.sort()
+
+    title_offsets = array("I", [0])
+    entry_ids = array("I")
+    blob = bytearray()
+    grams = {}
+    for number, (normalized, entry_id) in enumerate(titles):
+        blob += normalized.encode("UTF-8")
+        title_offsets.append(len(blob))
+        entry_ids.append(entry_id)
+        for gram in trigrams(normalized):
+            grams.setdefault(gram, array("I")).append(number)
+
+    trigram_keys = array("I", sorted(grams))
+    posting_offsets = array("I", [0])
+    postings = array("I")
+    for gram in trigram_keys:
+        # titles are numbered in order, each posting list is sorted already
+        postings.extend(grams[gram])
+        posting_offsets.append(len(postings))
+
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, 1, archive.uuid.bytes, len(titles), len(trigram_keys)))
+        for part in (title_offsets, entry_ids, trigram_keys, posting_offsets, postings):
+            part.tofile(f)
+        f.write(blob)
+    os.replace(tmp_path, out_path)
+    return len(titles)
+
+
+class TitleIndex:
+    """A memory mapped title index, see build()"""
+
+    def __init__(self, path, archive):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, uuid, count, gram_count = _HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != 1 or uuid != archive.uuid.bytes:
+            self.mm.close()
+            raise ValueError(f"{path} is not a title index for {archive.filename}")
+        self.count = count
+        words = memoryview(self.mm)[_HEADER.size:].cast("B")
+        pos = 0
+        def u32s(n):
+            nonlocal pos
+            part = words[pos:pos + 4*n].cast("I")
+            pos += 4*n
+            return part
+        self.title_offsets = u32s(count + 1)
+        self.entry_ids = u32s(count)
+        self.trigram_keys = u32s(gram_count)
+        self.posting_offsets = u32s(gram_count + 1)
+        self.postings = u32s(self.posting_offsets[-1] if gram_count else 0)
+        self.titles = words[pos:]
+
+    @classmethod
+    def open(cls, name, archive):
+        """The index for archive if one was built for it, else None"""
+        try:
+            return cls(index_path(name), archive)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"Not using title index for {name}: {e}")
+            return None
+
+    def title(self, number):
+        return bytes(self.titles[self.title_offsets[number]:self.title_offsets[number + 1]])
+
+    def _posting(self, gram):
+        i = bisect_left(self.trigram_keys, gram)
+        if i == len(self.trigram_keys) or self.trigram_keys[i] != gram:
+            return None
+        return self.postings[self.posting_offsets[i]:self.posting_offsets[i + 1]]
+
+    def prefix(self, query, limit):
+        """Title numbers of titles starting with the normalized query"""
+        key = query.encode("UTF-8")
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.title(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        found = []
+        while lo < self.count and len(found) < limit and self.title(lo).startswith(key):
+            found.append(lo)
+            lo += 1
+        return found
+
+    def substring(self, query, limit):
+        """Title numbers of titles containing the normalized query, which needs 3 characters"""
+        postings = [self._posting(gram) for gram in trigrams(query, padded=False)]
+        if not postings or any(p is None for p in postings):
+            return []
+        postings.sort(key=len)
+        # walk the rarest trigram's titles, the others only have to confirm
+        key = query.encode("UTF-8")
+        found = []
+        for number in postings[0]:
+            if all(_contains(p, number) for p in postings[1:]) and key in self.title(number):
+                found.append(number)
+                if len(found) == limit:
+                    break
+        return found
+
+    def fuzzy(self, query, limit):
+        """Title numbers of titles sharing the most trigrams with the normalized query"""
+        grams = trigrams(query)
+        votes = Counter()
+        for gram in grams:
+            posting = self._posting(gram)
+            if posting is not None and len(posting) <= FUZZY_MAX_POSTINGS:
+                votes.update(posting)
+        needed = max(1, int(len(grams) * FUZZY_MIN_SHARE))
+        return [number for number, shared in votes.most_common(limit) if shared >= needed]
+
+    def search(self, query, limit):
+        """
+        Entry ids of up to limit titles matching query: prefix matches, then substring matches,
+        then fuzzy ones
+        """
+        query = normalize(query)
+        if not query:
+            return []
+        found = dict.fromkeys(self.prefix(query, limit))
+        for more in (self.substring, self.fuzzy):
+            if len(found) >= limit:
+                break
+            found.update(dict.fromkeys(more(query, limit)))
+        return [self.entry_ids[number] for number in list(found)[:limit]]
+
+
+def _contains(posting, number):
+    i = bisect_left(posting, number)
+    return i < len(posting) and posting[i] == number
+
+
+def main():
+    from libzim.reader import Archive
+    if len(sys.argv) != 2:
+        print("usage: python zim_titles.py <zim file or directory of zim files>")
+        sys.exit(1)
+    target = sys.argv[1]
+    files = [os.path.join(target, f) for f in sorted(os.listdir(target)) if f.endswith(".zim")] if os.path.isdir(target) else [target]
+    os.makedirs(cache_path, exist_ok=True)
+    for file in files:
+        name = os.path.basename(file)[:-4]
+        count = build(Archive(file), index_path(name))
+        print(f"{name}: {count} titles -> {index_path(name)}")
+
+
+if __name__ == "__main__":
+    main()
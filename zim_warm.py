@@ -0,0 +1,113 @@
+"""
+Warm cache snapshots for zim_host.py. The converted pages and all-archives searches zim_host
+keeps in memory are gone after a restart, and the first visitors of every popular page pay for
+converting it again. This counts hits per page and search, saves the hottest ones to the cache
+directory on shutdown and every SAVE_INTERVAL seconds, and on startup hands them back most
+popular first, for zim_host to restore or redo in a background thread.
+
+The converted pages themselves are only saved with ZIM_WARM_BODIES=1, without them restoring
+means converting the pages again. Snapshot layout, gzipped JSON:
+    {"version": 1, "archives": {name: uuid hex}, "pages": [[name, path, hits, body or null]],
+     "searches": [[needle, hits]]}
+Pages of an archive whose uuid changed are dropped, the zim file was replaced.
+"""
+import gzip
+import json
+import os
+import threading
+import time
+from collections import Counter
+
+from zim_paths import cache_path
+
+SNAPSHOT_PATH = os.path.join(cache_path, "warm_cache.json.gz")
+KEEP_BODIES = os.environ.get("ZIM_WARM_BODIES", "0") == "1"
+SAVE_INTERVAL = 300 # seconds between snapshots, if anything was hit since the last one
+SNAPSHOT_PAGES = 200
+SNAPSHOT_SEARCHES = 32
+TRACKED_KEYS = 4096 # hit counts kept, the least popular are forgotten beyond twice this
+
+
+class WarmCache:
+    """
+    Hit counts of ("page", archive name, path) and ("search", needle) keys. hit() is called from
+    any request thread.
+    """
+
+    def __init__(self, path=SNAPSHOT_PATH, keep_bodies=KEEP_BODIES):
+        self.path = path
+        self.keep_bodies = keep_bodies
+        self.hits = Counter()
+        self.lock = threading.Lock()
+        self.dirty = False
+
+    def hit(self, key):
+        with self.lock:
+            self.hits[key] += 1
+            self.dirty = True
+            if len(self.hits) > 2*TRACKED_KEYS:
+                self.hits = Counter(dict(self.hits.most_common(TRACKED_KEYS)))
+
+    def _hottest(self, kind, n):
+        with self.lock:
+            ranked = [(key, hits) for key, hits in self.hits.most_common() if key[0] == kind]
+        return ranked[:n]
+
+    def save(self, archive_uuids, page_body):
+        """
+        Write the snapshot. archive_uuids is {archive name: uuid hex}, page_body(name, path) the
+        converted page if it's still in memory, else None.
+        """
+        self.dirty = False
+        pages = []
+        for (_, name, path), hits in self._hottest("page", SNAPSHOT_PAGES):
+            if name in archive_uuids:
+                pages.append([name, path, hits, page_body(name, path) if self.keep_bodies else None])
+        searches = [[needle, hits] for (_, needle), hits in self._hottest("search", SNAPSHOT_SEARCHES)]
+        snapshot = {"version": 1, "archives": archive_uuids, "pages": pages, "searches": searches}
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + ".tmp"
+            with gzip.open(tmp, "wt", encoding="UTF-8") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"Could not save warm cache snapshot: {e}")
+
+    def load(self, archive_uuids):
+        """
+        The snapshot's keys still valid for archive_uuids, most popular first, as (key, body or
+        None). Their hits count again, halved so what was popular long ago fades out.
+        """
+        try:
+            with gzip.open(self.path, "rt", encoding="UTF-8") as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError) as e:
+            print(f"Not using warm cache snapshot: {e}")
+            return []
+        if snapshot.get("version") != 1:
+            return []
+        saved_uuids = snapshot.get("archives", {})
+        entries = []
+        for name, path, hits, body in snapshot.get("pages", []):
+            if name in archive_uuids and saved_uuids.get(name) == archive_uuids[name]:
+                entries.append((hits, ("page", name, path), body))
+        for needle, hits in snapshot.get("searches", []):
+            # results are searched again, they'd be stale if any archive changed
+            entries.append((hits, ("search", needle), None))
+        entries.sort(key=lambda e: -e[0])
+        with self.lock:
+            for hits, key, _ in entries:
+                self.hits[key] += max(1, hits // 2)
+        return [(key, body) for _, key, body in entries]
+
+    def start_saving(self, archive_uuids, page_body):
+        """Save a snapshot every SAVE_INTERVAL seconds that had hits, in a daemon thread"""
+        def run():
+            while True:
+                time.sleep(SAVE_INTERVAL)
+                if self.dirty:
+                    self.save(archive_uuids, page_body)
+        threading.Thread(target=run, daemon=True, name="warm-cache").start()